@@ -0,0 +1,460 @@
+"""asyncio serial interface for Neato."""
+import serial
+import asyncio
+from gpiobackend import GPIO
+import time
+from neatoserial import (NeatoBase, RESPONSE_TERMINATOR, RESPONSE_TIMEOUTS, RECONNECTS,
+                         RECONNECT_SECONDS, USB_TOGGLES, BYTES_OUT, BYTES_IN,
+                         COALESCED_REQUESTS)
+from usbwatch import DeviceWatcher
+
+
+class AsyncNeatoSerial(NeatoBase):
+    """Serial interface to Neato driven by event loop readiness of the tty.
+
+    Commands are coroutines; the port is opened non-blocking and replies are
+    collected by a reader callback on its file descriptor.
+    """
+
+    def __init__(self, config=None):
+        """Initialize state. Call connect() from the event loop to open the port."""
+        super(AsyncNeatoSerial, self).__init__(config)
+        self.ser = None
+        self.isConnected = False
+        self.readBuffer = b''
+        self.waiter = None
+        self.waitCount = 0
+        self.waitMsgs = None
+        self.lock = asyncio.Lock()
+        self.inflight = {}
+        self.coalesced = 0
+
+    async def connect(self, timeout=0):
+        """Connect to serial port, waiting up to timeout seconds for Neato to show up."""
+        deadline = time.monotonic() + timeout
+        watcher = DeviceWatcher() if timeout > 0 else None
+        try:
+            while True:
+                devices = self.getDevices()
+                for dev in devices:
+                    if not self.isUsbEnabled:
+                        self.log.debug("Usb is manually disabled, stop trying to connect.")
+                        return False
+
+                    try:
+                        self.ser = serial.Serial(dev, 115200,
+                                                 serial.EIGHTBITS, serial.PARITY_NONE,
+                                                 serial.STOPBITS_ONE, timeout=0)
+                        self.ser.flushInput()
+                        asyncio.get_running_loop().add_reader(self.ser.fileno(), self.onReadable)
+                        self.readBuffer = b''
+                        self.wakeUp.reset()
+                        self.cache.invalidate()
+                        self.log.info("Connected to Neato at %s", dev)
+                        self.errorConnectingCount = 0
+                        self.isConnected = True
+                        return True
+                    except Exception as ex:
+                        self.log.debug("Could not connect to device %s: %s", dev, ex)
+                if watcher is None or not await watcher.waitAsync(deadline - time.monotonic()):
+                    break
+        finally:
+            if watcher is not None:
+                watcher.close()
+        self.log.error("Could not connect to any of %s.", devices)
+        self.errorConnectingCount += len(devices)
+
+        # Reboot RaspberryPi in case lots of connection errors:
+        if self.errorConnectingCount > 100:
+            self.reboot()
+
+        return False
+
+    def getIsConnected(self):
+        """Return if connected."""
+        return self.isConnected
+
+    def close(self):
+        """Close serial port."""
+        self.log.info("Entering CLOSE()")
+        if self.ser is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.ser.fileno())
+            except (OSError, ValueError):
+                pass
+            self.ser.close()
+        self.isConnected = False
+        self.failWaiter(OSError("Serial port closed"))
+        self.log.info("Leaving CLOSE, isConnected= %s", self.isConnected)
+
+    def onReadable(self):
+        """Collect pending bytes when the tty becomes readable."""
+        try:
+            chunk = self.ser.read(max(1, self.ser.inWaiting()))
+        except (OSError, serial.SerialException) as ex:
+            # device vanished, stop watching the dead descriptor
+            asyncio.get_running_loop().remove_reader(self.ser.fileno())
+            self.isConnected = False
+            self.failWaiter(OSError(str(ex)))
+            return
+        self.readBuffer += chunk
+        if (self.waiter is not None and not self.waiter.done()
+                and (self.readBuffer.count(RESPONSE_TERMINATOR) >= self.waitCount
+                     or (RESPONSE_TERMINATOR in chunk
+                         and self.isBatchAnswered(self.readBuffer, self.waitMsgs)))):
+            self.waiter.set_result(None)
+
+    def failWaiter(self, ex):
+        """Wake up a pending exchange with an error."""
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(ex)
+
+    async def exchange(self, msgs):
+        """Send messages back-to-back and return the raw reply bytes."""
+        # drop leftovers of earlier responses so they don't frame this one
+        self.ser.flushInput()
+        self.readBuffer = b''
+        inp = ''.join(msg+"\n" for msg in msgs).encode('utf-8')
+        BYTES_OUT.inc(amount=len(inp))
+        started = time.monotonic()
+        self.ser.write(inp)
+        if self.getFraming() != 'terminator':
+            await asyncio.sleep(1)
+            BYTES_IN.inc(amount=len(self.readBuffer))
+            self.observeExchange(msgs, started)
+            return self.readBuffer
+        timeout = sum(self.getCommandTimeout(msg) for msg in msgs)
+        self.waitCount = len(msgs)
+        self.waitMsgs = msgs
+        self.waiter = asyncio.get_running_loop().create_future()
+        if self.isBatchAnswered(self.readBuffer, msgs):
+            self.waiter.set_result(None)
+        try:
+            await asyncio.wait_for(self.waiter, timeout)
+        except asyncio.TimeoutError:
+            self.log.warning("Timed out after %ss waiting for end of response.", timeout)
+            RESPONSE_TIMEOUTS.inc()
+        finally:
+            self.waiter = None
+        BYTES_IN.inc(amount=len(self.readBuffer))
+        self.observeExchange(msgs, started)
+        return self.readBuffer
+
+    async def raw_write(self, msg):
+        """Write message to serial and return output."""
+        self.log.info("Entering RAW_WRITE(), msg = %s", msg)
+        out = ''
+        if self.isConnected:
+            out = (await self.exchange([msg])).decode('utf-8')
+            if out != '':
+                self.wakeUp.markActive()
+        self.log.info("Leaving RAW_WRITE()")
+        return out
+
+    async def raw_write_batch(self, msgs):
+        """Write messages back-to-back and return their outputs by message.
+
+        Messages that got no reply are left out.
+        """
+        self.log.info("Entering RAW_WRITE_BATCH(), msgs = %s", msgs)
+        outputs = {}
+        if self.isConnected:
+            if self.getFraming() != 'terminator':
+                for msg in msgs:
+                    outputs[msg] = await self.raw_write(msg)
+                return outputs
+            data = await self.exchange(msgs)
+            frames = [f.decode('utf-8') + RESPONSE_TERMINATOR.decode('utf-8')
+                      for f in data.split(RESPONSE_TERMINATOR)[:-1]]
+            if len(frames) == len(msgs):
+                outputs = dict(zip(msgs, frames))
+            else:
+                self.log.warning("Got %s of %s responses in batch.", len(frames), len(msgs))
+                for frame in frames:
+                    echo = frame.lstrip().split('\r\n')[0].strip().lower()
+                    for msg in msgs:
+                        if msg.lower() == echo and msg not in outputs:
+                            outputs[msg] = frame
+                            break
+            if frames:
+                self.wakeUp.markActive()
+        self.log.info("Leaving RAW_WRITE_BATCH()")
+        return outputs
+
+    async def sendWakeUp(self):
+        """Wake up neato by sending something random."""
+        self.log.info("Sending Wake-up msg.")
+        idle = self.wakeUp.idleSeconds()
+        out = await self.raw_write("wake-up")
+        self.wakeUp.wakeUpsSent += 1
+        if out != '':
+            self.wakeUp.learnAwake(idle)
+
+    async def write(self, msg):
+        """Write message to serial and return output. Handles Clean message.
+
+        Queries share the exchange of an identical one still in flight.
+        """
+        if not self.isQuery(msg):
+            return (await self.writeBatch([msg]))[msg]
+        task = self.inflight.get(msg)
+        if task is None:
+            task = asyncio.ensure_future(self.writeBatch([msg]))
+            self.inflight[msg] = task
+            task.add_done_callback(lambda t: self.inflight.pop(msg, None))
+        else:
+            self.coalesced += 1
+            COALESCED_REQUESTS.inc((msg,))
+        # one caller giving up must not cancel the exchange for the others
+        return (await asyncio.shield(task))[msg]
+
+    async def writeBatch(self, msgs):
+        """Write several messages in one burst and return their outputs by message.
+
+        Outputs are None for messages that got no answer.
+        """
+        self.log.info("Entering WRITEBATCH, msgs = %s", msgs)
+        msgs = list(dict.fromkeys(msgs))
+        results = {msg: self.cache.get(msg) for msg in msgs}
+        queries = [m for m in msgs if results[m] is None and not self.isCleanMessage(m)]
+        if not queries and not any(self.isCleanMessage(m) for m in msgs):
+            self.log.info("Leaving WRITEBATCH(), all outputs cached")
+            return results
+        for msg in queries:
+            self.invalidateCacheFor(msg)
+        async with self.lock:
+            if not self.isConnected:
+                await self.handleNotConnected()
+                return results
+            try:
+                idle = self.wakeUp.idleSeconds()
+                skippedWakeUp = not self.wakeUp.needsWakeUp()
+                if not skippedWakeUp:
+                    await self.sendWakeUp()
+                outputs = await self.raw_write_batch(queries) if queries else {}
+                missing = self.missingReplies(queries, outputs)
+                if missing and skippedWakeUp:
+                    # a sleeping Neato only swallows the first command of a burst
+                    self.log.info("No answer to %s without wake-up, Neato fell asleep after %ss idle.",
+                                  missing, idle)
+                    self.wakeUp.learnAsleep(idle)
+                    await self.sendWakeUp()
+                elif skippedWakeUp:
+                    self.wakeUp.wakeUpsSkipped += 1
+                if missing:
+                    outputs.update(await self.raw_write_batch(missing))
+                for msg, out in outputs.items():
+                    if out != '':
+                        results[msg] = out
+                        self.cache.put(msg, out)
+                for msg in msgs:
+                    if self.isCleanMessage(msg):
+                        out = await self.handleCleanMessage(msg)
+                        results[msg] = out if out != '' else None
+            except OSError as ex:
+                await self.handleWriteError(ex)
+        self.log.info("Leaving WRITEBATCH()")
+        return results
+
+    async def handleWriteError(self, ex):
+        """Close or reconnect after a failed write."""
+        self.log.error("Exception in 'write' method: %s", ex)
+        if not self.isUsbEnabled:
+            self.log.warning("Planned disconnection of USB → UART occurred, no need to reconnect")
+            self.close()
+        else:
+            self.log.info("Calling RECONNECT()")
+            await self.reconnect()
+
+    async def handleNotConnected(self):
+        """Try to connect when a write found the port closed."""
+        if self.isUsbEnabled:
+            self.log.info("Not connected in WRITE() - calling CONNECT()")
+            await self.connect()
+        else:
+            self.log.info("Usb is manually disabled, can't communicate yet.")
+
+    async def toggleusb(self):
+        """Toggle USB connection to Neato."""
+        self.log.info("Entering TOGGLEUSB()")
+        USB_TOGGLES.inc()
+        self.cache.invalidate()
+        if self.config['usb_switch_mode'] == 'direct':
+            self.log.info("Direct connection specified.")
+            process = await asyncio.create_subprocess_shell(self.getHubCtrlCommand())
+            await process.wait()
+        elif self.config['usb_switch_mode'] == 'relay':
+            self.log.debug("Relay connection specified")
+            dev = self.getUsbDevice()
+            with DeviceWatcher() as watcher:
+                GPIO.output(self.pin, GPIO.LOW)
+                switchedOff = time.monotonic()
+                await watcher.waitGoneAsync(dev, self.getUsbOffSeconds())
+            # the node can vanish within milliseconds, Neato needs the power off for longer
+            await asyncio.sleep(max(0, switchedOff + self.getUsbOffMinSeconds() - time.monotonic()))
+            GPIO.output(self.pin, GPIO.HIGH)
+            self.log.info("Relay toggled.")
+        if self.config['reboot_after_usb_switch']:
+            self.reboot()
+        self.log.info("Leaving TOGGLEUSB()")
+
+    async def reconnect(self):
+        """Close and reconnect connection to Neato."""
+        self.log.info("Entering RECONNECT()")
+        RECONNECTS.inc()
+        self.isConnected = False
+        self.cache.invalidate()
+        started = time.monotonic()
+        self.close()
+        if await self.connect(self.getReconnectTimeout()):
+            RECONNECT_SECONDS.observe(time.monotonic() - started)
+        self.log.info("Leaving RECONNECT(),  isConnected = %s", self.isConnected)
+
+    async def handleCleanMessage(self, msg):
+        """Handle sending and extra activities for Clean messages."""
+        self.log.info("Entering HANDLECLEANMESSAGE(), msg = %s", msg)
+        out = await self.cleanWithUsbToggle(msg)
+        self.log.info("Leaving HANDLECLEANMESSAGE(), out=%.10s", out)
+        return out
+
+    async def cleanWithUsbToggle(self, msg=None):
+        """Stopping, Clearing Error, in case someone paused it and wants to start again"""
+        return (await self.startClean(msg)).out
+
+    async def startClean(self, msg=None):
+        """Start cleaning and wait until the vacuum runs. Return the finished CleanStart.
+
+        Call with the lock held.
+        """
+        self.log.info("Entering STARTCLEAN(), msg = %s", msg)
+        if self.isConnected and self.wakeUp.needsWakeUp():
+            await self.sendWakeUp()
+        start = self.newCleanStart(msg)
+        while not start.done():
+            action = start.action()
+            self.log.debug("Clean start: %s", action)
+            result = None
+            if action[0] == 'batch':
+                result = await self.raw_write_batch(action[1])
+                for msg in self.missingReplies(action[1], result):
+                    result[msg] = await self.raw_write(msg)
+            elif action[0] == 'write':
+                result = await self.raw_write(action[1])
+            elif action[0] == 'toggle':
+                await self.toggleusb()
+            elif action[0] == 'reconnect':
+                await self.reconnect()
+                result = self.isConnected
+            elif action[0] == 'wait':
+                await asyncio.sleep(action[1])
+            start.advance(result)
+        self.log.info("Leaving STARTCLEAN(), %s", start.getStats())
+        return start
+
+    async def getError(self, getErrResult=None):
+        """Return error message if available."""
+        output = getErrResult
+        if output == None:
+            output = await self.write("GetErr")
+        error = self.parseError(output)
+        if error is not None and int(error[0]) == 220:
+            # if err is 220 (unplug usb before cleaning) handle it
+            self.log.info("Errorcode is 220. Let's stop clean and start it fresh")
+            async with self.lock:
+                await self.cleanWithUsbToggle()
+        return error
+
+    async def getBatteryLevel(self, getChargerResult=None):
+        """Return battery level."""
+        if getChargerResult == None:
+            getChargerResult = await self.getCharger()
+        return self.parseBatteryLevel(getChargerResult)
+
+    async def getChargingActive(self, getChargerResult=None):
+        """Return true if device is currently charging."""
+        if getChargerResult == None:
+            getChargerResult = await self.getCharger()
+        return self.parseChargingActive(getChargerResult)
+
+    async def getExtPwrPresent(self, getChargerResult=None):
+        """Return true if device is currently docked."""
+        if getChargerResult == None:
+            getChargerResult = await self.getCharger()
+        return self.parseExtPwrPresent(getChargerResult)
+
+    async def getAccel(self):
+        """Get accelerometer info."""
+        return self.parseRecord("GetAccel", await self.write("GetAccel"))
+
+    async def getAnalogSensors(self):
+        """Get analog sensor info."""
+        return self.parseRecord("GetAnalogSensors", await self.write("GetAnalogSensors"))
+
+    async def getButtons(self):
+        """Get button info."""
+        return self.parseRecord("GetButtons", await self.write("GetButtons"))
+
+    async def getCalInfo(self):
+        """Get calibration info."""
+        return self.parseRecord("GetCalInfo", await self.write("GetCalInfo"))
+
+    async def getCharger(self):
+        """Get charger info."""
+        return self.parseRecord("GetCharger", await self.write("GetCharger"))
+
+    async def getDigitalSensors(self):
+        """Get digital sensor info."""
+        return self.parseRecord("GetDigitalSensors", await self.write("GetDigitalSensors"))
+
+    async def getLDSScan(self, out=None):
+        """Get lidar scan as an LDSScan. Needs TestMode and LDS rotation on."""
+        return self.parseLDSScan(await self.write("GetLDSScan"), out)
+
+    async def getMotors(self):
+        """Get motor info."""
+        return self.parseRecord("GetMotors", await self.write("GetMotors"))
+
+    async def getSerialNumber(self, getVersionResult=None):
+        """Get serial number."""
+        if getVersionResult == None:
+            getVersionResult = await self.getVersion()
+        return self.parseSerialNumber(getVersionResult)
+
+    async def getSoftwareVersion(self, getVersionResult=None):
+        """Get main board software version."""
+        if getVersionResult == None:
+            getVersionResult = await self.getVersion()
+        return self.parseSoftwareVersion(getVersionResult)
+
+    async def getVersion(self):
+        """Get version info."""
+        return self.parseRecord("GetVersion", await self.write("GetVersion"))
+
+    async def getVacuumRPM(self, getMotorsResult=None):
+        """Get vacuum RPM."""
+        if getMotorsResult == None:
+            getMotorsResult = await self.getMotors()
+        return self.parseVacuumRPM(getMotorsResult)
+
+    async def getCleaning(self, getMotorsResult=None):
+        """Return true is device is currently cleaning."""
+        return await self.getVacuumRPM(getMotorsResult) > 0
+
+    async def getCombinedState(self):
+        """Gets combined info in one batched exchange."""
+        results = await self.writeBatch(["GetVersion", "GetCharger", "GetMotors", "GetErr"])
+        return self.parseCombinedState(self.parseRecord("GetVersion", results["GetVersion"]),
+                                       self.parseRecord("GetCharger", results["GetCharger"]),
+                                       self.parseRecord("GetMotors", results["GetMotors"]),
+                                       await self.getError(results["GetErr"]))
+
+
+if __name__ == '__main__':
+    async def main():
+        ns = AsyncNeatoSerial()
+        await ns.connect()
+        state = await ns.getCombinedState()
+        ns.log.info(">> %s", vars(state))
+        ns.close()
+
+    asyncio.run(main())
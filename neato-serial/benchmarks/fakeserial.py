@@ -0,0 +1,94 @@
+"""In-process serial port answering like Neato after scripted latencies."""
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from neatoemulator import NeatoEmulator, TERMINATOR  # noqa: E402
+
+
+class FakeSerial:
+    """The subset of pyserial's Serial that NeatoSerial uses.
+
+    Output comes from NeatoEmulator's command handlers. latencies maps a
+    command name (first word, case-insensitive) to seconds, or to a list of
+    seconds used in turn; other commands take defaultLatency. baud adds the
+    transfer time of each response, 0 leaves it out.
+    """
+
+    def __init__(self, latencies=None, defaultLatency=0.005, baud=115200, timeout=0.1):
+        self.emulator = NeatoEmulator(link=None, latency=0, jitter=0, baud=0, seed=1)
+        self.latencies = {}
+        for command, latency in (latencies or {}).items():
+            steps = latency if isinstance(latency, list) else [latency]
+            self.latencies[command.lower()] = itertools.cycle(steps)
+        self.defaultLatency = defaultLatency
+        self.baud = baud
+        self.timeout = timeout
+        self.pending = []
+        self.buffer = b''
+        self.busyUntil = 0.0
+        self.bytesWritten = 0
+        self.bytesRead = 0
+
+    def latencyFor(self, command):
+        steps = self.latencies.get(command.split(' ')[0].lower())
+        return next(steps) if steps is not None else self.defaultLatency
+
+    def write(self, data):
+        self.bytesWritten += len(data)
+        for line in data.decode('utf-8').split('\n'):
+            command = line.strip('\r ')
+            if not command:
+                continue
+            response = (command + '\r\n' + self.emulator.handle(command)
+                        + TERMINATOR).encode('ascii')
+            # commands are answered one after the other, like on the real link
+            start = max(time.monotonic(), self.busyUntil)
+            ready = start + self.latencyFor(command)
+            if self.baud:
+                ready += len(response) * 10 / self.baud
+            self.busyUntil = ready
+            self.pending.append((ready, response))
+        return len(data)
+
+    def collect(self):
+        """Move responses that are due into the read buffer."""
+        now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            self.buffer += self.pending.pop(0)[1]
+
+    def inWaiting(self):
+        self.collect()
+        return len(self.buffer)
+
+    in_waiting = property(inWaiting)
+
+    def read(self, size=1):
+        self.collect()
+        if not self.buffer:
+            deadline = time.monotonic() + (self.timeout or 0)
+            if self.pending and self.pending[0][0] < deadline:
+                deadline = self.pending[0][0]
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.collect()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.bytesRead += len(data)
+        return data
+
+    def flushInput(self):
+        self.collect()
+        self.buffer = b''
+
+    reset_input_buffer = flushInput
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        self.pending = []
+        self.buffer = b''
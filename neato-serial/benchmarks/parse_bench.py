@@ -0,0 +1,70 @@
+"""Micro-benchmark of response parsing cost per command.
+
+Run from the neato-serial directory on the target (e.g. the Pi):
+
+    python benchmarks/parse_bench.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from neatoschema import parseRecord, parseTable  # noqa: E402
+
+SAMPLES = {
+    'GetVersion': (
+        "GetVersion\r\nComponent,Major,Minor,Build\r\n"
+        "Product Model,XV21,\r\n"
+        "Serial Number,AAA00000AA0000000,0000,D\r\n"
+        "Software,3,6,29041\r\n"
+        "MainBoard Software,6,1,13328\r\n"
+        "MainBoard Version,1,0,\r\n"
+        "LDS Software,V2.6.15295,0000000000,\r\n"
+        "LDS Serial,KSH00000AA-0000000,\r\n"
+        "LDS CPU,F2802x/c001,\r\n"
+        "BootLoader Software,17225,1,\r\n"
+        "Chassis Version,-1,\r\n"
+        "UI Board Software,0,0\r\n"),
+    'GetCharger': (
+        "GetCharger\r\nLabel,Value\r\n"
+        "FuelPercent,87\r\nBatteryOverTemp,0\r\nChargingActive,1\r\n"
+        "ChargingEnabled,1\r\nConfidentOnFuel,0\r\nOnReservedFuel,0\r\n"
+        "EmptyFuel,0\r\nBatteryFailure,0\r\nExtPwrPresent,1\r\n"
+        "ThermistorPresent[0],1\r\nThermistorPresent[1],1\r\n"
+        "BattTempCAvg[0],27\r\nBattTempCAvg[1],27\r\nVBattV,16.12\r\n"
+        "VExtV,22.63\r\nCharger_mAH,0\r\nMaxPWM,65536\r\nPWM,-1\r\n"),
+    'GetMotors': (
+        "GetMotors\r\nParameter,Value\r\n"
+        "Brush_MaxPWM,65536\r\nBrush_PWM,0\r\nBrush_mVolts,0\r\nBrush_Encoder,0\r\n"
+        "Brush_RPM,0\r\nVacuum_MaxPWM,65536\r\nVacuum_PWM,0\r\n"
+        "Vacuum_CurrentInMA,0\r\nVacuum_Encoder,0\r\nVacuum_RPM,0\r\n"
+        "LeftWheel_MaxPWM,65536\r\nLeftWheel_PWM,0\r\nLeftWheel_mVolts,0\r\n"
+        "LeftWheel_Encoder,0\r\nLeftWheel_PositionInMM,0\r\nLeftWheel_RPM,0\r\n"
+        "RightWheel_MaxPWM,65536\r\nRightWheel_PWM,0\r\nRightWheel_mVolts,0\r\n"
+        "RightWheel_Encoder,0\r\nRightWheel_PositionInMM,0\r\nRightWheel_RPM,0\r\n"
+        "Laser_MaxPWM,65536\r\nLaser_PWM,0\r\nLaser_mVolts,0\r\nLaser_Encoder,0\r\n"
+        "Laser_RPM,0\r\nCharger_MaxPWM,65536\r\nCharger_PWM,0\r\nCharger_mAH,0\r\n"),
+    'GetAnalogSensors': (
+        "GetAnalogSensors\r\nSensorName,Unit,Value\r\n"
+        "BatteryVoltage,mV,16120\r\nBatteryCurrent,mA,-142\r\n"
+        "BatteryTemperature,mC,27300\r\nExternalVoltage,mV,22630\r\n"
+        "AccelerometerX,mG,12\r\nAccelerometerY,mG,-4\r\nAccelerometerZ,mG,1004\r\n"
+        "VacuumCurrent,mA,0\r\nSideBrushCurrent,mA,0\r\nMagSensorLeft,VAL,0\r\n"
+        "MagSensorRight,VAL,0\r\nWallSensor,mm,60\r\nDropSensorLeft,mm,0\r\n"
+        "DropSensorRight,mm,0\r\n"),
+}
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print("%-18s %12s %12s" % ("command", "table us", "record us"))
+    for command, output in SAMPLES.items():
+        table = timeit.timeit(lambda: parseTable(output), number=iterations)
+        record = timeit.timeit(lambda: parseRecord(command, output), number=iterations)
+        print("%-18s %12.2f %12.2f" % (command, table / iterations * 1e6,
+                                        record / iterations * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Benchmarks of the command path and poll cycle against a fake serial port.
+
+Run from the neato-serial directory:
+
+    python benchmarks/run.py                   # measure, compare, exit 1 if over budget
+    python benchmarks/run.py --save-baseline   # also store the results as the new baseline
+
+Results are printed and written as JSON to --output, by default
+neato-serial-bench-results.json in the temp directory, so only
+--save-baseline writes to the working tree. Every metric in budgets.json
+"limits" must stay under its limit, and when a baseline exists it may not
+be more than "regression_percent" worse than the baseline's value.
+Baselines depend on the machine, so record them on the device you
+compare on.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+os.environ.setdefault('NEATO_SERIAL_CONFIG', os.path.join(HERE, 'bench_config.yaml'))
+
+from fakeserial import FakeSerial  # noqa: E402
+from neatoserial import NeatoSerial  # noqa: E402
+from neatoschema import parseRecord  # noqa: E402
+
+# seconds before Neato starts answering, transfer time at 115200 baud comes on top
+LATENCIES = {
+    'GetVersion': 0.010,
+    'GetCharger': 0.008,
+    'GetMotors': 0.008,
+    'GetErr': 0.004,
+    'GetAnalogSensors': 0.008,
+    'GetLDSScan': [0.020, 0.030, 0.025],
+}
+COMMANDS = ['GetVersion', 'GetCharger', 'GetMotors', 'GetErr', 'GetAnalogSensors']
+
+
+class BenchNeatoSerial(NeatoSerial):
+    """NeatoSerial talking to a FakeSerial."""
+
+    def openPort(self, dev):
+        self.fake = FakeSerial(LATENCIES)
+        return self.fake
+
+
+def percentiles(samples, scale, unit):
+    """Return p50/p95/p99/max of samples, multiplied by scale, keyed with unit."""
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * scale, 3)
+    return {'p50_' + unit: pick(0.5), 'p95_' + unit: pick(0.95),
+            'p99_' + unit: pick(0.99), 'max_' + unit: pick(1.0)}
+
+
+def timed(fn, iterations):
+    """Return the duration of each of iterations calls of fn."""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def allocPeak(fn, iterations):
+    """Return the highest traced memory peak of a single call of fn."""
+    tracemalloc.start()
+    peak = 0
+    try:
+        for _ in range(iterations):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def allocBlocks(fn, iterations):
+    """Return memory blocks and bytes allocated per call of fn that are still held afterwards.
+
+    A snapshot diff over iterations calls, divided by iterations. CPython has
+    no count of short-lived allocations, allocPeak() covers those.
+    """
+    fn()
+    tracemalloc.start()
+    try:
+        # the fake serial port stands in for Neato, its allocations don't count
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+                  tracemalloc.Filter(False, '*fakeserial.py'),
+                  tracemalloc.Filter(False, '*neatoemulator.py')]
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        for _ in range(iterations):
+            fn()
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    return (round(sum(stat.count_diff for stat in stats) / iterations, 2),
+            round(sum(stat.size_diff for stat in stats) / iterations, 1))
+
+
+def benchCommands(ns, iterations):
+    """Latency of raw_write per command, bypassing the response cache."""
+    results = {}
+    for command in COMMANDS:
+        before = ns.fake.bytesRead
+        samples = timed(lambda: ns.raw_write(command), iterations)
+        results[command] = percentiles(samples, 1000, 'ms')
+        results[command]['bytes_in'] = (ns.fake.bytesRead - before) // iterations
+    return results
+
+
+def benchCycle(ns, iterations):
+    """Time, bytes and allocations of getCombinedState once cache entries with a TTL expired."""
+    def cycle():
+        ns.cache.invalidate(keepPermanent=True)
+        ns.getCombinedState()
+    cycle()
+    before = ns.fake.bytesRead + ns.fake.bytesWritten
+    samples = timed(cycle, iterations)
+    result = percentiles(samples, 1000, 'ms')
+    result['bytes'] = (ns.fake.bytesRead + ns.fake.bytesWritten - before) // iterations
+    result['alloc_peak_bytes'] = allocPeak(cycle, min(iterations, 20))
+    result['alloc_blocks'], result['alloc_bytes'] = allocBlocks(cycle, iterations)
+    return result
+
+
+def benchLDSScan(ns, iterations):
+    """Latency and allocations of getLDSScan into a reused buffer."""
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return None
+    ns.raw_write("TestMode On")
+    ns.raw_write("SetLDSRotation On")
+    buffer = ns.getLDSScan().data
+    samples = timed(lambda: ns.getLDSScan(buffer), iterations)
+    result = percentiles(samples, 1000, 'ms')
+    result['alloc_peak_bytes'] = allocPeak(lambda: ns.getLDSScan(buffer), min(iterations, 20))
+    result['alloc_blocks'], result['alloc_bytes'] = allocBlocks(lambda: ns.getLDSScan(buffer),
+                                                                iterations)
+    ns.raw_write("SetLDSRotation Off")
+    ns.raw_write("TestMode Off")
+    return result
+
+
+def benchTelemetryQuery(iterations, records=1000000):
+    """Latency and allocations of a one hour range query on a full telemetry ring.
+
+    Only the pages of the range should be read, so the allocation peak has
+    to stay far below one copy of the time column (8 bytes per record).
+    """
+    try:
+        import numpy
+        from telemetry import TelemetryRing
+    except ImportError:
+        return None
+    with tempfile.TemporaryDirectory() as tmp:
+        ring = TelemetryRing(os.path.join(tmp, 'telemetry.bin'), records)
+        ring.records['time'] = time.time() - records * 7 + 7 * numpy.arange(records)
+        ring.appended[0] = records
+        middle = float(ring.records['time'][records // 2])
+
+        def query():
+            ring.query(middle, middle + 3600)
+        samples = timed(query, iterations)
+        result = percentiles(samples, 1000, 'ms')
+        result['alloc_peak_bytes'] = allocPeak(query, min(iterations, 20))
+        result['records'] = records
+        ring.close()
+    return result
+
+
+def benchParse(ns, iterations):
+    """Cost of decoding each command's output into its record."""
+    results = {}
+    for command in ['GetVersion', 'GetCharger', 'GetMotors', 'GetAnalogSensors']:
+        output = ns.raw_write(command)
+        samples = timed(lambda: parseRecord(command, output), iterations)
+        results[command] = percentiles(samples, 1e6, 'us')
+    return results
+
+
+def metric(results, path):
+    """Return the value at a dotted path, None if missing."""
+    value = results
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def check(results, budgets, baseline):
+    """Return a list of budget violations."""
+    failures = []
+    tolerance = 1 + budgets.get('regression_percent', 0) / 100
+    for path, limit in budgets.get('limits', {}).items():
+        value = metric(results, path)
+        if value is None:
+            continue
+        if value > limit:
+            failures.append("%s = %s over limit %s" % (path, value, limit))
+        previous = metric(baseline, path) if baseline else None
+        if previous and value > previous * tolerance:
+            failures.append("%s = %s more than %s%% over baseline %s" % (
+                path, value, budgets.get('regression_percent'), previous))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--budgets', default=os.path.join(HERE, 'budgets.json'))
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--output', default=os.path.join(tempfile.gettempdir(),
+                                                         'neato-serial-bench-results.json'))
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    ns = BenchNeatoSerial()
+    results = {
+        'commands': benchCommands(ns, args.iterations),
+        'cycle': benchCycle(ns, args.iterations),
+        'lds_scan': benchLDSScan(ns, max(1, args.iterations // 5)),
+        'parse': benchParse(ns, args.iterations * 20),
+        'telemetry_query': benchTelemetryQuery(args.iterations),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    with open(args.budgets) as f:
+        budgets = json.load(f)
+    failures = check(results, budgets, baseline)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline to " + args.baseline)
+    for failure in failures:
+        print("OVER BUDGET: " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""Change-only MQTT publishing."""
+import threading
+import time
+from metrics import registry
+
+MQTT_PUBLISHED = registry.counter('neato_mqtt_published_total', 'MQTT messages published.', ('topic',))
+MQTT_SUPPRESSED = registry.counter('neato_mqtt_suppressed_total',
+                                   'Unchanged MQTT messages that were not published again.',
+                                   ('topic',))
+
+
+class ChangePublisher:
+    """Publishes a payload only when it differs from the last one on its topic.
+
+    Unchanged payloads are repeated after heartbeatSeconds so subscribers
+    still see the bridge is alive; a heartbeat of 0 never repeats them.
+    """
+
+    def __init__(self, client, heartbeatSeconds):
+        self.client = client
+        self.heartbeatSeconds = heartbeatSeconds
+        self.lastPayloads = {}
+        self.published = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload, qos=0, retain=False, heartbeat=True):
+        """Publish payload if it changed or its heartbeat is due. Return true if sent."""
+        now = time.monotonic()
+        with self.lock:
+            last = self.lastPayloads.get(topic)
+            if last is not None and last[0] == payload:
+                heartbeatDue = (heartbeat and self.heartbeatSeconds > 0
+                                and now - last[1] >= self.heartbeatSeconds)
+                if not heartbeatDue:
+                    self.suppressed += 1
+                    MQTT_SUPPRESSED.inc((topic,))
+                    return False
+            self.lastPayloads[topic] = (payload, now)
+            self.published += 1
+        MQTT_PUBLISHED.inc((topic,))
+        self.client.publish(topic, payload, qos=qos, retain=retain)
+        return True
+
+    def remember(self, topic, payload):
+        """Record a payload that was published on topic by other means."""
+        with self.lock:
+            self.lastPayloads[topic] = (payload, time.monotonic())
+
+    def reset(self):
+        """Forget everything published, e.g. after reconnecting to the broker."""
+        with self.lock:
+            self.lastPayloads = {}
+
+    def getStats(self):
+        """Return how many payloads were sent and suppressed."""
+        return {'published': self.published, 'suppressed': self.suppressed}
@@ -0,0 +1,141 @@
+"""State machine for starting a clean and confirming Neato actually started.
+
+CleanStart decides the steps and NeatoSerial or AsyncNeatoSerial carry them
+out: the driver asks for the current action, performs it and hands the
+result back through advance() until the machine is done. Steps that are not
+needed are skipped (no Clean Stop when the motors are idle, no GetErr Clear
+without an error) and success is only reported once Vacuum_RPM rises.
+"""
+import time
+from metrics import registry
+
+CLEAN_STARTS = registry.counter('neato_clean_starts_total',
+                                'Clean starts by outcome.', ('result',))
+CLEAN_START_SECONDS = registry.histogram(
+    'neato_clean_start_seconds', 'Time from a clean request until the vacuum was seen running.',
+    buckets=(1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60))
+
+CHECK = 'check'
+STOP = 'stop'
+CLEAR = 'clear'
+START = 'start'
+TOGGLE = 'toggle'
+RECONNECT = 'reconnect'
+CONFIRM = 'confirm'
+WAIT = 'wait'
+CLEANING = 'cleaning'
+FAILED = 'failed'
+
+MOTORS = ('Brush_RPM', 'Vacuum_RPM', 'LeftWheel_RPM', 'RightWheel_RPM')
+# USB toggles before giving up when Neato does not come back after one
+TOGGLE_ATTEMPTS = 2
+
+
+class CleanStart:
+    """One attempt to start cleaning.
+
+    Actions are tuples: ('batch', [commands]) and ('write', command) expect
+    the outputs, ('toggle',) nothing, ('reconnect',) whether the port is
+    connected again and ('wait', seconds) nothing.
+    """
+
+    def __init__(self, neato, msg, confirmSeconds, pollSeconds, minRpm):
+        self.neato = neato
+        self.msg = msg
+        self.confirmSeconds = confirmSeconds
+        self.pollSeconds = pollSeconds
+        self.minRpm = minRpm
+        self.state = CHECK
+        self.started = time.monotonic()
+        self.deadline = None
+        self.error = None
+        self.out = ''
+        self.vacuumRpm = 0
+        self.skipped = []
+        self.toggles = 0
+        self.seconds = None
+
+    def done(self):
+        return self.state in (CLEANING, FAILED)
+
+    def confirmed(self):
+        return self.state == CLEANING
+
+    def action(self):
+        """Return what the driver should do next."""
+        if self.state == CHECK:
+            return ('batch', ['GetMotors', 'GetErr'])
+        if self.state == STOP:
+            return ('write', 'Clean Stop')
+        if self.state == CLEAR:
+            return ('write', 'GetErr Clear')
+        if self.state == START:
+            return ('write', self.msg)
+        if self.state == TOGGLE:
+            return ('toggle',)
+        if self.state == RECONNECT:
+            return ('reconnect',)
+        if self.state == CONFIRM:
+            return ('write', 'GetMotors')
+        if self.state == WAIT:
+            return ('wait', min(self.pollSeconds, max(0, self.deadline - time.monotonic())))
+        return None
+
+    def advance(self, result):
+        """Move on given the result of the current action."""
+        if self.state == CHECK:
+            motors = self.neato.parseRecord('GetMotors', result.get('GetMotors'))
+            self.error = self.neato.parseError(result.get('GetErr'))
+            if motors is not None and any(motors.get(motor, 0) for motor in MOTORS):
+                self.state = STOP
+            else:
+                self.skipped.append(STOP)
+                self.state = self.afterStop()
+        elif self.state == STOP:
+            self.state = self.afterStop()
+        elif self.state == CLEAR:
+            self.state = START
+        elif self.state == START:
+            self.out = result
+            self.state = TOGGLE
+        elif self.state == TOGGLE:
+            self.toggles += 1
+            self.state = RECONNECT
+        elif self.state == RECONNECT:
+            if result:
+                # the robot spins up while we reconnect, so the deadline starts here
+                self.deadline = time.monotonic() + self.confirmSeconds
+                self.state = CONFIRM
+            elif self.toggles < TOGGLE_ATTEMPTS:
+                # the relay may have been switched back on before Neato noticed
+                self.state = TOGGLE
+            else:
+                self.state = FAILED
+        elif self.state == CONFIRM:
+            self.vacuumRpm = self.neato.parseVacuumRPM(self.neato.parseRecord('GetMotors', result))
+            if self.vacuumRpm >= self.minRpm:
+                self.state = CLEANING
+            elif time.monotonic() >= self.deadline:
+                self.state = FAILED
+            else:
+                self.state = WAIT
+        elif self.state == WAIT:
+            self.state = CONFIRM
+        if self.done():
+            self.finish()
+
+    def afterStop(self):
+        if self.error is not None:
+            return CLEAR
+        self.skipped.append(CLEAR)
+        return START
+
+    def finish(self):
+        self.seconds = time.monotonic() - self.started
+        CLEAN_STARTS.inc((self.state,))
+        if self.state == CLEANING:
+            CLEAN_START_SECONDS.observe(self.seconds)
+
+    def getStats(self):
+        return {'state': self.state, 'seconds': self.seconds, 'vacuum_rpm': self.vacuumRpm,
+                'toggles': self.toggles, 'skipped': self.skipped, 'error': self.error}
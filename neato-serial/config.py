@@ -1,5 +1,7 @@
 """Reading config file."""
+import os
 import yaml
 
-with open("config.yaml", "r") as f:
+# NEATO_SERIAL_CONFIG points to another config file, e.g. for benchmarks
+with open(os.environ.get("NEATO_SERIAL_CONFIG", "config.yaml"), "r") as f:
     settings = yaml.safe_load(f)
@@ -0,0 +1,47 @@
+"""GPIO access for the USB relay, with a no-op backend for machines without GPIO."""
+from config import settings
+import neatolog
+
+
+class NoGpio:
+    """Stand-in for RPi.GPIO that only remembers and logs pin levels."""
+
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.log = neatolog.getLogger(__name__)
+        self.pins = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode):
+        self.pins.setdefault(pin, self.LOW)
+
+    def output(self, pin, value):
+        self.log.debug("GPIO %s -> %s", pin, "HIGH" if value else "LOW")
+        self.pins[pin] = value
+
+    def input(self, pin):
+        return self.pins.get(pin, self.LOW)
+
+    def cleanup(self):
+        self.pins = {}
+
+
+def loadGpio(backend):
+    """Return the GPIO module for the configured backend: rpi or none."""
+    if backend == 'none':
+        return NoGpio()
+    import RPi.GPIO
+    return RPi.GPIO
+
+
+GPIO = loadGpio((settings.get('serial') or {}).get('gpio_backend', 'rpi'))
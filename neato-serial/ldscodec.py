@@ -0,0 +1,97 @@
+"""Compact binary encoding of LDS scans for publishing over MQTT.
+
+A payload is a fixed header followed by the scan as little-endian uint16
+values, row by row (angle, distance, intensity, error). Delta frames hold
+the difference to the previous scan modulo 2**16, and the body may be
+zlib compressed. Header layout (little-endian):
+
+    4s  magic b'NLDS'
+    B   format version
+    B   flags (FLAG_ZLIB, FLAG_DELTA)
+    H   number of points
+    I   sequence number
+    f   rotation speed in Hz
+    d   unix timestamp of the scan
+"""
+import struct
+import time
+import zlib
+import numpy as np
+from ldsscan import LDSScan
+
+MAGIC = b'NLDS'
+VERSION = 1
+FLAG_ZLIB = 1
+FLAG_DELTA = 2
+HEADER = struct.Struct('<4sBBHIfd')
+
+
+class LDSScanEncoder:
+    """Turns successive LDSScans into binary payloads.
+
+    Every keyframeInterval-th payload is a full frame so new subscribers
+    can start decoding; the ones in between are deltas when enabled.
+    """
+
+    def __init__(self, compress=True, delta=True, keyframeInterval=10):
+        self.compress = compress
+        self.delta = delta
+        self.keyframeInterval = max(1, keyframeInterval)
+        self.previous = None
+        self.sequence = 0
+
+    def encode(self, scan, timestamp=None):
+        """Return the payload for a scan."""
+        current = scan.data.astype('<u2')
+        flags = 0
+        body = current
+        if (self.delta and self.previous is not None
+                and self.sequence % self.keyframeInterval):
+            body = current - self.previous
+            flags |= FLAG_DELTA
+        raw = body.tobytes()
+        if self.compress:
+            raw = zlib.compress(raw, 1)
+            flags |= FLAG_ZLIB
+        header = HEADER.pack(MAGIC, VERSION, flags, len(current), self.sequence,
+                             scan.rotationSpeed,
+                             time.time() if timestamp is None else timestamp)
+        self.previous = current
+        self.sequence += 1
+        return header + raw
+
+
+class LDSPayloadDecoder:
+    """Turns binary payloads from LDSScanEncoder back into LDSScans.
+
+    Keeps the previous frame to resolve deltas; until the first full frame
+    arrives, decode() returns None.
+    """
+
+    def __init__(self):
+        self.previous = None
+        self.previousSequence = None
+        self.sequence = None
+        self.timestamp = None
+
+    def decode(self, payload):
+        """Return the LDSScan in payload, None if it can't be resolved yet."""
+        magic, version, flags, points, sequence, rotationSpeed, timestamp = \
+            HEADER.unpack_from(payload)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not an LDS scan payload")
+        raw = payload[HEADER.size:]
+        if flags & FLAG_ZLIB:
+            raw = zlib.decompress(raw)
+        values = np.frombuffer(raw, dtype='<u2').reshape(points, 4)
+        if flags & FLAG_DELTA:
+            if self.previous is None or self.previousSequence != sequence - 1:
+                # missed the frame this delta is based on, wait for a keyframe
+                self.previous = None
+                return None
+            values = self.previous + values
+        self.previous = values
+        self.previousSequence = sequence
+        self.sequence = sequence
+        self.timestamp = timestamp
+        return LDSScan(values.astype(np.int32), rotationSpeed)
@@ -0,0 +1,315 @@
+"""Vectorized decoding and streaming of GetLDSScan output."""
+import threading
+import time
+import numpy as np
+
+SCAN_POINTS = 360
+# Columns of LDSScan.data
+ANGLE, DISTANCE, INTENSITY, ERROR = range(4)
+# AngleInDegrees, DistInMM and Intensity are decimal, ErrorCodeHEX is hex
+COLUMN_BASES = np.array([10, 10, 10, 16], dtype=np.int64)
+# pauses of LDSStream while Neato is disconnected or a scan failed, doubling up to the max
+RETRY_MIN_SECONDS = 0.5
+RETRY_MAX_SECONDS = 30
+
+
+class LDSScan:
+    """One lidar rotation: a (360, 4) int32 array plus the rotation speed in Hz.
+
+    Rows are indexed by angle; angles missing from the output are all zero.
+    """
+
+    __slots__ = ('data', 'rotationSpeed')
+
+    def __init__(self, data, rotationSpeed):
+        self.data = data
+        self.rotationSpeed = rotationSpeed
+
+    @property
+    def angles(self):
+        return self.data[:, ANGLE]
+
+    @property
+    def distances(self):
+        return self.data[:, DISTANCE]
+
+    @property
+    def intensities(self):
+        return self.data[:, INTENSITY]
+
+    @property
+    def errors(self):
+        return self.data[:, ERROR]
+
+
+class LDSScanDecoder:
+    """Decodes the AngleInDegrees,DistInMM,Intensity,ErrorCodeHEX table in one pass.
+
+    The table is parsed on its bytes with numpy instead of per line strings:
+    every digit is weighted by its place value and summed per field. The
+    per byte work arrays are kept between scans and only grow, so a scan
+    only allocates two arrays of one float per field. A decoder is not
+    thread safe.
+    """
+
+    def __init__(self):
+        # float64 like the weights np.bincount sums
+        self.digitValues = np.zeros(256, dtype=np.float64)
+        self.isDigit = np.zeros(256, dtype=bool)
+        for i, c in enumerate(b'0123456789'):
+            self.digitValues[c] = i
+            self.isDigit[c] = True
+        for i, c in enumerate(b'abcdef'):
+            self.digitValues[c] = self.digitValues[c - 32] = 10 + i
+            self.isDigit[c] = self.isDigit[c - 32] = True
+        # int64 so the field index can be summed up from it without a cast
+        self.isSeparator = np.zeros(256, dtype=np.int64)
+        self.isSeparator[[ord(','), ord('\n')]] = 1
+        self.columnBases = COLUMN_BASES.astype(np.float64)
+        self.capacity = 0
+        self.reserve(8192)
+
+    def reserve(self, size):
+        """Make the work arrays hold at least size bytes of table."""
+        if size <= self.capacity:
+            return
+        self.capacity = max(size, 2 * self.capacity)
+        self.codes = np.empty(self.capacity, dtype=np.intp)
+        self.isSep = np.empty(self.capacity, dtype=np.int64)
+        self.isDig = np.empty(self.capacity, dtype=bool)
+        self.inField = np.empty(self.capacity, dtype=bool)
+        self.field = np.empty(self.capacity, dtype=np.int64)
+        self.column = np.empty(self.capacity, dtype=np.int64)
+        self.place = np.empty(self.capacity, dtype=np.float64)
+        self.weighted = np.empty(self.capacity, dtype=np.float64)
+        self.values = np.empty(self.capacity, dtype=np.int64)
+
+    def newBuffer(self):
+        """Return an empty scan array to reuse with decode()."""
+        return np.zeros((SCAN_POINTS, 4), dtype=np.int32)
+
+    def decode(self, output, out=None):
+        """Decode GetLDSScan output into an LDSScan, None if there is no table.
+
+        When out is given the scan is written into it instead of a new array.
+        """
+        if not output:
+            return None
+        raw = output.encode('ascii', 'ignore') if isinstance(output, str) else output
+        header = raw.find(b'AngleInDegrees')
+        if header < 0:
+            return None
+        start = raw.find(b'\n', header) + 1
+        end = raw.find(b'ROTATION_SPEED', start)
+        if end < 0:
+            end = len(raw)
+        rotationSpeed = 0.0
+        footer = raw[end:].split(b'\n', 1)[0].split(b',')
+        if len(footer) > 1:
+            try:
+                rotationSpeed = float(footer[1])
+            except ValueError:
+                pass
+
+        if out is None:
+            out = self.newBuffer()
+        else:
+            out[:] = 0
+        values = self.decodeFields(memoryview(raw)[start:end])
+        if len(values) == 0 or len(values) % 4:
+            return LDSScan(out, rotationSpeed)
+        rows = values.reshape(-1, 4)
+        angles = rows[:, ANGLE]
+        if angles.min() < 0 or angles.max() >= SCAN_POINTS:
+            rows = rows[(angles >= 0) & (angles < SCAN_POINTS)]
+        out[rows[:, ANGLE]] = rows
+        return LDSScan(out, rotationSpeed)
+
+    def decodeFields(self, body):
+        """Return the numeric value of every comma or newline terminated field.
+
+        The result is a work array, valid until the next call.
+        """
+        raw = np.frombuffer(body, dtype=np.uint8)
+        size = len(raw)
+        self.reserve(size)
+        # Table lookups take intp indices and mode='clip', otherwise each one
+        # allocates a converted copy of the indices or a buffer for out.
+        buf = self.codes[:size]
+        np.copyto(buf, raw)
+        sep = np.take(self.isSeparator, buf, out=self.isSep[:size], mode='clip')
+        fieldCount = int(np.count_nonzero(sep))
+        if fieldCount == 0:
+            return self.values[:0]
+        # field index of every byte; a separator belongs to the field it ends
+        field = np.cumsum(sep, out=self.field[:size])
+        np.subtract(field, sep, out=field)
+        digits = np.take(self.isDigit, buf, out=self.isDig[:size], mode='clip')
+        np.logical_and(digits, np.less(field, fieldCount, out=self.inField[:size]), out=digits)
+        # Work per byte rather than per digit: other bytes weigh nothing, and
+        # nothing has to be compacted. Arrays are float64 throughout, mixed
+        # types would make each ufunc allocate a cast buffer.
+        weighted = self.weighted[:size]
+        np.copyto(weighted, digits)
+        # digits up to the end of each field, then the digits after each byte in its field
+        fieldDigits = np.bincount(field, weights=weighted, minlength=fieldCount + 1)
+        np.cumsum(fieldDigits, out=fieldDigits)
+        place = np.take(fieldDigits, field, out=self.place[:size], mode='clip')
+        np.subtract(place, np.cumsum(weighted, out=weighted), out=place)
+        column = np.remainder(field, 4, out=self.column[:size])
+        np.take(self.columnBases, column, out=weighted, mode='clip')
+        np.power(weighted, place, out=weighted, where=digits)
+        np.multiply(weighted, np.take(self.digitValues, buf, out=place, mode='clip'), out=weighted)
+        sums = np.bincount(field, weights=weighted, minlength=fieldCount + 1)
+        values = self.values[:fieldCount]
+        np.copyto(values, sums[:fieldCount], casting='unsafe')
+        return values
+
+
+class LDSStream:
+    """Pulls lidar scans back-to-back into a ring of preallocated scan arrays.
+
+    Starting the stream puts Neato in TestMode and spins up the LDS, closing
+    it stops the LDS and leaves TestMode. Scans handed to consumers are views
+    into the ring, so each one stays valid until slots - 1 newer scans arrive.
+    """
+
+    def __init__(self, ns, slots=8, scheduler=None):
+        """Prepare a stream on a NeatoSerial, optionally running through a NeatoScheduler."""
+        self.ns = ns
+        self.scheduler = scheduler
+        self.slots = slots
+        self.buffers = np.zeros((slots, SCAN_POINTS, 4), dtype=np.int32)
+        self.rotationSpeeds = np.zeros(slots)
+        self.sequence = 0
+        self.failed = 0
+        self.dropped = 0
+        self.startedAt = None
+        self.running = False
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def call(self, fn, *args):
+        """Run fn on the serial port, through the scheduler if there is one."""
+        if self.scheduler is not None:
+            from neatoscheduler import PRIORITY_POLL
+            return self.scheduler.submitCall(fn, *args, priority=PRIORITY_POLL).result()
+        return fn(*args)
+
+    def start(self):
+        """Enter TestMode, start LDS rotation and begin pulling scans."""
+        self.call(self.ns.write, "TestMode On")
+        self.call(self.ns.write, "SetLDSRotation On")
+        self.running = True
+        self.startedAt = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name="neato-lds-stream",
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        """Stop pulling scans, stop LDS rotation and leave TestMode."""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.call(self.ns.write, "SetLDSRotation Off")
+        self.call(self.ns.write, "TestMode Off")
+
+    def __enter__(self):
+        return self if self.running else self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self):
+        """Fill ring slots with scans until closed.
+
+        While Neato is disconnected the stream pauses, backing off, and leaves
+        reconnecting to the poll loop; each connect attempt here would count
+        towards the reboot after too many connection errors.
+        """
+        retrySeconds = RETRY_MIN_SECONDS
+        wasDisconnected = False
+        while self.running:
+            try:
+                if not self.ns.getIsConnected():
+                    wasDisconnected = True
+                    self.pause(retrySeconds)
+                    retrySeconds = min(retrySeconds * 2, RETRY_MAX_SECONDS)
+                    continue
+                if wasDisconnected:
+                    # a reconnected Neato may have been reset, so start the LDS again
+                    self.ns.log.info("Neato reconnected, restarting LDS rotation")
+                    self.call(self.ns.write, "TestMode On")
+                    self.call(self.ns.write, "SetLDSRotation On")
+                    wasDisconnected = False
+                slot = self.sequence % self.slots
+                scan = self.call(self.ns.getLDSScan, self.buffers[slot])
+            except Exception:
+                self.ns.log.exception("Reading LDS scan failed, retrying in %ss", retrySeconds)
+                self.failed += 1
+                self.pause(retrySeconds)
+                retrySeconds = min(retrySeconds * 2, RETRY_MAX_SECONDS)
+                continue
+            retrySeconds = RETRY_MIN_SECONDS
+            if scan is None or scan.rotationSpeed == 0:
+                # no table in the answer, e.g. LDS still spinning up
+                self.failed += 1
+                time.sleep(0.1)
+                continue
+            with self.condition:
+                self.rotationSpeeds[slot] = scan.rotationSpeed
+                self.sequence += 1
+                self.condition.notify_all()
+
+    def pause(self, seconds):
+        """Sleep for seconds or until the stream is closed."""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.running, seconds)
+
+    def scanAt(self, sequence):
+        """Return the scan with the given sequence number as a view into the ring."""
+        slot = sequence % self.slots
+        return LDSScan(self.buffers[slot], self.rotationSpeeds[slot])
+
+    def latest(self):
+        """Return the most recent scan, None before the first one arrives."""
+        if self.sequence == 0:
+            return None
+        return self.scanAt(self.sequence - 1)
+
+    def scans(self, timeout=None):
+        """Yield scans as they arrive until the stream closes or timeout passes.
+
+        Scans overwritten before the consumer got to them count as dropped.
+        """
+        seen = self.sequence
+        while True:
+            with self.condition:
+                arrived = self.condition.wait_for(
+                    lambda: self.sequence > seen or not self.running, timeout)
+                if not arrived or (not self.running and self.sequence <= seen):
+                    return
+                sequence = self.sequence
+            if sequence - seen > self.slots - 1:
+                self.dropped += sequence - seen - (self.slots - 1)
+                seen = sequence - (self.slots - 1)
+            while seen < sequence:
+                yield self.scanAt(seen)
+                seen += 1
+
+    def __iter__(self):
+        return self.scans()
+
+    def getStats(self):
+        """Return achieved scans per second and dropped or failed scans."""
+        elapsed = time.monotonic() - self.startedAt if self.startedAt else 0
+        return {
+            'scans': self.sequence,
+            'scans_per_second': self.sequence / elapsed if elapsed > 0 else 0.0,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
@@ -0,0 +1,220 @@
+"""Counters, histograms and gauges with Prometheus text and JSON export.
+
+Metrics are created once, usually at module level, through the shared
+registry and updated in place; updating one is a dict lookup and an add
+under a lock, cheap enough to leave on. Labeled metrics take a tuple of
+label values in the order of their label names.
+"""
+import bisect
+import json
+import os
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def formatLabels(labelNames, labels, extra=None):
+    """Return the {name="value",...} part of a sample line."""
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(labelNames, labels)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A value that only goes up, per label combination."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, None, value) for labels, value in self.values.items()]
+
+    def asDict(self):
+        with self.lock:
+            if not self.labelNames:
+                return self.values.get((), 0)
+            return {','.join(map(str, labels)): value for labels, value in self.values.items()}
+
+
+class Histogram:
+    """Counts of observations per upper bound, plus their sum and count."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.bounds = tuple(buckets) + (float('inf'),)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * len(self.bounds), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        result = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucketCount in zip(self.bounds, counts):
+                    cumulative += bucketCount
+                    result.append((self.name + '_bucket', labels, ('le', formatValue(bound)),
+                                   cumulative))
+                result.append((self.name + '_sum', labels, None, total))
+                result.append((self.name + '_count', labels, None, count))
+        return result
+
+    def summarize(self, counts, total, count):
+        cumulative = 0
+        buckets = {}
+        for bound, bucketCount in zip(self.bounds, counts):
+            cumulative += bucketCount
+            buckets[formatValue(bound)] = cumulative
+        return {'count': count, 'sum': round(total, 6), 'buckets': buckets}
+
+    def asDict(self):
+        with self.lock:
+            summaries = {labels: self.summarize(*entry) for labels, entry in self.values.items()}
+        if not self.labelNames:
+            return summaries.get(())
+        return {','.join(map(str, labels)): summary for labels, summary in summaries.items()}
+
+
+class Gauge:
+    """A value read from a callback when exported.
+
+    The callback returns a number, or a dict of label value tuples to numbers
+    for labeled gauges, or None when there is nothing to report.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, fn, labelNames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelNames = labelNames
+
+    def read(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return {}
+        if value is None:
+            return {}
+        return value if isinstance(value, dict) else {(): value}
+
+    def samples(self):
+        return [(self.name, labels, None, value) for labels, value in self.read().items()]
+
+    def asDict(self):
+        values = self.read()
+        if not self.labelNames:
+            return values.get(())
+        return {','.join(map(str, labels)): value for labels, value in values.items()}
+
+
+class MetricsRegistry:
+    """Named metrics of the process."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Add metric, or return the already registered one of that name."""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelNames=()):
+        return self.register(Counter(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelNames, buckets))
+
+    def gauge(self, name, help, fn, labelNames=()):
+        """Register a gauge, replacing an earlier callback of the same name."""
+        gauge = Gauge(name, help, fn, labelNames)
+        with self.lock:
+            self.metrics[name] = gauge
+        return gauge
+
+    def toPrometheus(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, extra, value in metric.samples():
+                lines.append(name + formatLabels(metric.labelNames, labels, extra)
+                             + ' ' + formatValue(value))
+        return '\n'.join(lines) + '\n'
+
+    def asDict(self):
+        """Return all metrics as a JSON serializable dict."""
+        return {metric.name: metric.asDict() for metric in list(self.metrics.values())}
+
+    def toJson(self):
+        return json.dumps(self.asDict())
+
+    def writeTextfile(self, path):
+        """Atomically write the metrics for node_exporter's textfile collector."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.toPrometheus())
+        os.replace(tmp, path)
+
+    def serveHttp(self, port, host=''):
+        """Serve the metrics at http://host:port/metrics from a daemon thread."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.toPrometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="neato-metrics-http",
+                         daemon=True).start()
+        return server
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,121 @@
+"""MQTT topics and payloads for a Neato's state, shared by the bridge and the supervisor.
+
+topics is a dict with the robot's command_topic and state_topic and, when
+MQTT autodiscovery is used, the discovery_topic prefix.
+"""
+import json
+import neatolog
+
+log = neatolog.getLogger(__name__)
+
+
+def availabilityTopic(serialNumber):
+    return f'neato_serial_{serialNumber}/state'
+
+
+def attributesTopic(serialNumber):
+    return f'vacuum/neato_serial_{serialNumber}/attributes'
+
+
+def discoveryConfig(state, topics, name=None):
+    """Return Home Assistant's discovery config for the vacuum, "state" schema.
+
+    With an availability_topic in topics, e.g. the supervisor's, the vacuum is
+    only available while both it and the robot's own topic say online.
+    """
+    config = {
+        'availability': [{'topic': availabilityTopic(state.serial_number)}],
+        'command_topic': topics['command_topic'],
+        'device': {
+            'identifiers': [f'Neato_serial_{state.serial_number}'],
+            'name': f'neato_serial_{name}' if name else 'neato_serial_vacuum',
+            'manufacturer': 'Neato Robotics',
+            'model': 'XV Series',
+            'sw_version': state.software_version
+        },
+        'name': name or 'neato_serial',
+        'unique_id': f'neato_serial_{state.serial_number}',
+        'payload_clean_spot': 'Clean Spot',
+        'payload_locate': 'PlaySound 19',
+        'payload_start': 'Clean',
+        'payload_stop': 'Clean Stop',
+        'schema': 'state',
+        'state_topic': topics['state_topic'],
+        'json_attributes_topic': attributesTopic(state.serial_number),
+        'supported_features': ['start', 'stop', 'battery', 'status', 'locate', 'clean_spot']
+    }
+    if 'availability_topic' in topics:
+        config['availability'].append({'topic': topics['availability_topic']})
+        config['availability_mode'] = 'all'
+    return config
+
+
+def statePayloads(state, isUsbEnabled):
+    """Return the state and attributes payloads of the "state" schema."""
+    state_data = {}
+    attributes_data = {}
+    state_data["battery_level"] = state.battery_level
+    if not isUsbEnabled:
+        state_data["battery_icon"] = "mdi:battery-unknown"
+
+    state_data["fan_speed"] = state.fan_speed
+    attributes_data["charging"] = state.is_charging
+    attributes_data["USB Enabled"] = isUsbEnabled
+    if state.is_docked:
+        state_data["state"] = "docked"
+    elif state.is_cleaning:
+        state_data["state"] = "cleaning"
+    elif state.error:
+        log.debug("Error from Neato: %s", state.error[1])
+        attributes_data["error"] = state.error[1]
+        state_data["state"] = "error"
+    else:
+        state_data["state"] = "idle"
+    return state_data, attributes_data
+
+
+def legacyPayload(state):
+    """Return the state payload of the "legacy" schema."""
+    legacy_data = {}
+    legacy_data["battery_level"] = state.battery_level
+    legacy_data["docked"] = state.is_docked
+    legacy_data["cleaning"] = state.is_cleaning
+    legacy_data["charging"] = state.is_charging
+    legacy_data["fan_speed"] = state.fan_speed
+    error = state.error
+    if error:
+        log.debug("Error from Neato: %s", error)
+        legacy_data["error"] = error[1]
+    return legacy_data
+
+
+def statusPayload(state, status):
+    """Return a state payload announcing status, e.g. "cleaning" right after a command."""
+    on_message_data = {}
+    on_message_data["battery_level"] = state.battery_level
+    on_message_data["fan_speed"] = state.fan_speed
+    on_message_data["state"] = status
+    return on_message_data
+
+
+def publishState(publisher, state, topics, isUsbEnabled, name=None):
+    """Publish availability and state through a ChangePublisher, only what changed."""
+    publisher.publish(availabilityTopic(state.serial_number), 'online', qos=0, retain=True,
+                      heartbeat=False)
+    if 'discovery_topic' in topics:
+        json_config_data = json.dumps(discoveryConfig(state, topics, name))
+        state_data, attributes_data = statePayloads(state, isUsbEnabled)
+        json_state_data = json.dumps(state_data)
+        json_attributes_data = json.dumps(attributes_data)
+        #Config is retained and only re-sent when serial number or software version change
+        if publisher.publish(topics['discovery_topic'] + f'/vacuum/neato_serial_{state.serial_number}/config',
+                             json_config_data, retain=True, heartbeat=False):
+            log.debug("Sent MQTT Config Message: %s", json_config_data)
+        if publisher.publish(topics['state_topic'], json_state_data):
+            log.debug("Sent vacuum state message: %s", json_state_data)
+        if publisher.publish(attributesTopic(state.serial_number), json_attributes_data):
+            log.debug("Sent vacuum attributes message: %s", json_attributes_data)
+    else:
+        json_legacy_data = json.dumps(legacyPayload(state))
+        if publisher.publish(topics['state_topic'], json_legacy_data):
+            log.debug("Sent vacuum state message: %s", json_legacy_data)
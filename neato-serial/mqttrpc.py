@@ -0,0 +1,176 @@
+"""Request/response commands over MQTT.
+
+A client publishes a JSON request to the request topic:
+
+    {"id": "42", "command": "GetCharger", "timeout": 5, "reply_to": "my/replies"}
+
+and gets the response on reply_to, or the configured response topic:
+
+    {"id": "42", "command": "GetCharger", "ok": true, "error": null,
+     "output": "<raw output>", "parsed": {...},
+     "timing": {"queued_ms": 0.4, "run_ms": 41.2, "total_ms": 41.6}}
+
+Commands run on the NeatoScheduler's I/O thread, never on paho's network
+thread. At most max_pending requests are queued or running at once; more
+are answered with an error right away. A request not answered within its
+timeout gets a timeout error, and is dropped if it has not started yet.
+Queries share the exchange of an identical command already queued or
+running; their timing then only has total_ms and coalesced.
+"""
+import json
+import threading
+import time
+import neatolog
+from neatoschema import SCHEMAS, parseTable
+from neatoscheduler import PRIORITY_USER
+from metrics import registry
+
+RPC_REQUESTS = registry.counter('neato_rpc_requests_total', 'MQTT RPC requests by outcome.',
+                                ('result',))
+RPC_SECONDS = registry.histogram('neato_rpc_seconds',
+                                 'Time from receiving an MQTT RPC request to its response.')
+# lower bound for the timeout given in a request
+MIN_TIMEOUT_SECONDS = 0.1
+
+
+class CommandRpc:
+    """Runs commands received on the request topic and publishes their responses."""
+
+    def __init__(self, config, scheduler, outbox):
+        self.log = neatolog.getLogger(__name__)
+        self.requestTopic = config.get('request_topic', 'vacuum/rpc/request')
+        self.responseTopic = config.get('response_topic', 'vacuum/rpc/response')
+        self.maxPending = int(config.get('max_pending', 4))
+        self.timeoutSeconds = float(config.get('timeout_seconds', 10))
+        self.maxTimeoutSeconds = float(config.get('max_timeout_seconds', 60))
+        self.scheduler = scheduler
+        self.outbox = outbox
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def handle(self, payload):
+        """Parse a request (bytes) and queue its command. Safe to call from paho's network thread."""
+        received = time.monotonic()
+        requestId = None
+        try:
+            request = json.loads(payload.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError("not a JSON object")
+            requestId = request.get('id')
+            command = str(request['command']).strip()
+            replyTo = request.get('reply_to') or self.responseTopic
+            timeout = max(MIN_TIMEOUT_SECONDS, min(float(request.get('timeout', self.timeoutSeconds)),
+                                                   self.maxTimeoutSeconds))
+            if not command:
+                raise ValueError("empty command")
+        except (ValueError, TypeError, KeyError) as ex:
+            self.log.warning("Invalid RPC request %.100s: %s", payload, ex)
+            RPC_REQUESTS.inc(('invalid',))
+            self.reply(self.responseTopic, {'id': requestId, 'ok': False,
+                                            'error': "invalid request: %s" % ex})
+            return
+        with self.lock:
+            if self.pending >= self.maxPending:
+                busy = True
+            else:
+                busy = False
+                self.pending += 1
+        if busy:
+            RPC_REQUESTS.inc(('busy',))
+            self.reply(replyTo, {'id': requestId, 'command': command, 'ok': False,
+                                 'error': "busy, %d requests pending" % self.maxPending})
+            return
+        self.log.info("RPC request %s: %s", requestId, command)
+        call = RpcCall(self, requestId, command, replyTo, received)
+        # identical queries already queued or running answer this one too
+        key = command if self.scheduler.ns.isQuery(command) else None
+        call.future = self.scheduler.submitCall(call.run, priority=PRIORITY_USER, key=key)
+        call.timer = threading.Timer(timeout, call.expire)
+        call.timer.daemon = True
+        call.timer.start()
+        call.future.add_done_callback(call.done)
+
+    def reply(self, topic, response):
+        # every response matters, so they are never coalesced
+        self.outbox.publish(topic, json.dumps(response), qos=1, coalesce=False)
+
+    def release(self):
+        """Free the slot of a request whose command finished or was dropped."""
+        with self.lock:
+            self.pending -= 1
+
+
+class RpcCall:
+    """One request on its way through the scheduler; answered exactly once."""
+
+    def __init__(self, rpc, requestId, command, replyTo, received):
+        self.rpc = rpc
+        self.requestId = requestId
+        self.command = command
+        self.replyTo = replyTo
+        self.received = received
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.timer = None
+        self.answered = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        """Send the command, on the I/O thread."""
+        self.started = time.monotonic()
+        try:
+            return self.rpc.scheduler.ns.write(self.command)
+        finally:
+            self.finished = time.monotonic()
+
+    def done(self, future):
+        # the serial port is busy until the command returns, even after its deadline
+        self.rpc.release()
+        if future.cancelled():
+            return
+        self.timer.cancel()
+        if future.exception() is not None:
+            self.answer('error', False, error=str(future.exception()))
+            return
+        output = future.result()
+        if output is None:
+            self.answer('error', False, error="no response from Neato")
+        else:
+            self.answer('ok', True, output=output, parsed=self.parse(output))
+
+    def expire(self):
+        # the scheduler drops the command if it has not started and nobody else waits for it
+        self.future.cancel()
+        self.answer('timeout', False, error="deadline exceeded")
+
+    def parse(self, output):
+        """Return the output as a dict, typed when the command has a schema."""
+        schema = SCHEMAS.get(self.command.split(' ')[0])
+        if schema is not None and len(self.command.split(' ')) == 1:
+            record = schema.parse(output)
+            parsed = record.asDict()
+            parsed.update(record.extra)
+            return parsed
+        return parseTable(output) or None
+
+    def answer(self, result, ok, output=None, parsed=None, error=None):
+        with self.lock:
+            if self.answered:
+                return
+            self.answered = True
+        now = time.monotonic()
+        timing = {'total_ms': round((now - self.received) * 1000, 1)}
+        if self.started is None and output is not None:
+            # answered by an identical request's exchange
+            timing['coalesced'] = True
+        elif self.started is not None:
+            timing['queued_ms'] = round((self.started - self.received) * 1000, 1)
+            if self.finished is not None:
+                timing['run_ms'] = round((self.finished - self.started) * 1000, 1)
+        RPC_REQUESTS.inc((result,))
+        RPC_SECONDS.observe(now - self.received)
+        self.rpc.log.info("RPC response %s: %s", self.requestId, result)
+        self.rpc.reply(self.replyTo, {'id': self.requestId, 'command': self.command, 'ok': ok,
+                                      'error': error, 'output': output, 'parsed': parsed,
+                                      'timing': timing})
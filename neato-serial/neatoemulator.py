@@ -0,0 +1,308 @@
+"""Pseudo-terminal stand-in for a Neato XV, for running the bridge without a robot.
+
+Point serial_device at the emulator's link (default /tmp/neato-emulator) and
+set gpio_backend to none. The emulator answers the commands neatoserial.py
+uses the way the firmware does: the command is echoed, followed by the
+output lines and a Ctrl-Z end-of-response marker.
+"""
+import math
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+TERMINATOR = '\x1a'
+
+ERRORS = {
+    220: "Unplug USB cable before cleaning",
+    243: "Please clear my path",
+    247: "Please empty dustbin",
+}
+
+
+class NeatoEmulator:
+    """Simulated XV firmware behind a pty.
+
+    latency and jitter (seconds) delay every response, baud paces how fast
+    responses are written (0 writes at once), sleepSeconds is the idle time
+    after which the first command only wakes the robot and is not answered
+    (0 never sleeps), and errorRate is the chance that a Clean is refused
+    with errorCode.
+    """
+
+    def __init__(self, link='/tmp/neato-emulator', latency=0.05, jitter=0.02,
+                 baud=115200, sleepSeconds=0, errorCode=220, errorRate=0.0, seed=None):
+        self.link = link
+        self.latency = latency
+        self.jitter = jitter
+        self.baud = baud
+        self.sleepSeconds = sleepSeconds
+        self.errorCode = errorCode
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+        self.serialNumber = 'EMU00000EM0000000'
+        self.fuelPercent = 80.0
+        self.docked = True
+        self.cleaning = False
+        self.testMode = False
+        self.ldsRotating = False
+        self.error = None
+        self.lastCommand = time.monotonic()
+        self.lastUpdate = time.monotonic()
+        self.commands = 0
+        self.unanswered = 0
+        self.master = None
+        self.slave = None
+        self.running = False
+        self.thread = None
+
+    def open(self):
+        """Create the pty and link it, return the device path to connect to."""
+        self.master, self.slave = os.openpty()
+        # no echo or newline translation: the emulator produces the firmware's bytes
+        tty.setraw(self.slave)
+        path = os.ttyname(self.slave)
+        if self.link:
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(path, self.link)
+            path = self.link
+        return path
+
+    def close(self):
+        """Stop serving and remove the pty and its link."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def start(self):
+        """Open the pty and serve it on a background thread."""
+        path = self.open()
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name="neato-emulator", daemon=True)
+        self.thread.start()
+        return path
+
+    def serve(self):
+        """Answer commands until closed."""
+        self.running = True
+        pending = b''
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                pending += os.read(self.master, 4096)
+            except OSError:
+                continue
+            while b'\n' in pending:
+                line, pending = pending.split(b'\n', 1)
+                command = line.decode('ascii', 'ignore').strip('\r ')
+                if command:
+                    self.respond(command)
+
+    def respond(self, command):
+        """Answer one command on the pty, unless it only wakes the robot up."""
+        now = time.monotonic()
+        asleep = self.sleepSeconds > 0 and now - self.lastCommand > self.sleepSeconds
+        self.lastCommand = now
+        self.commands += 1
+        if asleep:
+            self.unanswered += 1
+            return
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        self.write((command + '\r\n' + self.handle(command) + TERMINATOR).encode('ascii'))
+
+    def write(self, data):
+        """Write data at the configured baud rate."""
+        if not self.baud:
+            os.write(self.master, data)
+            return
+        # 10 bits per byte on the wire (start, 8 data, stop)
+        chunk = max(1, self.baud // 100)
+        for offset in range(0, len(data), chunk):
+            part = data[offset:offset + chunk]
+            os.write(self.master, part)
+            time.sleep(len(part) * 10 / self.baud)
+
+    def handle(self, command):
+        """Return the output lines for a command."""
+        self.update()
+        words = command.split()
+        name = words[0].lower()
+        args = [w.lower() for w in words[1:]]
+        handler = getattr(self, 'cmd' + name.capitalize(), None)
+        if handler is None:
+            return "Unknown Cmd: '" + command + "'\r\n"
+        return handler(args)
+
+    def update(self):
+        """Advance battery level for the time since the last command."""
+        now = time.monotonic()
+        minutes = (now - self.lastUpdate) / 60
+        self.lastUpdate = now
+        if self.cleaning:
+            self.fuelPercent = max(0.0, self.fuelPercent - minutes)
+            if self.fuelPercent == 0:
+                self.cleaning = False
+        elif self.docked:
+            self.fuelPercent = min(100.0, self.fuelPercent + 2 * minutes)
+
+    def table(self, header, rows):
+        return header + '\r\n' + ''.join(label + ',' + str(value) + '\r\n'
+                                         for label, value in rows)
+
+    def cmdGetversion(self, args):
+        return self.table('Component,Major,Minor,Build', [
+            ('Product Model', 'XV21,'),
+            ('Serial Number', self.serialNumber + ',0000,D'),
+            ('Software', '3,6,29041'),
+            ('MainBoard Software', '6,1,13328'),
+            ('MainBoard Version', '1,0,'),
+            ('LDS Software', 'V2.6.15295,0000000000,'),
+            ('LDS Serial', 'KSH00000EM-0000000,'),
+            ('LDS CPU', 'F2802x/c001,'),
+            ('BootLoader Software', '17225,1,'),
+            ('Chassis Version', '-1,'),
+            ('UI Board Software', '0,0'),
+        ])
+
+    def cmdGetcharger(self, args):
+        charging = self.docked and self.fuelPercent < 100
+        return self.table('Label,Value', [
+            ('FuelPercent', int(self.fuelPercent)),
+            ('BatteryOverTemp', 0),
+            ('ChargingActive', int(charging)),
+            ('ChargingEnabled', int(self.docked)),
+            ('ConfidentOnFuel', 1),
+            ('OnReservedFuel', int(self.fuelPercent < 10)),
+            ('EmptyFuel', int(self.fuelPercent == 0)),
+            ('BatteryFailure', 0),
+            ('ExtPwrPresent', int(self.docked)),
+            ('ThermistorPresent[0]', 1),
+            ('ThermistorPresent[1]', 1),
+            ('BattTempCAvg[0]', 31 if charging else 27),
+            ('BattTempCAvg[1]', 31 if charging else 27),
+            ('VBattV', '%.2f' % (14.4 + 2.2 * self.fuelPercent / 100)),
+            ('VExtV', '22.63' if self.docked else '0.00'),
+            ('Charger_mAH', 1200 if charging else 0),
+            ('MaxPWM', 65536),
+            ('PWM', 23000 if charging else -1),
+        ])
+
+    def cmdGetmotors(self, args):
+        rows = []
+        speeds = {'Brush': 1100, 'Vacuum': 1200, 'LeftWheel': 90, 'RightWheel': 90,
+                  'Laser': 300 if self.ldsRotating else 0}
+        for motor, rpm in speeds.items():
+            running = self.cleaning or (motor == 'Laser' and self.ldsRotating)
+            rows += [(motor + '_MaxPWM', 65536), (motor + '_PWM', 20000 if running else 0),
+                     (motor + '_Encoder', 0), (motor + '_RPM', rpm if running else 0)]
+        rows += [('Charger_MaxPWM', 65536), ('Charger_PWM', 0), ('Charger_mAH', 0)]
+        return self.table('Parameter,Value', rows)
+
+    def cmdGetanalogsensors(self, args):
+        current = -1500 if self.cleaning else (1200 if self.docked else -150)
+        return self.table('SensorName,Unit,Value', [
+            ('BatteryVoltage', 'mV,%d' % (14400 + 22 * self.fuelPercent)),
+            ('BatteryCurrent', 'mA,%d' % current),
+            ('BatteryTemperature', 'mC,27300'),
+            ('ExternalVoltage', 'mV,%d' % (22630 if self.docked else 0)),
+            ('AccelerometerX', 'mG,12'),
+            ('AccelerometerY', 'mG,-4'),
+            ('AccelerometerZ', 'mG,1004'),
+            ('VacuumCurrent', 'mA,%d' % (900 if self.cleaning else 0)),
+            ('SideBrushCurrent', 'mA,0'),
+            ('MagSensorLeft', 'VAL,0'),
+            ('MagSensorRight', 'VAL,0'),
+            ('WallSensor', 'mm,60'),
+            ('DropSensorLeft', 'mm,0'),
+            ('DropSensorRight', 'mm,0'),
+        ])
+
+    def cmdGeterr(self, args):
+        if args and args[0] == 'clear':
+            self.error = None
+            return ''
+        if self.error is None:
+            return ''
+        return str(self.error) + ' - ' + ERRORS.get(self.error, 'Error') + '\r\n'
+
+    def cmdGetldsscan(self, args):
+        rows = []
+        for angle in range(360):
+            if not self.ldsRotating:
+                rows.append('%d,0,0,8035' % angle)
+                continue
+            # distance to the walls of a 4 x 3 m room, seen from its middle
+            rad = math.radians(angle)
+            distance = min(2000 / max(abs(math.cos(rad)), 1e-6),
+                           1500 / max(abs(math.sin(rad)), 1e-6))
+            distance += self.random.gauss(0, 5)
+            rows.append('%d,%d,%d,0' % (angle, distance, self.random.randint(80, 200)))
+        speed = 5.0 + self.random.uniform(-0.05, 0.05) if self.ldsRotating else 0.0
+        return ('AngleInDegrees,DistInMM,Intensity,ErrorCodeHEX\r\n'
+                + '\r\n'.join(rows) + '\r\nROTATION_SPEED,%.2f\r\n' % speed)
+
+    def cmdTestmode(self, args):
+        self.testMode = bool(args) and args[0] == 'on'
+        if not self.testMode:
+            self.ldsRotating = False
+        return ''
+
+    def cmdSetldsrotation(self, args):
+        if not self.testMode:
+            return 'TestMode must be on to use this command.\r\n'
+        self.ldsRotating = bool(args) and args[0] == 'on'
+        return ''
+
+    def cmdClean(self, args):
+        if args and args[0] == 'stop':
+            self.cleaning = False
+            return ''
+        if self.errorRate and self.random.random() < self.errorRate:
+            self.error = self.errorCode
+            return ''
+        if self.error is None and self.fuelPercent > 0:
+            self.cleaning = True
+            self.docked = False
+        return ''
+
+    def cmdPlaysound(self, args):
+        return ''
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Emulate a Neato XV on a pseudo-terminal.")
+    parser.add_argument('--link', default='/tmp/neato-emulator',
+                        help="symlink to the pty, use it as serial_device")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds before each response")
+    parser.add_argument('--jitter', type=float, default=0.02, help="random +/- seconds on latency")
+    parser.add_argument('--baud', type=int, default=115200, help="pace output like the real link, 0 for no pacing")
+    parser.add_argument('--sleep', type=float, default=0,
+                        help="idle seconds after which the first command is swallowed, 0 never sleeps")
+    parser.add_argument('--error-code', type=int, default=220, help="error raised when a Clean is refused")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="chance that a Clean is refused")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    emulator = NeatoEmulator(args.link, args.latency, args.jitter, args.baud, args.sleep,
+                             args.error_code, args.error_rate, args.seed)
+    print("Neato emulator listening on " + emulator.open())
+    try:
+        emulator.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
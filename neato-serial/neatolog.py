@@ -0,0 +1,140 @@
+"""Queue-backed logging shared by the serial interfaces and the MQTT bridge.
+
+Loggers only put records on a bounded queue; a background listener formats
+them and writes them to the console and a size-rotated file. Records are
+formatted by the listener, so log calls should pass arguments lazily
+(log.info("msg = %s", msg)). When the queue is full records are dropped
+rather than blocking the caller.
+"""
+from config import settings
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING,
+          'error': logging.ERROR}
+
+
+class RateLimitFilter(logging.Filter):
+    """Drops a message repeated more than burst times within intervalSeconds.
+
+    The first message let through after a suppression says how many were
+    dropped. Messages are the same when logger, level, format string and
+    arguments are.
+    """
+
+    def __init__(self, intervalSeconds, burst):
+        super(RateLimitFilter, self).__init__()
+        self.intervalSeconds = intervalSeconds
+        self.burst = burst
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        args = record.args
+        try:
+            hash(args)
+        except TypeError:
+            args = None
+        key = (record.name, record.levelno, record.msg, args)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.intervalSeconds:
+                suppressed = window[2] if window is not None else 0
+                if len(self.windows) > 1000:
+                    self.windows = {}
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = str(record.msg) + " (%d similar messages suppressed)" % suppressed
+                return True
+            window[1] += 1
+            if window[1] <= self.burst:
+                return True
+            window[2] += 1
+            return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, dropping them when the queue is full."""
+
+    def __init__(self, recordQueue):
+        super(NonBlockingQueueHandler, self).__init__(recordQueue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+handler = None
+listener = None
+level = logging.DEBUG
+
+
+def configure():
+    """Start the pipeline from the logging config section, once."""
+    global handler, listener, level
+    if handler is not None:
+        return handler
+    config = settings.get('logging') or {}
+    if 'level' in config:
+        level = LEVELS.get(str(config['level']).lower(), logging.DEBUG)
+    elif (settings.get('serial') or {}).get('log_level_warning'):
+        level = logging.WARN
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    outputs = []
+    if config.get('console', True):
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(formatter)
+        outputs.append(console)
+    path = config.get('file', 'neato-debug.log')
+    if path:
+        rotating = logging.handlers.RotatingFileHandler(
+            path, maxBytes=int(config.get('max_bytes', 1048576)),
+            backupCount=int(config.get('backup_count', 3)))
+        rotating.setFormatter(formatter)
+        outputs.append(rotating)
+    recordQueue = queue.Queue(int(config.get('queue_size', 10000)))
+    handler = NonBlockingQueueHandler(recordQueue)
+    if float(config.get('rate_limit_seconds', 60)) > 0:
+        handler.addFilter(RateLimitFilter(float(config.get('rate_limit_seconds', 60)),
+                                          int(config.get('rate_limit_burst', 5))))
+    listener = logging.handlers.QueueListener(recordQueue, *outputs)
+    listener.start()
+    # write out what is still queued on exit
+    atexit.register(listener.stop)
+    return handler
+
+
+def getLevel():
+    """Return the configured log level."""
+    configure()
+    return level
+
+
+def getLogger(name):
+    """Return a logger writing through the shared pipeline."""
+    configure()
+    logger = logging.getLogger(name)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+def getStats():
+    """Return records waiting to be written and dropped because the queue was full."""
+    configure()
+    return {'queued': handler.queue.qsize(), 'dropped': handler.dropped}
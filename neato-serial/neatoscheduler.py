@@ -0,0 +1,156 @@
+"""Single-owner command scheduler for the Neato serial port."""
+from concurrent.futures import Future, InvalidStateError
+import itertools
+import neatolog
+import queue
+import sys
+import threading
+import time
+from neatoserial import COALESCED_REQUESTS
+
+# Lower values run first.
+PRIORITY_USER = 0
+PRIORITY_POLL = 10
+
+
+class NeatoScheduler:
+    """Runs all work on a NeatoSerial from one I/O thread, most urgent first.
+
+    Callers get a concurrent.futures.Future back instead of touching the
+    serial port from their own thread. Identical queries asked while one is
+    queued or running share its exchange.
+    """
+
+    def __init__(self, ns):
+        """Start the I/O thread that owns the given NeatoSerial."""
+        self.ns = ns
+        self.log = neatolog.getLogger(__name__)
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.completed = 0
+        self.coalesced = 0
+        # key to the Future of the shared run and the Futures of its callers
+        self.shared = {}
+        self.lock = threading.Lock()
+        self.totalWaitSeconds = 0.0
+        self.maxWaitSeconds = 0.0
+        self.lastWaitSeconds = 0.0
+        self.thread = threading.Thread(target=self.run, name="neato-serial-io",
+                                       daemon=True)
+        self.thread.start()
+
+    def submit(self, msg, priority=PRIORITY_POLL):
+        """Queue a message for NeatoSerial.write and return a Future of its output.
+
+        Queries share the exchange of an identical one that is queued or running.
+        """
+        key = msg if self.ns.isQuery(msg) else None
+        return self.submitCall(self.ns.write, msg, priority=priority, key=key)
+
+    def submitCall(self, fn, *args, priority=PRIORITY_POLL, key=None):
+        """Queue fn(*args) to run on the I/O thread and return a Future of its result.
+
+        Calls with the same key share one run while it is queued or running.
+        Only pass a key for calls without side effects. Each caller gets its
+        own Future, which is running while the shared run is, so like any
+        running Future it can no longer be cancelled. The run is dropped if
+        all callers are cancelled before it starts. A shared run keeps the
+        priority it was queued with.
+        """
+        if key is None:
+            future = Future()
+            self.queue.put((priority, next(self.counter), time.monotonic(), future, fn, args))
+            return future
+        caller = Future()
+        with self.lock:
+            shared = self.shared.get(key)
+            isNew = shared is None
+            if isNew:
+                shared = self.shared[key] = (Future(), set())
+            else:
+                self.coalesced += 1
+                if shared[0].running():
+                    caller.set_running_or_notify_cancel()
+            shared[1].add(caller)
+        if isNew:
+            shared[0].add_done_callback(lambda f: self.finishShared(key, shared))
+            self.queue.put((priority, next(self.counter), time.monotonic(), shared[0],
+                            self.runShared, (shared, fn, args)))
+        else:
+            COALESCED_REQUESTS.inc((str(key),))
+        caller.add_done_callback(lambda f: self.dropCaller(shared, f))
+        return caller
+
+    def runShared(self, shared, fn, args):
+        """Mark the callers of a shared run running, then run it."""
+        with self.lock:
+            for caller in shared[1]:
+                if not caller.running():
+                    # one cancelled meanwhile stays cancelled
+                    caller.set_running_or_notify_cancel()
+        return fn(*args)
+
+    def dropCaller(self, shared, caller):
+        """Drop the shared run when its last caller was cancelled."""
+        if not caller.cancelled():
+            return
+        with self.lock:
+            shared[1].discard(caller)
+            abandoned = not shared[1]
+        if abandoned:
+            # fails once the run started, which then finishes for nobody
+            shared[0].cancel()
+
+    def finishShared(self, key, shared):
+        """Hand the outcome of a shared run to all its callers."""
+        with self.lock:
+            if self.shared.get(key) is shared:
+                del self.shared[key]
+            callers = list(shared[1])
+        future = shared[0]
+        for caller in callers:
+            try:
+                if future.cancelled():
+                    caller.cancel()
+                elif future.exception() is not None:
+                    caller.set_exception(future.exception())
+                else:
+                    caller.set_result(future.result())
+            except InvalidStateError:
+                # cancelled by its caller meanwhile
+                pass
+
+    def stop(self):
+        """Stop the I/O thread once everything queued so far has run."""
+        self.queue.put((sys.maxsize, next(self.counter), time.monotonic(), None, None, ()))
+        self.thread.join()
+
+    def run(self):
+        """Take jobs from the queue and run them one at a time."""
+        while True:
+            priority, _, queuedAt, future, fn, args = self.queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.lastWaitSeconds = time.monotonic() - queuedAt
+            self.totalWaitSeconds += self.lastWaitSeconds
+            self.maxWaitSeconds = max(self.maxWaitSeconds, self.lastWaitSeconds)
+            try:
+                future.set_result(fn(*args))
+            except Exception as ex:
+                self.log.exception("Scheduled call failed: %s", ex)
+                future.set_exception(ex)
+            self.completed += 1
+
+    def getStats(self):
+        """Return queue depth and how long jobs waited before running."""
+        average = self.totalWaitSeconds / self.completed if self.completed else 0.0
+        return {
+            'queue_depth': self.queue.qsize(),
+            'completed': self.completed,
+            'coalesced': self.coalesced,
+            'last_wait_seconds': self.lastWaitSeconds,
+            'average_wait_seconds': average,
+            'max_wait_seconds': self.maxWaitSeconds,
+        }
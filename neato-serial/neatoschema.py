@@ -0,0 +1,221 @@
+"""Typed records for the output of Neato commands.
+
+Each command with a known output gets a record type with __slots__ and
+typed fields, decoded once from the raw reply. Labels not in the schema
+are kept as strings in the record's extra dict.
+"""
+
+
+def toBool(value):
+    """Convert a 0/1 column to bool."""
+    return int(value) != 0
+
+
+def toColumns(value):
+    """Keep all remaining columns as a tuple of stripped strings."""
+    return tuple(v.strip() for v in value.split(','))
+
+
+class Record:
+    """Base of typed command records.
+
+    FIELDS lists (label, attribute, converter) for each known row label.
+    Converters other than toColumns get the first value column; when a row
+    has a unit column (Name,Unit,Value) the value is the last column and
+    the unit is kept in units.
+    """
+
+    __slots__ = ('extra', 'units')
+    FIELDS = ()
+    BY_LABEL = {}
+
+    def __init__(self):
+        for _, attribute, _ in self.FIELDS:
+            setattr(self, attribute, None)
+        self.extra = {}
+        self.units = {}
+
+    @classmethod
+    def parse(cls, output):
+        """Decode raw command output into a record, None if there is no output."""
+        if output is None:
+            return None
+        record = cls()
+        byLabel = cls.BY_LABEL
+        extra = record.extra
+        for line in output.split('\n'):
+            label, comma, rest = line.partition(',')
+            if not comma:
+                continue
+            rest = rest.rstrip('\r')
+            field = byLabel.get(label)
+            if field is None:
+                extra[label] = rest
+                continue
+            attribute, converter = field
+            if converter is not toColumns and ',' in rest:
+                columns = rest.split(',')
+                if len(columns) == 2 and columns[1].strip():
+                    record.units[attribute] = columns[0].strip()
+                    rest = columns[1]
+                else:
+                    rest = columns[0]
+            try:
+                setattr(record, attribute, converter(rest))
+            except ValueError:
+                extra[label] = rest
+        return record
+
+    def get(self, label, default=None):
+        """Return the typed value of a firmware label, like the old dict results."""
+        field = self.BY_LABEL.get(label)
+        if field is not None:
+            value = getattr(self, field[0])
+            return default if value is None else value
+        return self.extra.get(label, default)
+
+    def asDict(self):
+        """Return known fields as a dict of attribute to value."""
+        return {attribute: getattr(self, attribute) for _, attribute, _ in self.FIELDS}
+
+    def __repr__(self):
+        return self.__class__.__name__ + repr(self.asDict())
+
+
+def recordType(name, fields):
+    """Create a Record subclass with slots for the given (label, attribute, converter) fields."""
+    return type(name, (Record,), {
+        '__slots__': tuple(attribute for _, attribute, _ in fields),
+        'FIELDS': tuple(fields),
+        'BY_LABEL': {label: (attribute, converter) for label, attribute, converter in fields},
+    })
+
+
+def intFields(labels):
+    """Fields for labels that are all integers, attribute names lower-cased."""
+    return [(label, label.lower(), int) for label in labels]
+
+
+VersionInfo = recordType('VersionInfo', [
+    ('Product Model', 'product_model', toColumns),
+    ('Serial Number', 'serial_number', toColumns),
+    ('Software', 'software', toColumns),
+    ('MainBoard Software', 'mainboard_software', toColumns),
+    ('MainBoard Version', 'mainboard_version', toColumns),
+    ('LDS Software', 'lds_software', toColumns),
+    ('LDS Serial', 'lds_serial', toColumns),
+    ('LDS CPU', 'lds_cpu', toColumns),
+    ('BootLoader Software', 'bootloader_software', toColumns),
+    ('Chassis Version', 'chassis_version', toColumns),
+    ('UI Board Software', 'ui_board_software', toColumns),
+])
+
+ChargerInfo = recordType('ChargerInfo', [
+    ('FuelPercent', 'fuel_percent', int),
+    ('BatteryOverTemp', 'battery_over_temp', toBool),
+    ('ChargingActive', 'charging_active', toBool),
+    ('ChargingEnabled', 'charging_enabled', toBool),
+    ('ConfidentOnFuel', 'confident_on_fuel', toBool),
+    ('OnReservedFuel', 'on_reserved_fuel', toBool),
+    ('EmptyFuel', 'empty_fuel', toBool),
+    ('BatteryFailure', 'battery_failure', toBool),
+    ('ExtPwrPresent', 'ext_pwr_present', toBool),
+    ('ThermistorPresent[0]', 'thermistor_present_0', toBool),
+    ('ThermistorPresent[1]', 'thermistor_present_1', toBool),
+    ('BattTempCAvg[0]', 'batt_temp_c_avg_0', int),
+    ('BattTempCAvg[1]', 'batt_temp_c_avg_1', int),
+    ('VBattV', 'vbatt_v', float),
+    ('VExtV', 'vext_v', float),
+    ('Charger_mAH', 'charger_mah', int),
+    ('MaxPWM', 'max_pwm', int),
+    ('PWM', 'pwm', int),
+])
+
+MotorInfo = recordType('MotorInfo', intFields([
+    'Brush_MaxPWM', 'Brush_PWM', 'Brush_mVolts', 'Brush_Encoder', 'Brush_RPM',
+    'Vacuum_MaxPWM', 'Vacuum_PWM', 'Vacuum_CurrentInMA', 'Vacuum_Encoder', 'Vacuum_RPM',
+    'LeftWheel_MaxPWM', 'LeftWheel_PWM', 'LeftWheel_mVolts', 'LeftWheel_Encoder',
+    'LeftWheel_PositionInMM', 'LeftWheel_RPM',
+    'RightWheel_MaxPWM', 'RightWheel_PWM', 'RightWheel_mVolts', 'RightWheel_Encoder',
+    'RightWheel_PositionInMM', 'RightWheel_RPM',
+    'Laser_MaxPWM', 'Laser_PWM', 'Laser_mVolts', 'Laser_Encoder', 'Laser_RPM',
+    'Charger_MaxPWM', 'Charger_PWM', 'Charger_mAH',
+    'SideBrush_mA',
+]))
+
+AnalogSensorInfo = recordType('AnalogSensorInfo', intFields([
+    'WallSensorInMM', 'BatteryVoltageInmV', 'LeftDropInMM', 'RightDropInMM',
+    'RightMagSensor', 'LeftMagSensor', 'XTemp0InC', 'XTemp1InC',
+    'VacuumCurrentInmA', 'ChargeVoltInmV', 'BatteryTemp0InC', 'BatteryTemp1InC',
+    'CurrentInmA', 'SideBrushCurrentInmA', 'VoltageReferenceInmV',
+    'AccelXInmG', 'AccelYInmG', 'AccelZInmG',
+    # firmware printing SensorName,Unit,Value
+    'BatteryVoltage', 'BatteryCurrent', 'BatteryTemperature', 'ExternalVoltage',
+    'AccelerometerX', 'AccelerometerY', 'AccelerometerZ', 'VacuumCurrent',
+    'SideBrushCurrent', 'MagSensorLeft', 'MagSensorRight', 'WallSensor',
+    'DropSensorLeft', 'DropSensorRight',
+]))
+
+AccelInfo = recordType('AccelInfo', [
+    ('PitchInDegrees', 'pitch_in_degrees', float),
+    ('RollInDegrees', 'roll_in_degrees', float),
+    ('XInG', 'x_in_g', float),
+    ('YInG', 'y_in_g', float),
+    ('ZInG', 'z_in_g', float),
+    ('SumInG', 'sum_in_g', float),
+])
+
+ButtonInfo = recordType('ButtonInfo', [
+    ('BTN_SOFT_KEY', 'soft_key', toBool),
+    ('BTN_SCROLL_UP', 'scroll_up', toBool),
+    ('BTN_START', 'start', toBool),
+    ('BTN_BACK', 'back', toBool),
+    ('BTN_SCROLL_DOWN', 'scroll_down', toBool),
+])
+
+DigitalSensorInfo = recordType('DigitalSensorInfo', [
+    ('SNSR_DC_JACK_CONNECT', 'dc_jack_connect', toBool),
+    ('SNSR_DUSTBIN_IS_IN', 'dustbin_is_in', toBool),
+    ('SNSR_LEFT_WHEEL_EXTENDED', 'left_wheel_extended', toBool),
+    ('SNSR_RIGHT_WHEEL_EXTENDED', 'right_wheel_extended', toBool),
+    ('LSIDEBIT', 'left_side_bit', toBool),
+    ('LFRONTBIT', 'left_front_bit', toBool),
+    ('RSIDEBIT', 'right_side_bit', toBool),
+    ('RFRONTBIT', 'right_front_bit', toBool),
+])
+
+CalInfo = recordType('CalInfo', intFields([
+    'LDSOffset', 'XAccel', 'YAccel', 'ZAccel', 'RTCOffset', 'LCDContrast',
+    'RDropMin', 'RDropMid', 'RDropMax', 'LDropMin', 'LDropMid', 'LDropMax',
+    'WallMin', 'WallMid', 'WallMax',
+]))
+
+SCHEMAS = {
+    'GetVersion': VersionInfo,
+    'GetCharger': ChargerInfo,
+    'GetMotors': MotorInfo,
+    'GetAnalogSensors': AnalogSensorInfo,
+    'GetAccel': AccelInfo,
+    'GetButtons': ButtonInfo,
+    'GetDigitalSensors': DigitalSensorInfo,
+    'GetCalInfo': CalInfo,
+}
+
+
+def parseRecord(command, output):
+    """Decode output of a command with a known schema into its record type."""
+    return SCHEMAS[command].parse(output)
+
+
+def parseTable(output):
+    """Parse raw output into a dict of first column to second column strings."""
+    if output is None:
+        return None
+    else:
+        lines = output.splitlines()
+        dict = {}
+        for l in lines:
+            lsplit = l.split(',')
+            if len(lsplit) > 1:
+                dict[lsplit[0]] = lsplit[1]
+        return dict
@@ -3,76 +3,407 @@ from config import settings
 import serial
 import os
 import time
-import RPi.GPIO as GPIO
+from gpiobackend import GPIO
 import logging
-import sys
+import neatolog
+from neatoschema import parseRecord, parseTable
+from metrics import registry
+from usbwatch import DeviceWatcher, findDevices
+from cleanstart import CleanStart
+
+# XV firmware ends every response with Ctrl-Z.
+RESPONSE_TERMINATOR = b'\x1a'
+
+COMMAND_SECONDS = registry.histogram(
+    'neato_command_seconds', 'Time from sending a command to the end of its response.',
+    ('command',))
+RESPONSE_TIMEOUTS = registry.counter(
+    'neato_response_timeouts_total', 'Responses that did not end before their deadline.')
+RECONNECTS = registry.counter('neato_reconnects_total', 'Reconnects to the serial port.')
+RECONNECT_SECONDS = registry.histogram(
+    'neato_reconnect_seconds', 'Time from starting a reconnect until the port is open again.')
+USB_TOGGLES = registry.counter('neato_usb_toggles_total', 'Times the USB connection was toggled.')
+BYTES_OUT = registry.counter('neato_serial_bytes_out_total', 'Bytes written to the serial port.')
+BYTES_IN = registry.counter('neato_serial_bytes_in_total', 'Bytes read from the serial port.')
+COALESCED_REQUESTS = registry.counter(
+    'neato_coalesced_requests_total',
+    'Queries answered by an identical exchange already queued or running.', ('command',))
+
+class PrintAndLogLogger(logging.Logger):
+    """Logger writing to console and log file through the shared queue (see neatolog.py)."""
 
-class PrintAndLogLogger(logging.Logger):    
     def __init__(self, name, level=logging.NOTSET):
-        super(PrintAndLogLogger, self).__init__(name, level)
+        super(PrintAndLogLogger, self).__init__(name, self.getLogLevel())
+        self.addHandler(neatolog.configure())
 
-        # Create a handler for console output
-        console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setLevel(self.getLogLevel())  # Set the desired level for console output
+    def getLogLevel(self):
+        return neatolog.getLevel()
 
-        # Create a formatter and add it to the handler
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        console_handler.setFormatter(formatter)
+class WakeUpTracker:
+    """Tracks link activity and learns how long Neato stays awake when idle."""
 
-        # Add the console handler to the logger
-        self.addHandler(console_handler)
+    def __init__(self, idleTimeout, maxIdleTimeout):
+        self.idleTimeout = min(idleTimeout, maxIdleTimeout)
+        self.maxIdleTimeout = maxIdleTimeout
+        self.lastActivity = None
+        self.wakeUpsSent = 0
+        self.wakeUpsSkipped = 0
 
-        # Add file handler
-        file_handler = logging.FileHandler("neato-debug.log")
-        file_handler.setLevel(self.getLogLevel())
-        file_handler.setFormatter(formatter)
-        self.addHandler(file_handler)
+    def idleSeconds(self):
+        """Return seconds since Neato last answered, None if it never did."""
+        if self.lastActivity is None:
+            return None
+        return time.monotonic() - self.lastActivity
+
+    def needsWakeUp(self):
+        """Return true if Neato could be asleep by now."""
+        idle = self.idleSeconds()
+        return idle is None or idle >= self.idleTimeout
+
+    def markActive(self):
+        """Record that Neato just answered."""
+        self.lastActivity = time.monotonic()
+
+    def reset(self):
+        """Forget link activity, e.g. after reconnecting."""
+        self.lastActivity = None
+
+    def learnAwake(self, idle):
+        """Neato answered after being idle for the given seconds."""
+        if idle is not None:
+            self.idleTimeout = min(max(self.idleTimeout, idle * 2),
+                                   self.maxIdleTimeout)
+
+    def learnAsleep(self, idle):
+        """Neato did not answer after being idle for the given seconds."""
+        if idle is not None:
+            self.idleTimeout = min(self.idleTimeout, idle / 2)
+
+    def getStats(self):
+        """Return wake-up counters and the learned idle timeout."""
+        return {
+            'wake_ups_sent': self.wakeUpsSent,
+            'wake_ups_skipped': self.wakeUpsSkipped,
+            'idle_timeout_seconds': self.idleTimeout,
+        }
+
+class ResponseCache:
+    """Caches raw command output for a configurable time per command.
+
+    A TTL of 0 disables caching for a command, a negative TTL keeps the
+    output until the cache is invalidated.
+    """
+
+    def __init__(self, ttls):
+        self.ttls = ttls
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def isCacheable(self, msg):
+        """Return true if output of the message may be cached."""
+        return self.ttls.get(msg, 0) != 0
+
+    def get(self, msg):
+        """Return cached output of the message, None if missing or expired."""
+        if not self.isCacheable(msg):
+            return None
+        entry = self.entries.get(msg)
+        if entry is not None:
+            expires, out = entry
+            if expires is None or time.monotonic() < expires:
+                self.hits += 1
+                return out
+            del self.entries[msg]
+        self.misses += 1
+        return None
+
+    def put(self, msg, out):
+        """Store output of the message if it is cacheable."""
+        ttl = self.ttls.get(msg, 0)
+        if ttl == 0 or not out:
+            return
+        expires = None if ttl < 0 else time.monotonic() + ttl
+        self.entries[msg] = (expires, out)
+
+    def invalidate(self, keepPermanent=False):
+        """Drop cached output, optionally keeping entries without expiry."""
+        if keepPermanent:
+            self.entries = {msg: entry for msg, entry in self.entries.items()
+                            if entry[0] is None}
+        else:
+            self.entries = {}
 
-    def getLogLevel(self):
-        if 'log_level_warning' in settings['serial'] and settings['serial']['log_level_warning']:
-            return logging.WARN
-        return logging.DEBUG
+    def getStats(self):
+        """Return hit and miss counters."""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
 
-class NeatoSerial:
-    """Serial interface to Neato."""
-    
-    def __init__(self):
-        """Initialize serial connection to Neato."""
+class NeatoBase:
+    """Configuration, relay and parsing logic shared by the serial interfaces."""
+
+    def __init__(self, config=None):
+        """Initialize state and the relay, without touching the serial port.
+
+        config is the robot's serial section, by default the one in config.yaml.
+        """
+        self.config = settings['serial'] if config is None else config
         self.isUsbEnabled = True
         self.errorConnectingCount = 0
-        self.log = PrintAndLogLogger(__name__)
-
-        if settings['serial']['usb_switch_mode'] == 'relay':
+        self.log = PrintAndLogLogger(
+            __name__ + '.' + self.config['name'] if self.config.get('name') else __name__)
+        self.wakeUp = WakeUpTracker(
+            float(self.config.get('wake_up_idle_seconds', 5)),
+            float(self.config.get('wake_up_max_idle_seconds', 120)))
+        ttls = {'GetVersion': -1, 'GetCalInfo': -1, 'GetCharger': 5, 'GetMotors': 0}
+        ttls.update(self.config.get('cache_ttl_seconds') or {})
+        self.cache = ResponseCache(ttls)
+        self.ldsDecoder = None
+
+        if self.config['usb_switch_mode'] == 'relay':
             # use relay to temporarily disconnect neato to trigger clean
-            self.pin = int(settings['serial']['relay_gpio'])
+            self.pin = int(self.config['relay_gpio'])
             GPIO.setmode(GPIO.BCM)
             GPIO.setwarnings(False)
             GPIO.setup(self.pin, GPIO.OUT)
             GPIO.output(self.pin, GPIO.HIGH)
+
+    def getFraming(self):
+        """Return how responses are framed: terminator or sleep."""
+        return self.config.get('response_framing', 'terminator')
+
+    def isBatchAnswered(self, data, msgs):
+        """Return true once data holds a reply to every one of msgs, or to the last one.
+
+        Replies come in order, so once the last one arrived a missing earlier
+        one was swallowed, e.g. by a sleeping Neato, and will not come anymore.
+        """
+        frames = data.split(RESPONSE_TERMINATOR)[:-1]
+        if len(frames) >= len(msgs):
+            return True
+        if not frames:
+            return False
+        echo = frames[-1].lstrip().split(b'\r\n')[0].strip().lower()
+        return echo == msgs[-1].lower().encode('utf-8')
+
+    def missingReplies(self, msgs, outputs):
+        """Return the messages of a batch that got no reply."""
+        return [msg for msg in msgs if not outputs.get(msg)]
+
+    def getDevices(self):
+        """Return device paths to try: matches of usb_id and Neato's by-id links before serial_device.
+
+        With device_discovery off only serial_device is tried.
+        """
+        return findDevices(self.config.get('usb_id'),
+                           self.config['serial_device'].split(','),
+                           self.config.get('device_discovery', True))
+
+    def getReconnectTimeout(self):
+        """Return how long a reconnect waits for Neato to enumerate again."""
+        return float(self.config.get('reconnect_timeout_seconds', 15))
+
+    def getUsbOffSeconds(self):
+        """Return the longest time the USB connection is switched off when toggling."""
+        return max(float(self.config.get('usb_off_seconds', 3)), self.getUsbOffMinSeconds())
+
+    def getUsbOffMinSeconds(self):
+        """Return the shortest time the USB connection is switched off when toggling."""
+        return float(self.config.get('usb_off_min_seconds', 1))
+
+    def getHubCtrlCommand(self):
+        """Return the shell command switching the robot's USB hub port off and on."""
+        hub = int(self.config.get('usb_hub', 0))
+        port = int(self.config.get('usb_hub_port', 2))
+        return ('sudo ./hub-ctrl -h %d -P %d -p 0 ; sleep 1; '
+                'sudo ./hub-ctrl -h %d -P %d -p 1 ' % (hub, port, hub, port))
+
+    def getUsbDevice(self):
+        """Return the /dev node of the open port, None if there is none."""
+        if self.ser is None or not self.ser.is_open:
+            return None
+        return os.path.realpath(self.ser.port)
+
+    def newCleanStart(self, msg):
+        """Return a CleanStart for msg with the configured confirmation settings."""
+        return CleanStart(self, msg or "Clean",
+                          float(self.config.get('clean_confirm_seconds', 20)),
+                          float(self.config.get('clean_confirm_poll_seconds', 0.25)),
+                          int(self.config.get('clean_confirm_rpm', 1)))
+
+    def getCommandTimeout(self, msg):
+        """Return the deadline in seconds for the response to a command."""
+        timeouts = self.config.get('command_timeout_seconds') or {}
+        command = msg.split(' ')[0]
+        if command in timeouts:
+            return float(timeouts[command])
+        return float(self.config.get('response_timeout_seconds', 2))
+
+    def enableDisableUsb(self, isEnabled):
+        """Enables or disables usb"""
+        self.cache.invalidate()
+        if isEnabled:
+            self.log.info("Enabling USB.")
+            self.isUsbEnabled = True
+            GPIO.output(self.pin, GPIO.HIGH)
+        else:
+            self.log.info("Disabling USB.")
+            self.isUsbEnabled = False
+            GPIO.output(self.pin, GPIO.LOW)
+
+    def reboot(self):
+        """Reboots RaspberryPi"""
+        os.system('sudo reboot')
+
+    def getWakeUpStats(self):
+        """Return how many wake-ups were sent and skipped."""
+        return self.wakeUp.getStats()
+
+    def getCacheStats(self):
+        """Return response cache hit and miss counters."""
+        return self.cache.getStats()
+
+    def isQuery(self, msg):
+        """Return true if the message only reads state, so identical ones may share one exchange."""
+        return msg.startswith("Get") and 'clear' not in msg.lower()
+
+    def invalidateCacheFor(self, msg):
+        """Drop cached output that a command other than a query may change."""
+        if not msg.startswith("Get"):
+            self.cache.invalidate(keepPermanent=True)
+
+    def observeExchange(self, msgs, started):
+        """Record how long the answer to msgs took since time.monotonic() was started."""
+        command = msgs[0].split(' ')[0] if len(msgs) == 1 else 'batch'
+        COMMAND_SECONDS.observe(time.monotonic() - started, (command,))
+
+    def parseOutput(self, output):
+        """Parse the raw output of the serial port into a dictionary."""
+        return parseTable(output)
+
+    def parseRecord(self, command, output):
+        """Parse the raw output of a known command into its typed record."""
+        return parseRecord(command, output)
+        
+    def parseLDSScan(self, output, out=None):
+        """Decode GetLDSScan output into an LDSScan, reusing out when given."""
+        if self.ldsDecoder is None:
+            # numpy is only needed for lidar scans
+            from ldsscan import LDSScanDecoder
+            self.ldsDecoder = LDSScanDecoder()
+        return self.ldsDecoder.decode(output, out)
+
+    def isCleanMessage(self, msg):
+        """Return true if the message starts cleaning."""
+        return msg.lower() == "clean" or msg.lower() == "clean spot"
+
+    def parseError(self, output):
+        """Parse GetErr output into a (code, message) tuple, None if no error."""
+        if output is not None:
+            outputsplit = output.split('\r\n')
+            if len(outputsplit) == 3:
+                err = outputsplit[1]
+                if ' - ' in err:
+                    errsplit = err.split(' - ')
+                    return errsplit[0], errsplit[1]
+        return None
+
+    def parseBatteryLevel(self, getChargerResult):
+        """Return battery level from GetCharger output."""
+        if getChargerResult:
+            return getChargerResult.get("FuelPercent", 0)
+        else:
+            return 0
+
+    def parseChargingActive(self, getChargerResult):
+        """Return true if GetCharger output says the device is charging."""
+        if getChargerResult:
+            return getChargerResult.get("ChargingActive", False)
+        else:
+            return False
+
+    def parseExtPwrPresent(self, getChargerResult):
+        """Return true if GetCharger output says the device is docked."""
+        if getChargerResult:
+            return getChargerResult.get("ExtPwrPresent", False)
+        else:
+            return False
+
+    def parseSerialNumber(self, getVersionResult):
+        """Return serial number from GetVersion output."""
+        if getVersionResult and getVersionResult.serial_number:
+            return getVersionResult.serial_number[0]
+        else:
+            return str(1234)
+
+    def parseSoftwareVersion(self, getVersionResult):
+        """Return main board software version from GetVersion output."""
+        if getVersionResult and getVersionResult.mainboard_software:
+            return getVersionResult.mainboard_software[0]
+        else:
+            return str(1234)
+
+    def parseVacuumRPM(self, getMotorsResult):
+        """Return vacuum RPM from GetMotors output."""
+        if getMotorsResult:
+            return getMotorsResult.get("Vacuum_RPM", 0)
+        else:
+            return 0
+
+    def parseCombinedState(self, getVersionResult, getChargerResult,
+                           getMotorsResult, error):
+        """Build a CombinedState from parsed command outputs."""
+        combinedState = CombinedState()
+        combinedState.serial_number = self.parseSerialNumber(getVersionResult)
+        combinedState.software_version = self.parseSoftwareVersion(getVersionResult)
+        combinedState.is_docked = self.parseExtPwrPresent(getChargerResult)
+        combinedState.is_cleaning = self.parseVacuumRPM(getMotorsResult) > 0
+        combinedState.is_charging = self.parseChargingActive(getChargerResult)
+        combinedState.fan_speed = self.parseVacuumRPM(getMotorsResult)
+        combinedState.battery_level = self.parseBatteryLevel(getChargerResult)
+        combinedState.error = error
+        combinedState.charger = getChargerResult
+        combinedState.motors = getMotorsResult
+        return combinedState
+
+class NeatoSerial(NeatoBase):
+    """Serial interface to Neato."""
+    
+    def __init__(self, config=None):
+        """Initialize serial connection to Neato."""
+        super(NeatoSerial, self).__init__(config)
+        self.ser = None
         self.isConnected = self.connect()
 
-    def connect(self):
-        """Connect to serial port."""
-        devices = settings['serial']['serial_device'].split(',')
-        for dev in devices:
-            if not self.isUsbEnabled:
-                self.log.debug("Usb is manually disabled, stop trying to connect.")
-                return False
-            
-            try:
-                self.ser = serial.Serial(dev, 115200,
-                                         serial.EIGHTBITS, serial.PARITY_NONE,
-                                         serial.STOPBITS_ONE,
-                                         settings['serial']['timeout_seconds'])
-                self.open()
-                self.log.info("Connected to Neato at "+dev)
-                self.errorConnectingCount = 0
-                return True
-            except:
-                self.log.error("Could not connect to device "+dev+". "
-                               + "Trying next device.")
-                self.errorConnectingCount += 1
-                time.sleep(1)
+    def connect(self, timeout=0):
+        """Connect to serial port, waiting up to timeout seconds for Neato to show up."""
+        deadline = time.monotonic() + timeout
+        # watch before the first try so a device appearing in between isn't missed
+        watcher = DeviceWatcher() if timeout > 0 else None
+        try:
+            while True:
+                devices = self.getDevices()
+                for dev in devices:
+                    if not self.isUsbEnabled:
+                        self.log.debug("Usb is manually disabled, stop trying to connect.")
+                        return False
+
+                    try:
+                        self.ser = self.openPort(dev)
+                        self.open()
+                        self.wakeUp.reset()
+                        self.cache.invalidate()
+                        self.log.info("Connected to Neato at %s", dev)
+                        self.errorConnectingCount = 0
+                        return True
+                    except Exception as ex:
+                        self.log.debug("Could not connect to device %s: %s", dev, ex)
+                if watcher is None or not watcher.wait(deadline - time.monotonic()):
+                    break
+        finally:
+            if watcher is not None:
+                watcher.close()
+        self.log.error("Could not connect to any of %s.", devices)
+        self.errorConnectingCount += len(devices)
 
         # Reboot RaspberryPi in case lots of connection errors:
         if self.errorConnectingCount > 100:
@@ -84,6 +415,13 @@ class NeatoSerial:
         """Return if connected."""
         return self.isConnected
 
+    def openPort(self, dev):
+        """Return a serial port for the device, override to use another port implementation."""
+        return serial.Serial(dev, 115200,
+                             serial.EIGHTBITS, serial.PARITY_NONE,
+                             serial.STOPBITS_ONE,
+                             self.config['timeout_seconds'])
+
     def open(self):
         """Open serial port and flush the input."""
         self.log.info("Entering OPEN()")
@@ -97,9 +435,10 @@ class NeatoSerial:
     def close(self):
         """Close serial port."""
         self.log.info("Entering CLOSE()")
-        self.ser.close()
+        if self.ser is not None:
+            self.ser.close()
         self.isConnected = False
-        self.log.info("Leaving CLOSE, isConnected= "+str(self.isConnected))
+        self.log.info("Leaving CLOSE, isConnected= %s", self.isConnected)
 
     def read_all(self, port, chunk_size=200):
         """Read all characters on the serial port and return them."""
@@ -113,39 +452,54 @@ class NeatoSerial:
             read_buffer += byte_chunk
             if not len(byte_chunk) == chunk_size:
                 break
+        BYTES_IN.inc(amount=len(read_buffer))
         return read_buffer
 
-    def enableDisableUsb(self, isEnabled):
-        """Enables or disables usb"""
-        if isEnabled:
-            self.log.info("Enabling USB.")
-            self.isUsbEnabled = True
-            GPIO.output(self.pin, GPIO.HIGH)
-        else:
-            self.log.info("Disabling USB.")
-            self.isUsbEnabled = False
-            GPIO.output(self.pin, GPIO.LOW)
+    def read_until_terminator(self, port, timeout, count=1, msgs=None):
+        """Read from the serial port until count end-of-response markers or timeout.
 
-    def reboot(self):
-        """Reboots RaspberryPi"""
-        os.system('sudo reboot')
+        With the msgs of a batch, reading also stops once the last one is answered.
+        """
+        deadline = time.monotonic() + timeout
+        read_buffer = b''
+        seen = 0
+        while time.monotonic() < deadline:
+            # Each read waits at most port.timeout when nothing is pending
+            byte_chunk = port.read(size=max(1, port.inWaiting()))
+            read_buffer += byte_chunk
+            seen += byte_chunk.count(RESPONSE_TERMINATOR)
+            if seen >= count or (msgs and RESPONSE_TERMINATOR in byte_chunk
+                                 and self.isBatchAnswered(read_buffer, msgs)):
+                BYTES_IN.inc(amount=len(read_buffer))
+                return read_buffer
+        self.log.warning("Timed out after %ss waiting for end of response.", timeout)
+        RESPONSE_TIMEOUTS.inc()
+        BYTES_IN.inc(amount=len(read_buffer))
+        return read_buffer
 
     def toggleusb(self):
         """Toggle USB connection to Neato."""
         self.log.info("Entering TOGGLEUSB()")
-        if settings['serial']['usb_switch_mode'] == 'direct':
+        USB_TOGGLES.inc()
+        self.cache.invalidate()
+        if self.config['usb_switch_mode'] == 'direct':
             self.log.info("Direct connection specified.")
             # disable and re-enable usb ports to trigger clean
-            os.system('sudo ./hub-ctrl -h 0 -P 2 -p 0 ; sleep 1; '
-                      + 'sudo ./hub-ctrl -h 0 -P 2 -p 1 ')
-        elif settings['serial']['usb_switch_mode'] == 'relay':
+            os.system(self.getHubCtrlCommand())
+        elif self.config['usb_switch_mode'] == 'relay':
             self.log.debug("Relay connection specified")
-            # use relay to temporarily disconnect neato to trigger clean
-            GPIO.output(self.pin, GPIO.LOW)
-            time.sleep(1)
+            # use relay to temporarily disconnect neato to trigger clean,
+            # switching back on once the kernel has seen it go away
+            dev = self.getUsbDevice()
+            with DeviceWatcher() as watcher:
+                GPIO.output(self.pin, GPIO.LOW)
+                switchedOff = time.monotonic()
+                watcher.waitGone(dev, self.getUsbOffSeconds())
+            # the node can vanish within milliseconds, Neato needs the power off for longer
+            time.sleep(max(0, switchedOff + self.getUsbOffMinSeconds() - time.monotonic()))
             GPIO.output(self.pin, GPIO.HIGH)
             self.log.info("Relay toggled.")
-        if settings['serial']['reboot_after_usb_switch']:
+        if self.config['reboot_after_usb_switch']:
             self.reboot()
         self.log.info("Leaving TOGGLEUSB()")
 
@@ -153,223 +507,344 @@ class NeatoSerial:
         """Close and reconnect connection to Neato."""
         self.log.info("Entering RECONNECT()")
         self.log.debug("Reconnecting to Neato")
+        RECONNECTS.inc()
         self.isConnected = False
-        time.sleep(5)
+        self.cache.invalidate()
+        started = time.monotonic()
         self.close()
-        self.isConnected = self.connect()
-        self.open()
-        self.log.info("Leaving RECONNECT(),  isConnected = "+str(self.isConnected))
+        # opens the port as soon as Neato enumerates again instead of sleeping
+        self.isConnected = self.connect(self.getReconnectTimeout())
+        if self.isConnected:
+            RECONNECT_SECONDS.observe(time.monotonic() - started)
+            self.open()
+        self.log.info("Leaving RECONNECT(),  isConnected = %s", self.isConnected)
 
     def handleCleanMessage(self, msg):
         """Handle sending and extra activities for Clean messages."""
-        self.log.info("Entering HANDLECLEANMESSAGE(), msg = "+str(msg))
+        self.log.info("Entering HANDLECLEANMESSAGE(), msg = %s", msg)
         out = self.cleanWithUsbToggle(msg)
-        self.log.info("Leaving HANDLECLEANMESSAGE(), out="+str(out)[:10])
+        self.log.info("Leaving HANDLECLEANMESSAGE(), out=%.10s", out)
         return out
 
     def raw_write(self,msg):
         """Write message to serial and return output."""
-        self.log.info("Entering RAW_WRITE(), msg = "+str(msg))
+        self.log.info("Entering RAW_WRITE(), msg = %s", msg)
         out = ''
         if self.isConnected:
-            inp = msg+"\n"
-            self.ser.write(inp.encode('utf-8'))
-            time.sleep(1)
-            while self.ser.inWaiting() > 0:
-                out += self.read_all(self.ser).decode('utf-8')
+            inp = (msg+"\n").encode('utf-8')
+            BYTES_OUT.inc(amount=len(inp))
+            started = time.monotonic()
+            if self.getFraming() == 'terminator':
+                # drop leftovers of earlier responses so they don't frame this one
+                self.ser.flushInput()
+                self.ser.write(inp)
+                out = self.read_until_terminator(
+                    self.ser, self.getCommandTimeout(msg)).decode('utf-8')
+            else:
+                self.ser.write(inp)
+                time.sleep(1)
+                while self.ser.inWaiting() > 0:
+                    out += self.read_all(self.ser).decode('utf-8')
+            self.observeExchange([msg], started)
+            if out != '':
+                self.wakeUp.markActive()
         self.log.info("Leaving RAW_WRITE()")
         return out
 
+    def raw_write_batch(self, msgs):
+        """Write messages back-to-back and return their outputs by message.
+
+        Messages that got no reply are left out.
+        """
+        self.log.info("Entering RAW_WRITE_BATCH(), msgs = %s", msgs)
+        outputs = {}
+        if self.isConnected:
+            if self.getFraming() != 'terminator':
+                # without framing the replies can't be told apart
+                for msg in msgs:
+                    outputs[msg] = self.raw_write(msg)
+                return outputs
+            self.ser.flushInput()
+            inp = ''.join(msg+"\n" for msg in msgs).encode('utf-8')
+            BYTES_OUT.inc(amount=len(inp))
+            started = time.monotonic()
+            self.ser.write(inp)
+            timeout = sum(self.getCommandTimeout(msg) for msg in msgs)
+            data = self.read_until_terminator(self.ser, timeout, len(msgs), msgs)
+            self.observeExchange(msgs, started)
+            frames = [f.decode('utf-8') + RESPONSE_TERMINATOR.decode('utf-8')
+                      for f in data.split(RESPONSE_TERMINATOR)[:-1]]
+            if len(frames) == len(msgs):
+                outputs = dict(zip(msgs, frames))
+            else:
+                # some replies went missing, match the rest on the echoed command
+                self.log.warning("Got %s of %s responses in batch.", len(frames), len(msgs))
+                for frame in frames:
+                    echo = frame.lstrip().split('\r\n')[0].strip().lower()
+                    for msg in msgs:
+                        if msg.lower() == echo and msg not in outputs:
+                            outputs[msg] = frame
+                            break
+            if frames:
+                self.wakeUp.markActive()
+        self.log.info("Leaving RAW_WRITE_BATCH()")
+        return outputs
+
     def write(self, msg):
         """Write message to serial and return output. Handles Clean message."""
-        self.log.info("Entering WRITE, msg = "+msg)
+        self.log.info("Entering WRITE, msg = %s", msg)
+        cached = self.cache.get(msg)
+        if cached is not None:
+            self.log.info("Leaving WRITE(), cached out = %.10s", cached)
+            return cached
+        self.invalidateCacheFor(msg)
         if self.isConnected:
-            # wake up neato by sending something random
             try:
-                self.log.info("Sending Wake-up msg.")
-                out = self.raw_write("wake-up")
+                idle = self.wakeUp.idleSeconds()
+                skippedWakeUp = not self.wakeUp.needsWakeUp()
+                if not skippedWakeUp:
+                    self.sendWakeUp()
                 # now send the real message
-                if msg.lower() == "clean" or msg.lower() == "clean spot":
+                if self.isCleanMessage(msg):
                     out = self.handleCleanMessage(msg)
                 else:
                     out = self.raw_write(msg)
+                    if skippedWakeUp and out == '':
+                        self.log.info("No answer without wake-up, Neato fell asleep after %ss idle.", idle)
+                        self.wakeUp.learnAsleep(idle)
+                        self.sendWakeUp()
+                        out = self.raw_write(msg)
+                    elif skippedWakeUp:
+                        self.wakeUp.wakeUpsSkipped += 1
+                    self.cache.put(msg, out)
                 if out != '':
-                    self.log.info("Leaving WRITE(), out = "+str(out)[:10])
+                    self.log.info("Leaving WRITE(), out = %.10s", out)
                     return out
             except OSError as ex:
-                self.log.error("Exception in 'write' method: "+str(ex))
-                if not self.isUsbEnabled:
-                    self.log.warning("Planned disconnection of USB → UART occurred, no need to reconnect")
-                    self.close()
-                else:
-                    self.log.info("Calling RECONNECT()")
-                    self.reconnect()
+                self.handleWriteError(ex)
         else:
-            if self.isUsbEnabled:
-                self.log.info("Not connected in WRITE() - calling CONNECT()")
-                self.isConnected = self.connect()
-            else:
-                self.log.info("Usb is manually disabled, can't communicate yet.");
+            self.handleNotConnected()
+
+    def writeBatch(self, msgs):
+        """Write several messages in one burst and return their outputs by message.
+
+        Outputs are None for messages that got no answer. Clean messages are
+        sent one by one through write().
+        """
+        self.log.info("Entering WRITEBATCH, msgs = %s", msgs)
+        msgs = list(dict.fromkeys(msgs))
+        results = {msg: self.cache.get(msg) for msg in msgs}
+        queries = [m for m in msgs if results[m] is None and not self.isCleanMessage(m)]
+        if not queries and not any(self.isCleanMessage(m) for m in msgs):
+            self.log.info("Leaving WRITEBATCH(), all outputs cached")
+            return results
+        for msg in queries:
+            self.invalidateCacheFor(msg)
+        if self.isConnected:
+            try:
+                idle = self.wakeUp.idleSeconds()
+                skippedWakeUp = not self.wakeUp.needsWakeUp()
+                if not skippedWakeUp:
+                    self.sendWakeUp()
+                # Clean messages alone are sent by write() below, there is nothing to read here
+                outputs = self.raw_write_batch(queries) if queries else {}
+                missing = self.missingReplies(queries, outputs)
+                if missing and skippedWakeUp:
+                    # a sleeping Neato only swallows the first command of a burst
+                    self.log.info("No answer to %s without wake-up, Neato fell asleep after %ss idle.",
+                                  missing, idle)
+                    self.wakeUp.learnAsleep(idle)
+                    self.sendWakeUp()
+                elif skippedWakeUp:
+                    self.wakeUp.wakeUpsSkipped += 1
+                if missing:
+                    outputs.update(self.raw_write_batch(missing))
+                for msg, out in outputs.items():
+                    if out != '':
+                        results[msg] = out
+                        self.cache.put(msg, out)
+            except OSError as ex:
+                self.handleWriteError(ex)
+                return results
+        else:
+            self.handleNotConnected()
+            return results
+        for msg in msgs:
+            if self.isCleanMessage(msg):
+                results[msg] = self.write(msg)
+        self.log.info("Leaving WRITEBATCH()")
+        return results
+
+    def handleWriteError(self, ex):
+        """Close or reconnect after a failed write."""
+        self.log.error("Exception in 'write' method: %s", ex)
+        if not self.isUsbEnabled:
+            self.log.warning("Planned disconnection of USB → UART occurred, no need to reconnect")
+            self.close()
+        else:
+            self.log.info("Calling RECONNECT()")
+            self.reconnect()
+
+    def handleNotConnected(self):
+        """Try to connect when a write found the port closed."""
+        if self.isUsbEnabled:
+            self.log.info("Not connected in WRITE() - calling CONNECT()")
+            self.isConnected = self.connect()
+        else:
+            self.log.info("Usb is manually disabled, can't communicate yet.");
     
+    def sendWakeUp(self):
+        """Wake up neato by sending something random."""
+        self.log.info("Sending Wake-up msg.")
+        idle = self.wakeUp.idleSeconds()
+        out = self.raw_write("wake-up")
+        self.wakeUp.wakeUpsSent += 1
+        if out != '':
+            self.wakeUp.learnAwake(idle)
+
     def cleanWithUsbToggle(self, msg = None):
         """Stopping, Clearing Error, in case someone paused it and wants to start again"""
-        self.raw_write("Clean Stop")
-        self.raw_write("GetErr Clear")
-        if msg == None:
-            msg = "Clean"
-        out = self.raw_write(msg)
-        self.log.info("Toggling USB")
-        self.toggleusb()
-        self.log.info("Reconnecting")
-        self.reconnect()
-        return out
-
-    def getError(self):
+        return self.startClean(msg).out
+
+    def startClean(self, msg=None):
+        """Start cleaning and wait until the vacuum runs. Return the finished CleanStart."""
+        self.log.info("Entering STARTCLEAN(), msg = %s", msg)
+        if self.isConnected and self.wakeUp.needsWakeUp():
+            self.sendWakeUp()
+        start = self.newCleanStart(msg)
+        while not start.done():
+            action = start.action()
+            self.log.debug("Clean start: %s", action)
+            result = None
+            if action[0] == 'batch':
+                result = self.raw_write_batch(action[1])
+                for msg in self.missingReplies(action[1], result):
+                    result[msg] = self.raw_write(msg)
+            elif action[0] == 'write':
+                result = self.raw_write(action[1])
+            elif action[0] == 'toggle':
+                self.toggleusb()
+            elif action[0] == 'reconnect':
+                self.reconnect()
+                result = self.isConnected
+            elif action[0] == 'wait':
+                time.sleep(action[1])
+            start.advance(result)
+        self.log.info("Leaving STARTCLEAN(), %s", start.getStats())
+        return start
+
+    def getError(self, getErrResult=None):
         """Return error message if available."""
         self.log.info("Entering GETERROR()")
-        output = self.write("GetErr")
-        if output is not None:
-            outputsplit = output.split('\r\n')
-            if len(outputsplit) == 3:
-                err = outputsplit[1]
-                if ' - ' in err:
-                    errsplit = err.split(' - ')
-                    if int(errsplit[0]) == 220:
-                        # if err is 220 (unplug usb before cleaning) handle it
-                        self.log.info("Errorcode is 220. Let's stop clean and start it fresh")
-                        self.cleanWithUsbToggle()
-                    self.log.info("Leaving GETERROR(), errsplit = "+str(errsplit))
-                    return errsplit[0], errsplit[1]
-            else:
-                self.log.info("Leaving GETERROR(), return None since no output split.")
-                return None
-        else:
+        output = getErrResult
+        if output == None:
+            output = self.write("GetErr")
+        if output is None:
             self.log.info("Leaving GETERROR(), return None since Output is None.")
             return None
+        error = self.parseError(output)
+        if error is not None and int(error[0]) == 220:
+            # if err is 220 (unplug usb before cleaning) handle it
+            self.log.info("Errorcode is 220. Let's stop clean and start it fresh")
+            self.cleanWithUsbToggle()
+        self.log.info("Leaving GETERROR(), error = %s", error)
+        return error
 
     def getBatteryLevel(self, getChargerResult = None):
         """Return battery level."""
         if getChargerResult == None:
             getChargerResult = self.getCharger()
-        if getChargerResult:
-            return int(getChargerResult.get("FuelPercent", 0))
-        else:
-            return 0
+        return self.parseBatteryLevel(getChargerResult)
 
     def getChargingActive(self, getChargerResult = None):
         """Return true if device is currently charging."""
         if getChargerResult == None:
             getChargerResult = self.getCharger()
-        if getChargerResult:
-            return bool(int(getChargerResult.get("ChargingActive", False)))
-        else:
-            return False
+        return self.parseChargingActive(getChargerResult)
 
     def getExtPwrPresent(self, getChargerResult=None):
         """Return true if device is currently docked."""
         if getChargerResult == None:
             getChargerResult = self.getCharger()
-        if getChargerResult:
-            return bool(int(getChargerResult.get("ExtPwrPresent", False)))
-        else:
-            return False
+        return self.parseExtPwrPresent(getChargerResult)
 
     def getAccel(self):
         """Get accelerometer info."""
-        return self.parseOutput(self.write("GetAccel"))
+        return self.parseRecord("GetAccel", self.write("GetAccel"))
 
     def getAnalogSensors(self):
         """Get analog sensor info."""
-        return self.parseOutput(self.write("GetAnalogSensors"))
+        return self.parseRecord("GetAnalogSensors", self.write("GetAnalogSensors"))
 
     def getButtons(self):
         """Get button info."""
-        return self.parseOutput(self.write("GetButtons"))
+        return self.parseRecord("GetButtons", self.write("GetButtons"))
 
     def getCalInfo(self):
         """Get calibration info."""
-        return self.parseOutput(self.write("GetCalInfo"))
+        return self.parseRecord("GetCalInfo", self.write("GetCalInfo"))
 
     def getCharger(self):
         """Get charger info."""
-        return self.parseOutput(self.write("GetCharger"))
+        return self.parseRecord("GetCharger", self.write("GetCharger"))
 
     def getDigitalSensors(self):
         """Get digital sensor info."""
-        return self.parseOutput(self.write("GetDigitalSensors"))
+        return self.parseRecord("GetDigitalSensors", self.write("GetDigitalSensors"))
 
-    def getLDSScan(self):
-        """Get lidar scan."""
-        return self.parseOutput(self.write("GetLDSScan"))
+    def getLDSScan(self, out=None):
+        """Get lidar scan as an LDSScan. Needs TestMode and LDS rotation on.
+
+        Pass an array from LDSScanDecoder.newBuffer() as out to decode in place.
+        """
+        return self.parseLDSScan(self.write("GetLDSScan"), out)
+
+    def streamLDS(self, slots=8, scheduler=None):
+        """Start streaming lidar scans into a ring of slots; close the stream when done.
+
+        Pass the NeatoScheduler that owns this port, if any, as scheduler.
+        """
+        from ldsscan import LDSStream
+        return LDSStream(self, slots, scheduler).start()
 
     def getMotors(self):
         """Get motor info."""
-        return self.parseOutput(self.write("GetMotors"))
+        return self.parseRecord("GetMotors", self.write("GetMotors"))
 
     def getSerialNumber(self, getVersionResult=None):
         if getVersionResult == None:
             getVersionResult = self.getVersion()
-        if getVersionResult:
-            return getVersionResult.get("Serial Number", "1234")
-        else:
-            return str(1234)
+        return self.parseSerialNumber(getVersionResult)
 
     def getSoftwareVersion(self, getVersionResult=None):
         if getVersionResult == None:
             getVersionResult = self.getVersion()
-        if getVersionResult:
-            return getVersionResult.get("MainBoard Software", "1234")
-        else:
-            return str(1234)
+        return self.parseSoftwareVersion(getVersionResult)
 
     def getVersion(self):
         """Get version info."""
-        return self.parseOutput(self.write("GetVersion"))
+        return self.parseRecord("GetVersion", self.write("GetVersion"))
 
     def getVacuumRPM(self, getMotorsResult = None):
         """Get vacuum RPM."""
         if getMotorsResult == None:
             getMotorsResult = self.getMotors()
-        if getMotorsResult:
-            return int(getMotorsResult.get("Vacuum_RPM", 0))
-        else:
-            return 0
+        return self.parseVacuumRPM(getMotorsResult)
 
     def getCleaning(self, getMotorsResult = None):
         """Return true is device is currently cleaning."""
         return self.getVacuumRPM(getMotorsResult) > 0
 
-    def parseOutput(self, output):
-        """Parse the raw output of the serial port into a dictionary."""
-        if output is None:
-            return None
-        else:
-            lines = output.splitlines()
-            dict = {}
-            for l in lines:
-                lsplit = l.split(',')
-                if len(lsplit) > 1:
-                    dict[lsplit[0]] = lsplit[1]
-            return dict
-        
     def getCombinedState(self):
         """Gets combined info by calling methods as few times as possible"""
 
-        getVersionResult = self.getVersion()
-        getChargerResult = self.getCharger()
-        getMotorsResult = self.getMotors()
-
-        combinedState = CombinedState()
-        combinedState.serial_number = self.getSerialNumber(getVersionResult)
-        combinedState.software_version = self.getSoftwareVersion(getVersionResult)
-        combinedState.is_docked = self.getExtPwrPresent(getChargerResult)
-        combinedState.is_cleaning = self.getCleaning(getMotorsResult)
-        combinedState.is_charging = self.getChargingActive(getChargerResult)
-        combinedState.fan_speed = self.getVacuumRPM(getMotorsResult)
-        combinedState.battery_level = self.getBatteryLevel(getChargerResult)
-        combinedState.error = self.getError()
+        results = self.writeBatch(["GetVersion", "GetCharger", "GetMotors", "GetErr"])
+        getVersionResult = self.parseRecord("GetVersion", results["GetVersion"])
+        getChargerResult = self.parseRecord("GetCharger", results["GetCharger"])
+        getMotorsResult = self.parseRecord("GetMotors", results["GetMotors"])
 
-        return combinedState
+        return self.parseCombinedState(getVersionResult, getChargerResult,
+                                       getMotorsResult, self.getError(results["GetErr"]))
 
 class CombinedState:
     def __init__(self):
@@ -381,6 +856,8 @@ class CombinedState:
         self.fan_speed = 0
         self.battery_level = 0
         self.error: tuple[str, str] = None
+        self.charger = None
+        self.motors = None
 
 if __name__ == '__main__':
     ns = NeatoSerial()
@@ -392,6 +869,6 @@ if __name__ == '__main__':
             exit()
         else:
             try:
-                ns.log.info(">> "+ns.write(inp))
+                ns.log.info(">> %s", ns.write(inp))
             except:
                 ns.log.info("No result returned.")
\ No newline at end of file
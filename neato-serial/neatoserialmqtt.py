@@ -1,127 +1,145 @@
-
 """MQTT interface for Neato Serial."""
 from config import settings
+import atexit
 import json
-import time
+import signal
 import sys
+import time
 import paho.mqtt.client as mqtt
 from neatoserial import NeatoSerial, CombinedState
-import logging
+from neatoscheduler import NeatoScheduler, PRIORITY_USER, PRIORITY_POLL
+import neatolog
 import threading
 from restartMqtt import RestartMqtt
+from pollscheduler import PollScheduler
+from changepublisher import ChangePublisher, MQTT_PUBLISHED
+from publishqueue import PublishQueue
+from mqttrpc import CommandRpc
+from mqttpayloads import availabilityTopic, publishState, statusPayload
+from metrics import registry
 
 ns = NeatoSerial()
-restartMqtt = RestartMqtt()
+# all serial access goes through the scheduler's I/O thread
+scheduler = NeatoScheduler(ns)
+# previous fixed pace was publish_wait_seconds plus 2 seconds per loop
+pollScheduler = PollScheduler(settings['mqtt'].get('poll') or {},
+                              settings['mqtt']['publish_wait_seconds'] + 2)
+# watches Home Assistant's view of the MQTT connection on its own thread
+restartMqtt = RestartMqtt() if settings['mqtt'].get('home_assistant') else None
+registry.gauge('neato_scheduler_queue_depth', 'Serial requests waiting for the I/O thread.',
+               lambda: scheduler.getStats()['queue_depth'])
+registry.gauge('neato_scheduler_max_wait_seconds', 'Longest time a serial request waited in the queue.',
+               lambda: scheduler.getStats()['max_wait_seconds'])
+registry.gauge('neato_wake_ups', 'Wake-up messages sent and skipped.',
+               lambda: {('sent',): ns.wakeUp.wakeUpsSent, ('skipped',): ns.wakeUp.wakeUpsSkipped},
+               ('result',))
+registry.gauge('neato_cache_requests', 'Response cache lookups by result.',
+               lambda: {('hit',): ns.cache.hits, ('miss',): ns.cache.misses}, ('result',))
+registry.gauge('neato_connected', '1 while the serial port is connected.', lambda: int(ns.getIsConnected()))
+registry.gauge('neato_log_records_dropped', 'Log records dropped because the log queue was full.',
+               lambda: neatolog.getStats()['dropped'])
+metricsConfig = settings.get('metrics') or {}
+if metricsConfig.get('http_port'):
+    registry.serveHttp(int(metricsConfig['http_port']))
+nextMetricsPublish = 0
 state: CombinedState = None
+ldsThread = None
+recorder = None
+if (settings.get('telemetry') or {}).get('enabled', False):
+    from telemetry import TelemetryRecorder
+    recorder = TelemetryRecorder(settings['telemetry'])
+# latest state for the local HTTP API, which never touches the serial port
+stateStore = None
+apiConfig = settings.get('api') or {}
+if apiConfig.get('enabled', False):
+    from stateapi import StateApi, StateStore
+    stateStore = StateStore()
+    StateApi({apiConfig.get('name', 'neato'): stateStore}, apiConfig.get('host', ''),
+             int(apiConfig.get('port', 8080))).start()
 
-#Function utilized when MQTT Autodiscovery is used - uses "state" schema in Homeassistant
-def discovery_payload():
-    config_data = {
-        'availability': [{'topic': f'neato_serial_{state.serial_number}/state'}],
-        'command_topic': settings['mqtt']['command_topic'],
-        'device': {
-            'identifiers': [f'Neato_serial_{state.serial_number}'],
-            'name': 'neato_serial_vacuum',
-            'manufacturer': 'Neato Robotics',
-            'model': 'XV Series',
-            'sw_version': state.software_version
-        },
-        'name': 'neato_serial',
-        'unique_id': f'neato_serial_{state.serial_number}',
-        'payload_clean_spot': 'Clean Spot',
-        'payload_locate': 'PlaySound 19',
-        'payload_start': 'Clean',
-        'payload_stop': 'Clean Stop',
-        'schema': 'state',
-        'state_topic': settings['mqtt']['state_topic'],
-        'json_attributes_topic': f'vacuum/neato_serial_{state.serial_number}/attributes',
-        'supported_features': ['start', 'stop', 'battery', 'status', 'locate', 'clean_spot']
-    }
-    state_data = {}
-    attributes_data = {}
-    state_data["battery_level"] = state.battery_level
-    if not ns.isUsbEnabled:
-        state_data["battery_icon"] = "mdi:battery-unknown"
-        
-    state_data["fan_speed"] = state.fan_speed
-    attributes_data["charging"] = state.is_charging
-    attributes_data["USB Enabled"] = ns.isUsbEnabled
-    if state.is_docked:
-        state_data["state"] = "docked"
-    elif state.is_cleaning:
-        state_data["state"] = "cleaning"
-    elif state.error:
-        log.debug(f"Error from Neato: {str(state.error[1])}")
-        attributes_data["error"] = state.error[1]
-        state_data["state"] = "error"
-    else:
-        state_data["state"] = "idle"
-
-    #Convert config, state, and attributes payloads to json + publish them
-    json_config_data = json.dumps(config_data)
-    json_state_data = json.dumps(state_data)
-    json_attributes_data = json.dumps(attributes_data)
-    log.debug(f"Sending MQTT Config Message: {str(json_config_data)}")
-    client.publish(settings['mqtt']['discovery_topic'] + f'/vacuum/neato_serial_{state.serial_number}/config', json_config_data)
-    log.debug(f"Sending vacuum state message: {str(json_state_data)}")
-    client.publish(settings['mqtt']['state_topic'], json_state_data)
-    log.debug(f"Sending vacuum attributes message: {str(json_attributes_data)}")
-    client.publish(f'vacuum/neato_serial_{state.serial_number}/attributes', json_attributes_data)
-    time.sleep(settings['mqtt']['publish_wait_seconds'])
+def publish_lds_scans(serial_number):
+    """Streams LDS scans to the lds topic as binary payloads (see ldscodec.py)."""
+    from ldscodec import LDSScanEncoder
+    lds_config = settings['mqtt']['lds']
+    encoder = LDSScanEncoder(lds_config.get('compress', True), lds_config.get('delta', True),
+                             lds_config.get('keyframe_interval', 10))
+    topic = f'vacuum/neato_serial_{serial_number}/lds'
+    log.info("Streaming LDS scans to %s", topic)
+    with ns.streamLDS(lds_config.get('slots', 8), scheduler) as stream:
+        for scan in stream:
+            outbox.publish(topic, encoder.encode(scan), qos=0)
+            MQTT_PUBLISHED.inc((topic,))
+            if stateStore is not None:
+                stateStore.putLDSScan(scan)
 
-#Function utilized when manual MQTT configuration is used - uses "legacy" schema in Homeassistant
-def legacy_payload():
-    legacy_data = {}
-    legacy_data["battery_level"] = state.battery_level
-    legacy_data["docked"] = state.is_docked
-    legacy_data["cleaning"] = state.is_cleaning
-    legacy_data["charging"] = state.is_charging
-    legacy_data["fan_speed"] = state.fan_speed
-    error = ns.getError()
-    if error:
-        log.debug(f"Error from Neato: {str(error)}")
-        legacy_data["error"] = error[1]
-    json_legacy_data = json.dumps(legacy_data)
-    log.debug(f"Sending vacuum state message: {str(json_legacy_data)}")
-    client.publish(settings['mqtt']['state_topic'], json_legacy_data)
-    time.sleep(settings['mqtt']['publish_wait_seconds'])
+def publish_metrics():
+    """Publishes metrics to the retained diagnostics topic and the Prometheus textfile when due."""
+    global nextMetricsPublish
+    interval = float(metricsConfig.get('diagnostics_seconds', 60))
+    if interval <= 0 or time.monotonic() < nextMetricsPublish:
+        return
+    nextMetricsPublish = time.monotonic() + interval
+    topic = f'neato_serial_{state.serial_number}/diagnostics'
+    outbox.publish(topic, registry.toJson(), qos=0, retain=True)
+    MQTT_PUBLISHED.inc((topic,))
+    if metricsConfig.get('textfile'):
+        try:
+            registry.writeTextfile(metricsConfig['textfile'])
+        except OSError as ex:
+            log.warning("Could not write metrics textfile: %s", ex)
 
 def __publish_status(publishStatus: str):
     """Publishes the json with status on message received"""
     if state is None:
-        log.warning(f"While publising status '{publishStatus}', the state was None, so not publishing.")
+        log.warning("While publising status '%s', the state was None, so not publishing.", publishStatus)
         return
     
-    on_message_data={}
-    on_message_data["battery_level"] = state.battery_level
-    on_message_data["fan_speed"] = state.fan_speed
-    on_message_data["state"] = publishStatus
-    json_on_message_data = json.dumps(on_message_data)
-    #Use secondary client connection to set state to idle before Pi reboots (Can't publish with primary client whithin callback function)
-    cleaning_client.publish(settings['mqtt']['state_topic'], json_on_message_data)
+    json_on_message_data = json.dumps(statusPayload(state, publishStatus))
+    outbox.publish(settings['mqtt']['state_topic'], json_on_message_data)
+    MQTT_PUBLISHED.inc((settings['mqtt']['state_topic'],))
+    publisher.remember(settings['mqtt']['state_topic'], json_on_message_data)
+
+def __log_feedback(future):
+    """Logs the device output of a scheduled command."""
+    if future.exception() is None:
+        log.info("Feedback from device: %s", future.result())
+
+def __clean_started(future):
+    """Publishes cleaning once a clean start is confirmed."""
+    if future.exception() is not None:
+        log.error("Starting to clean failed: %s", future.exception())
+        return
+    start = future.result()
+    if start.confirmed():
+        __publish_status("cleaning")
+    else:
+        log.warning("Neato did not start cleaning: %s", start.getStats())
+    pollScheduler.notifyCommand()
 
 def on_message(client, userdata, msg):
     """Message received."""
+    if rpc is not None and msg.topic == rpc.requestTopic:
+        rpc.handle(msg.payload)
+        return
     inp = msg.payload.decode('ascii')
-    log.info(f"Message received: {inp}")
+    log.info("Message received: %s", inp)
+    pollScheduler.notifyCommand()
     if 'discovery_topic' in settings['mqtt']:
         if (inp == "Clean") or (inp == "Clean Spot"):
-            __publish_status("cleaning")
-            feedback = ns.write(inp)
-            log.info(f"Feedback from device: {feedback}")
+            # "cleaning" is published once the vacuum is seen running
+            scheduler.submitCall(ns.startClean, inp, priority=PRIORITY_USER) \
+                .add_done_callback(__clean_started)
         elif inp == "Clean Stop":
             __publish_status("idle")
-            feedback = ns.write(inp)
-            log.info(f"Feedback from device: {feedback}")
+            scheduler.submit(inp, PRIORITY_USER).add_done_callback(__log_feedback)
         elif inp.lower() == "enable usb":
-            ns.enableDisableUsb(True)
-            __publish_status("USB Enabled")
+            scheduler.submitCall(ns.enableDisableUsb, True, priority=PRIORITY_USER) \
+                .add_done_callback(lambda f: __publish_status("USB Enabled"))
         elif inp.lower() == "disable usb":
-            ns.enableDisableUsb(False)
-            __publish_status("USB Disabled")
+            scheduler.submitCall(ns.enableDisableUsb, False, priority=PRIORITY_USER) \
+                .add_done_callback(lambda f: __publish_status("USB Disabled"))
         else:
-            feedback = ns.write(inp)
-            log.info(f"Feedback from device: {feedback}")
+            scheduler.submit(inp, PRIORITY_USER).add_done_callback(__log_feedback)
     else:
         log.error("Non-discovery topic is obsolete and not supported")
 
@@ -129,17 +147,25 @@ def on_connect(client, userdata, flags, rc):
     """Broker responded to connection request"""
     if rc == 0:
         log.info("Connection to broker successful")
+        #Broker may have lost non-retained state, so publish everything again
+        publisher.reset()
         client.subscribe(settings['mqtt']['command_topic'], qos=1)
+        if rpc is not None:
+            client.subscribe(rpc.requestTopic, qos=1)
+        #Send what queued up while disconnected
+        outbox.onConnect()
     else:
         log.info("Problem connecting to broker")
 
 def on_disconnect(client, userdata, rc):
     """Handle MQTT client disconnect."""
-    #Set availability to offline if disconnected from MQTT Broker
+    #The broker sets availability to offline through the will, or shutdown() did before a clean
+    #disconnect; publishing waits for the reconnect
+    outbox.onDisconnect()
     try:
-        cleaning_client.publish(f'neato_serial_{state.serial_number}/state', 'offline', qos=0, retain=True)
+        publisher.remember(f'neato_serial_{state.serial_number}/state', 'offline')
         
-        log.warning(f"Disconnected with code {rc}, attempting to reconnect...")
+        log.warning("Disconnected with code %s, attempting to reconnect...", rc)
         
         if rc != 0:
             def reconnect_forever():
@@ -149,7 +175,7 @@ def on_disconnect(client, userdata, rc):
                         log.info("Reconnected successfully.")
                         return  # Done reconnecting
                     except Exception as e:
-                        log.error(f"Reconnect failed: {e}")
+                        log.error("Reconnect failed: %s", e)
                         time.sleep(30)
 
             # Start the reconnect thread so we don't block the main thread
@@ -158,66 +184,83 @@ def on_disconnect(client, userdata, rc):
             log.info("Disconnected normally. Not trying to reconnect.")
             client.loop_stop(force=False)
     except Exception as outer_exc:
-        log.exception(f"Exception on_disconnect: {outer_exc}")
+        log.exception("Exception on_disconnect: %s", outer_exc)
 
-# def on_publish(client, userdata, mid):
-#     log.debug("on_publish, mid {}".format(mid))
+def shutdown():
+    """Publish offline and disconnect. The broker only sends the will when the connection breaks."""
+    log.info("Shutting down")
+    outbox.publish(willTopic, 'offline', qos=1, retain=True)
+    if not outbox.flush(5):
+        log.warning("Could not publish offline before disconnecting from the broker")
+    client.disconnect()
+    client.loop_stop()
 
-#logging.basicConfig(level=logging.INFO)
-log = logging.getLogger(__name__)
-if settings['serial']['log_level_warning']:
-    log.setLevel(logging.WARN)
-else:
-    log.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch = logging.StreamHandler(sys.stdout)
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(formatter)
-log.addHandler(ch)
-fh = logging.FileHandler('neatoserial.log')
-log = logging.getLogger(__name__)
-if settings['serial']['log_level_warning']:
-    fh.setLevel(logging.WARN)
-else:
-    fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
-log.addHandler(fh)
+# console and rotating log file, written from a background thread (see neatolog.py)
+log = neatolog.getLogger(__name__)
 
 log.debug("Starting")
-#Primary Client
+#One client; everything is published through the queue, also from within callbacks
 client = mqtt.Client()
-#Secondary client that will handle publishing the "cleaning state" when on_message callback is called
-cleaning_client = mqtt.Client()
+outbox = PublishQueue(client, int(settings['mqtt'].get('max_inflight', 20)),
+                      int(settings['mqtt'].get('max_queued', 1000)))
+publisher = ChangePublisher(outbox, settings['mqtt'].get('heartbeat_seconds', 300))
+rpcConfig = settings['mqtt'].get('rpc') or {}
+rpc = CommandRpc(rpcConfig, scheduler, outbox) if rpcConfig.get('enabled', False) else None
+registry.gauge('neato_mqtt_queue_depth', 'MQTT messages waiting to be published.',
+               lambda: outbox.getStats()['queued'])
+registry.gauge('neato_mqtt_inflight', 'MQTT messages handed to the client and not yet published.',
+               lambda: outbox.getStats()['inflight'])
 client.on_message = on_message
 client.on_disconnect = on_disconnect
 client.on_connect = on_connect
-#client.on_publish = on_publish
 client.username_pw_set(settings['mqtt']['username'],
                        settings['mqtt']['password'])
-cleaning_client.username_pw_set(settings['mqtt']['username'],
-                       settings['mqtt']['password'])
+#Let the broker publish offline when the connection drops
+willTopic = availabilityTopic(scheduler.submitCall(ns.getSerialNumber, priority=PRIORITY_POLL).result())
+client.will_set(willTopic, 'offline', qos=0, retain=True)
 log.debug("Connecting")
 client.connect(settings['mqtt']['host'], settings['mqtt']['port'])
-cleaning_client.connect(settings['mqtt']['host'], settings['mqtt']['port'])
 log.debug("Ready")
 client.loop_start()
-cleaning_client.loop_start()
+#systemd stops the service with SIGTERM, exit through atexit so Neato is marked offline
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+atexit.register(shutdown)
+if restartMqtt is not None:
+    restartMqtt.start()
 while True:
     # try:
     #if not ns.getIsConnected():
     #    ns.reconnect()
     if ns.isUsbEnabled:
-        state = ns.getCombinedState()
-        restartMqtt.checkAndRestart()
-    #Determine whether end-user is using MQTT Autodiscovery or Manual configuration
-    if 'discovery_topic' in settings['mqtt']:
-        client.publish(f'neato_serial_{state.serial_number}/state', 'online', qos=0, retain=True)
-        discovery_payload()
-    else:
-        client.publish(f'neato_serial_{state.serial_number}/state', 'online', qos=0, retain=True)
-        legacy_payload()
-        # except Exception as ex:
-        #     log.error("Error getting status: "+str(ex))
+        state = scheduler.submitCall(ns.getCombinedState, priority=PRIORITY_POLL).result()
+        log.debug("Wake-up stats: %s", ns.getWakeUpStats())
+        log.debug("Scheduler stats: %s", scheduler.getStats())
+        log.debug("Publish stats: %s", publisher.getStats())
+        if recorder is not None and ns.getIsConnected():
+            analogSensors = None
+            if recorder.sensors:
+                # the raw read shares the exchange of a GetAnalogSensors command or RPC
+                analogSensors = ns.parseRecord("GetAnalogSensors",
+                                               scheduler.submit("GetAnalogSensors", PRIORITY_POLL).result())
+            recorder.record(state, analogSensors)
+            log.debug("Telemetry stats: %s", recorder.getStats())
+            if stateStore is not None:
+                stateStore.putRecord('analog_sensors', analogSensors)
+        if stateStore is not None and ns.getIsConnected():
+            stateStore.putState(state)
+        if ldsThread is None and (settings['mqtt'].get('lds') or {}).get('enabled', False):
+            ldsThread = threading.Thread(target=publish_lds_scans, args=(state.serial_number,),
+                                         name="neato-lds-publish", daemon=True)
+            ldsThread.start()
+        publish_metrics()
+    if willTopic != availabilityTopic(state.serial_number):
+        #Neato's serial number changed, the broker uses this from the next connect on
+        willTopic = availabilityTopic(state.serial_number)
+        client.will_set(willTopic, 'offline', qos=0, retain=True)
+    #Autodiscovery ("state" schema) when discovery_topic is set, otherwise manual configuration
+    publishState(publisher, state, settings['mqtt'], ns.isUsbEnabled)
     
-    # Sleep our loop
-    time.sleep(2)
\ No newline at end of file
+    # Sleep our loop, pace depends on what Neato is doing
+    delay = pollScheduler.nextDelay(state, ns.getIsConnected())
+    log.debug("Next poll in %ss", delay)
+    pollScheduler.wait(delay)
\ No newline at end of file
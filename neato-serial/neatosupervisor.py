@@ -0,0 +1,255 @@
+"""Supervisor for several Neatos: one process, one MQTT connection.
+
+Every entry of the robots section in config.yaml gets its own
+AsyncNeatoSerial session on a shared event loop. Serial I/O never blocks
+the loop, so a robot that is slow to answer, reconnecting or starting to
+clean does not hold up the polls of the others. All robots publish and
+receive commands through one MQTT client.
+"""
+from config import settings
+import asyncio
+import json
+import signal
+import sys
+import paho.mqtt.client as mqtt
+import neatolog
+from asyncneatoserial import AsyncNeatoSerial
+from changepublisher import ChangePublisher
+from publishqueue import PublishQueue
+from mqttpayloads import availabilityTopic, publishState, statusPayload
+from pollscheduler import PollScheduler
+from stateapi import StateApi, StateStore
+from metrics import registry
+
+log = neatolog.getLogger(__name__)
+
+
+def robotConfigs():
+    """Return the serial config of each robot: the serial section overridden by its robots entry."""
+    defaults = settings.get('serial') or {}
+    robots = settings.get('robots') or []
+    configs = []
+    for index, robot in enumerate(robots):
+        config = dict(defaults)
+        config.update(robot)
+        config.setdefault('name', 'neato%d' % (index + 1))
+        if len(robots) > 1:
+            # usb_id and the by-id links match any Neato, so each robot only opens its own device
+            config['device_discovery'] = robot.get('device_discovery', False)
+        configs.append(config)
+    return configs
+
+
+class RobotSession:
+    """Polls one robot, publishes its state and runs the commands it receives."""
+
+    def __init__(self, config, outbox, supervisorTopic=None):
+        self.name = config['name']
+        self.ns = AsyncNeatoSerial(config)
+        self.topics = {
+            'command_topic': config.get('command_topic', f'vacuum/{self.name}/command'),
+            'state_topic': config.get('state_topic', f'vacuum/{self.name}/state'),
+        }
+        if supervisorTopic is not None:
+            self.topics['availability_topic'] = supervisorTopic
+        if 'discovery_topic' in settings['mqtt']:
+            self.topics['discovery_topic'] = settings['mqtt']['discovery_topic']
+        self.publisher = ChangePublisher(outbox, settings['mqtt'].get('heartbeat_seconds', 300))
+        self.pollScheduler = PollScheduler(config.get('poll') or settings['mqtt'].get('poll') or {},
+                                           settings['mqtt']['publish_wait_seconds'] + 2)
+        self.state = None
+        self.serialNumber = None
+        self.store = StateStore()
+        self.commands = asyncio.Queue()
+        self.wakeEvent = asyncio.Event()
+
+    async def run(self):
+        """Connect, then poll and run commands until cancelled."""
+        await self.ns.connect()
+        await asyncio.gather(self.poll(), self.runCommands())
+
+    async def poll(self):
+        """Publish the robot's state, paced by its own poll schedule."""
+        while True:
+            try:
+                if self.ns.isUsbEnabled:
+                    await self.pollOnce()
+            except Exception:
+                log.exception("Polling %s failed", self.name)
+            delay = self.pollScheduler.nextDelay(self.state, self.ns.getIsConnected())
+            log.debug("Next poll of %s in %ss", self.name, delay)
+            await self.wait(delay)
+
+    async def pollOnce(self):
+        state = await self.ns.getCombinedState()
+        # without answers the state only holds defaults, e.g. a made up serial number
+        if state.charger is None or state.motors is None:
+            self.state = None
+            if self.serialNumber is not None:
+                self.publisher.publish(availabilityTopic(self.serialNumber), 'offline',
+                                       qos=0, retain=True, heartbeat=False)
+            return
+        self.state = state
+        self.serialNumber = state.serial_number
+        self.store.putState(state)
+        publishState(self.publisher, state, self.topics, self.ns.isUsbEnabled, self.name)
+
+    async def wait(self, delay):
+        """Sleep for delay seconds or until a command arrives."""
+        try:
+            await asyncio.wait_for(self.wakeEvent.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeEvent.clear()
+
+    def onCommand(self, inp):
+        """Queue a command received over MQTT. Call on the event loop."""
+        log.info("Message received for %s: %s", self.name, inp)
+        self.pollScheduler.notifyCommand()
+        self.commands.put_nowait(inp)
+
+    async def runCommands(self):
+        while True:
+            inp = await self.commands.get()
+            try:
+                await self.handleCommand(inp)
+            except Exception:
+                log.exception("Command %s for %s failed", inp, self.name)
+            # poll soon to show the effect of the command
+            self.wakeEvent.set()
+
+    async def handleCommand(self, inp):
+        if (inp == "Clean") or (inp == "Clean Spot"):
+            async with self.ns.lock:
+                start = await self.ns.startClean(inp)
+            if start.confirmed():
+                self.publishStatus("cleaning")
+            else:
+                log.warning("%s did not start cleaning: %s", self.name, start.getStats())
+        elif inp == "Clean Stop":
+            self.publishStatus("idle")
+            log.info("Feedback from %s: %s", self.name, await self.ns.write(inp))
+        elif inp.lower() == "enable usb":
+            self.ns.enableDisableUsb(True)
+            self.publishStatus("USB Enabled")
+        elif inp.lower() == "disable usb":
+            self.ns.enableDisableUsb(False)
+            self.publishStatus("USB Disabled")
+        else:
+            log.info("Feedback from %s: %s", self.name, await self.ns.write(inp))
+
+    def publishStatus(self, status):
+        """Publish status as the robot's state right away."""
+        if self.state is None:
+            log.warning("No state of %s yet, not publishing status '%s'.", self.name, status)
+            return
+        self.publisher.publish(self.topics['state_topic'],
+                               json.dumps(statusPayload(self.state, status)))
+
+
+class Supervisor:
+    """Runs a RobotSession per robot and routes MQTT commands to them."""
+
+    def __init__(self, configs):
+        self.client = mqtt.Client()
+        self.client.username_pw_set(settings['mqtt']['username'], settings['mqtt']['password'])
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.on_disconnect = self.on_disconnect
+        self.outbox = PublishQueue(self.client, int(settings['mqtt'].get('max_inflight', 20)),
+                                   int(settings['mqtt'].get('max_queued', 1000)))
+        # one connection can only have one will, so it marks the supervisor offline, and every
+        # robot's discovery config requires the supervisor to be online too
+        self.availabilityTopic = settings['mqtt'].get('supervisor_availability_topic',
+                                                      'neato_supervisor/state')
+        self.client.will_set(self.availabilityTopic, 'offline', qos=0, retain=True)
+        self.sessions = [RobotSession(config, self.outbox, self.availabilityTopic)
+                         for config in configs]
+        self.byTopic = {}
+        for session in self.sessions:
+            topic = session.topics['command_topic']
+            if topic in self.byTopic:
+                raise ValueError(f"Robots {self.byTopic[topic].name} and {session.name} "
+                                 f"share the command topic {topic}")
+            self.byTopic[topic] = session
+        self.loop = None
+        registry.gauge('neato_robot_connected', "1 while the robot's serial port is connected.",
+                       lambda: {(s.name,): int(s.ns.getIsConnected()) for s in self.sessions},
+                       ('robot',))
+        registry.gauge('neato_mqtt_queue_depth', 'MQTT messages waiting to be published.',
+                       lambda: self.outbox.getStats()['queued'])
+
+    def on_connect(self, client, userdata, flags, rc):
+        """Broker responded to connection request"""
+        if rc == 0:
+            log.info("Connection to broker successful")
+            for session in self.sessions:
+                # broker may have lost non-retained state, so publish everything again
+                session.publisher.reset()
+            client.subscribe([(topic, 1) for topic in self.byTopic])
+            self.outbox.publish(self.availabilityTopic, 'online', qos=0, retain=True)
+            self.outbox.onConnect()
+        else:
+            log.info("Problem connecting to broker")
+
+    def on_message(self, client, userdata, msg):
+        """Hand a command to its robot's session on the event loop."""
+        session = self.byTopic.get(msg.topic)
+        if session is not None:
+            self.loop.call_soon_threadsafe(session.onCommand, msg.payload.decode('ascii'))
+
+    def on_disconnect(self, client, userdata, rc):
+        log.warning("Disconnected from broker with code %s", rc)
+        self.outbox.onDisconnect()
+
+    async def run(self):
+        """Run all sessions; the MQTT client reconnects by itself from its network thread."""
+        self.loop = asyncio.get_running_loop()
+        metricsConfig = settings.get('metrics') or {}
+        if metricsConfig.get('http_port'):
+            registry.serveHttp(int(metricsConfig['http_port']))
+        apiConfig = settings.get('api') or {}
+        if apiConfig.get('enabled', False):
+            await StateApi({session.name: session.store for session in self.sessions},
+                           apiConfig.get('host', ''), int(apiConfig.get('port', 8080))).open()
+        self.client.connect_async(settings['mqtt']['host'], settings['mqtt']['port'])
+        self.client.loop_start()
+        try:
+            await asyncio.gather(*(session.run() for session in self.sessions))
+        finally:
+            await self.shutdown()
+            for session in self.sessions:
+                session.ns.close()
+
+    async def shutdown(self):
+        """Publish every robot and the supervisor offline, then disconnect.
+
+        The broker only sends the will when the connection breaks.
+        """
+        log.info("Shutting down")
+        for session in self.sessions:
+            if session.serialNumber is not None:
+                self.outbox.publish(availabilityTopic(session.serialNumber), 'offline',
+                                    qos=1, retain=True)
+        self.outbox.publish(self.availabilityTopic, 'offline', qos=1, retain=True)
+        if not await self.loop.run_in_executor(None, self.outbox.flush, 5):
+            log.warning("Could not publish offline before disconnecting from the broker")
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+if __name__ == '__main__':
+    configs = robotConfigs()
+    if not configs:
+        log.error("No robots configured, add a robots section to config.yaml.")
+        sys.exit(1)
+
+    async def main():
+        # systemd stops the service with SIGTERM; cancelling runs the shutdown
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            await Supervisor(configs).run()
+        except asyncio.CancelledError:
+            log.info("Stopped")
+
+    asyncio.run(main())
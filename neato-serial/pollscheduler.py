@@ -0,0 +1,66 @@
+"""Adaptive poll pacing for the MQTT bridge."""
+import threading
+import time
+
+# doublings of the disconnected delay after which it stops growing anyway
+MAX_BACKOFF_STEPS = 32
+
+
+class PollScheduler:
+    """Decides how long to wait before polling Neato's state again.
+
+    Polls fast while cleaning or right after a command, slowly while docked
+    and fully charged, and backs off exponentially while disconnected.
+    """
+
+    def __init__(self, config, defaultIdleSeconds=7):
+        """Read intervals from the mqtt poll config section."""
+        self.cleaningSeconds = float(config.get('cleaning_seconds', 2))
+        self.afterCommandSeconds = float(config.get('after_command_seconds', 1))
+        self.afterCommandWindowSeconds = float(config.get('after_command_window_seconds', 30))
+        self.idleSeconds = float(config.get('idle_seconds', defaultIdleSeconds))
+        self.dockedFullSeconds = float(config.get('docked_full_seconds', 60))
+        self.disconnectedMinSeconds = float(config.get('disconnected_min_seconds', 5))
+        self.disconnectedMaxSeconds = float(config.get('disconnected_max_seconds', 300))
+        self.lastCommand = None
+        self.failures = 0
+        # set by a command until the next wait() returns; guarded by wakeCondition
+        self.wakePending = False
+        self.wakeCondition = threading.Condition()
+
+    def nextDelay(self, state, isConnected):
+        """Return seconds to wait before the next poll given the last state."""
+        if not isConnected or state is None:
+            delay = min(self.disconnectedMinSeconds * 2 ** self.failures,
+                        self.disconnectedMaxSeconds)
+            # stop counting at the longest delay, 2 ** failures would overflow the float
+            if delay < self.disconnectedMaxSeconds and self.failures < MAX_BACKOFF_STEPS:
+                self.failures += 1
+            return delay
+        self.failures = 0
+        if (self.lastCommand is not None
+                and time.monotonic() - self.lastCommand < self.afterCommandWindowSeconds):
+            return self.afterCommandSeconds
+        if state.is_cleaning:
+            return self.cleaningSeconds
+        if state.is_docked and not state.is_charging and state.battery_level >= 100:
+            return self.dockedFullSeconds
+        return self.idleSeconds
+
+    def notifyCommand(self):
+        """Record a user command and cut the current wait short."""
+        self.lastCommand = time.monotonic()
+        self.failures = 0
+        with self.wakeCondition:
+            self.wakePending = True
+            self.wakeCondition.notify_all()
+
+    def wait(self, delay):
+        """Sleep for delay seconds or until a command arrives.
+
+        A command that arrived since the last wait returns right away, and
+        one arriving while this returns is kept for the next wait.
+        """
+        with self.wakeCondition:
+            self.wakeCondition.wait_for(lambda: self.wakePending, delay)
+            self.wakePending = False
@@ -0,0 +1,137 @@
+"""Outbound MQTT queue in front of a single paho client."""
+import collections
+import itertools
+import threading
+import paho.mqtt.client as mqtt
+from metrics import registry
+
+MQTT_COALESCED = registry.counter('neato_mqtt_coalesced_total',
+                                  'Queued MQTT messages replaced by a newer one on the same topic.',
+                                  ('topic',))
+MQTT_DROPPED = registry.counter('neato_mqtt_dropped_total',
+                                'Queued MQTT messages dropped because the queue was full.')
+
+
+class PublishQueue:
+    """Thread-safe publishing through one client, in order and with bounded inflight messages.
+
+    Messages wait here while the broker is unreachable and are flushed on
+    reconnect. A message waiting for a topic is replaced by a newer one for
+    the same topic, so only the latest state goes out. At most maxInflight
+    messages are handed to paho before it reports them published. There is
+    no thread of its own: the thread that queues a message, or paho's
+    network thread when a publish completes, sends what is waiting, one
+    thread at a time.
+    """
+
+    def __init__(self, client, maxInflight=20, maxQueued=1000):
+        self.client = client
+        self.maxInflight = maxInflight
+        self.maxQueued = maxQueued
+        # topic, or a unique key for messages that must not be coalesced, to message
+        self.pending = collections.OrderedDict()
+        self.counter = itertools.count()
+        self.inflight = set()
+        self.completedEarly = set()
+        self.connected = False
+        self.draining = False
+        self.coalesced = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        # notified whenever the queue may have run empty or the connection dropped
+        self.idle = threading.Condition(self.lock)
+        client.on_publish = self.on_publish
+
+    def publish(self, topic, payload, qos=0, retain=False, coalesce=True):
+        """Queue payload for topic and send what can be sent.
+
+        With coalesce a message still waiting for topic is replaced; without,
+        e.g. for replies that each matter, the message is always sent.
+        """
+        key = topic if coalesce else (topic, next(self.counter))
+        with self.lock:
+            if key in self.pending:
+                # keep the place in line, so topics don't starve each other
+                self.pending[key] = (topic, payload, qos, retain)
+                self.coalesced += 1
+                MQTT_COALESCED.inc((topic,))
+            else:
+                if len(self.pending) >= self.maxQueued:
+                    self.pending.popitem(last=False)
+                    self.dropped += 1
+                    MQTT_DROPPED.inc()
+                self.pending[key] = (topic, payload, qos, retain)
+        self.drain()
+
+    def drain(self):
+        """Hand waiting messages to paho while connected and below the inflight limit."""
+        with self.lock:
+            if self.draining:
+                return
+            self.draining = True
+        while True:
+            with self.lock:
+                if not self.connected or not self.pending or len(self.inflight) >= self.maxInflight:
+                    self.draining = False
+                    self.idle.notify_all()
+                    return
+                key, message = self.pending.popitem(last=False)
+                topic, payload, qos, retain = message
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+            with self.lock:
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    # lost the connection; keep it for the flush on reconnect unless superseded
+                    if key not in self.pending:
+                        self.pending[key] = message
+                        self.pending.move_to_end(key, last=False)
+                    self.connected = False
+                    self.draining = False
+                    self.idle.notify_all()
+                    return
+                if info.mid in self.completedEarly:
+                    self.completedEarly.discard(info.mid)
+                else:
+                    self.inflight.add(info.mid)
+
+    def on_publish(self, client, userdata, mid):
+        """paho finished a publish, which frees an inflight slot."""
+        with self.lock:
+            if mid in self.inflight:
+                self.inflight.discard(mid)
+                self.idle.notify_all()
+            else:
+                # completed before publish() returned its mid
+                self.completedEarly.add(mid)
+        self.drain()
+
+    def onConnect(self):
+        """Flush what queued up while disconnected. Call from on_connect."""
+        with self.lock:
+            self.connected = True
+            # paho resends or drops what was inflight on its own
+            self.inflight.clear()
+            self.completedEarly.clear()
+        self.drain()
+
+    def onDisconnect(self):
+        """Hold messages until the next onConnect(). Call from on_disconnect."""
+        with self.lock:
+            self.connected = False
+            self.idle.notify_all()
+
+    def flush(self, timeout):
+        """Wait until everything queued was published, e.g. before disconnecting.
+
+        Gives up after timeout seconds or when the connection drops. Return
+        true if nothing is left.
+        """
+        with self.idle:
+            self.idle.wait_for(lambda: not self.connected or not (self.pending or self.inflight),
+                               timeout)
+            return not (self.pending or self.inflight)
+
+    def getStats(self):
+        """Return messages waiting, handed to paho and not yet published, coalesced and dropped."""
+        with self.lock:
+            return {'queued': len(self.pending), 'inflight': len(self.inflight),
+                    'coalesced': self.coalesced, 'dropped': self.dropped}
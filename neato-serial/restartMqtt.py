@@ -1,36 +1,112 @@
 from config import settings
 import requests
-import json
-import logging
+import neatolog
 import os
+import random
+import threading
+from metrics import registry
+
+# failed checks after which the backoff stops growing anyway
+MAX_BACKOFF_STEPS = 32
+
+HA_CHECKS = registry.counter('neato_ha_checks_total',
+                             'Home Assistant MQTT connection checks by result.', ('result',))
+HA_RESTARTS = registry.counter('neato_ha_restarts_total',
+                               'Restarts of the bridge service requested by the watchdog.')
+
 
 class RestartMqtt:
-    """Class to fetch state from Home Assistant and restart MQTT service automatically """
+    """Class to fetch state from Home Assistant and restart MQTT service automatically
+
+    Runs on its own thread so a slow or unreachable Home Assistant never
+    delays the poll loop. The service is only restarted after off_threshold
+    consecutive checks report the connection as off; failed checks back off
+    exponentially.
+    """
     def __init__(self):
-        self.log = logging.getLogger(__name__)
+        self.log = neatolog.getLogger(__name__)
 
-        baseUrl = settings["mqtt"]["home_assistant"]["base_url"]
+        config = settings["mqtt"]["home_assistant"]
+        baseUrl = config["base_url"]
         self.url = f"{baseUrl}/api/states/binary_sensor.is_neato_mqtt_connected"
-        token = settings["mqtt"]["home_assistant"]["token"]
-        self.headers = {
+        token = config["token"]
+        self.session = requests.Session()
+        self.session.headers.update({
             "Authorization": f"Bearer {token}",
             "content-type": "application/json",
-        }
+        })
+        self.timeoutSeconds = float(config.get("timeout_seconds", 5))
+        self.checkSeconds = float(config.get("check_interval_seconds", 60))
+        self.backoffMaxSeconds = float(config.get("backoff_max_seconds", 600))
+        self.offThreshold = max(1, int(config.get("off_threshold", 3)))
+        self.consecutiveOff = 0
+        self.failures = 0
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def check(self):
+        """Return Home Assistant's state of the connection sensor, None if it can't be read."""
+        try:
+            response = self.session.get(self.url, timeout=self.timeoutSeconds)
+            response.raise_for_status()
+            state = response.json()["state"]
+        except (requests.RequestException, ValueError, KeyError, TypeError) as ex:
+            self.log.warning("Could not get MQTT connection state from Home Assistant: %s", ex)
+            HA_CHECKS.inc(("error",))
+            return None
+        self.log.debug("Home Assistant reports MQTT connection %s", state)
+        HA_CHECKS.inc((state,))
+        return state
 
     def checkAndRestart(self):
-        response = requests.get(self.url, headers=self.headers)
+        """Check once, restart the service after enough consecutive offs. Return seconds until the next check."""
+        state = self.check()
+        if state is None:
+            delay = min(self.checkSeconds * 2 ** (self.failures + 1), self.backoffMaxSeconds)
+            # stop counting at the longest delay, 2 ** failures would overflow the float
+            if delay < self.backoffMaxSeconds and self.failures < MAX_BACKOFF_STEPS:
+                self.failures += 1
+        else:
+            self.failures = 0
+            delay = self.checkSeconds
+            if state == "off":
+                self.consecutiveOff += 1
+                if self.consecutiveOff >= self.offThreshold:
+                    self.log.warning("MQTT connection off for %s checks, restarting the mqtt service",
+                                     self.consecutiveOff)
+                    HA_RESTARTS.inc()
+                    self.consecutiveOff = 0
+                    os.popen("sudo systemctl restart neatoserialmqtt")
+            else:
+                self.consecutiveOff = 0
+        # spread checks so they don't line up with the poll loop
+        return delay * random.uniform(0.8, 1.2)
 
-        self.log.debug(response.text)
-        print(response.text)
+    def run(self):
+        """Check until stopped."""
+        delay = self.checkSeconds
+        while not self.stopEvent.wait(delay):
+            try:
+                delay = self.checkAndRestart()
+            except Exception:
+                # the watchdog must outlive anything Home Assistant answers
+                self.log.exception("Checking the MQTT connection failed")
+                delay = self.checkSeconds
 
-        jContent = json.loads(response.text)
-        isOff = jContent["state"] == "off"
-        if isOff:
-            print("Restarting the mqtt service")
-            os.popen("sudo systemctl restart neatoserialmqtt")
-        else:
-            print("All good, service lives")
+    def start(self):
+        """Start checking on a background thread."""
+        self.thread = threading.Thread(target=self.run, name="neato-ha-watchdog", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread and close the session."""
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.session.close()
 
 if __name__ == '__main__':
     app = RestartMqtt()
-    app.checkAndRestart()
\ No newline at end of file
+    print(app.check())
@@ -0,0 +1,293 @@
+"""Local HTTP API serving Neato's latest state from memory.
+
+The bridge or the supervisor puts every polled state, the sensor groups
+it already reads and LDS scans into a StateStore per robot. Requests are
+answered from there, so they never cause serial traffic. Bodies are
+encoded once per change and carry an ETag, so polling unchanged state
+costs a 304.
+
+    GET /                          robots and their entries
+    GET /<robot>/state             CombinedState as JSON
+    GET /<robot>/charger           GetCharger, likewise motors, analog_sensors
+    GET /<robot>/lds               latest LDS scan, binary (see ldscodec.py)
+    GET /<robot>/events            Server-Sent Events, pushed when an entry changes
+
+With a single robot the /<robot> prefix may be left out. JSON entries are
+pushed as event data; binary ones only announce their new ETag.
+"""
+import asyncio
+import json
+import threading
+import time
+import zlib
+import neatolog
+from metrics import registry
+
+CONTENT_JSON = 'application/json'
+CONTENT_BINARY = 'application/octet-stream'
+MAX_HEADER_BYTES = 8192
+SSE_KEEPALIVE_SECONDS = 15
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed'}
+
+API_REQUESTS = registry.counter('neato_api_requests_total', 'State API requests by status.',
+                                ('status',))
+
+
+class Entry:
+    """An encoded body with its content type, ETag and update time."""
+
+    __slots__ = ('body', 'contentType', 'etag', 'updated')
+
+    def __init__(self, body, contentType):
+        self.body = body
+        self.contentType = contentType
+        self.etag = '"%08x-%x"' % (zlib.crc32(body), len(body))
+        self.updated = time.time()
+
+
+class StateStore:
+    """Latest entries of one robot, updated from any thread."""
+
+    def __init__(self):
+        self.entries = {}
+        self.listeners = []
+        self.ldsEncoder = None
+        self.lock = threading.Lock()
+
+    def put(self, name, body, contentType=CONTENT_JSON):
+        """Store body under name. Listeners are only called when it changed; return true if it did."""
+        with self.lock:
+            old = self.entries.get(name)
+            if old is not None and old.body == body:
+                return False
+            self.entries[name] = Entry(body, contentType)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(name)
+        return True
+
+    def putJson(self, name, value):
+        return self.put(name, json.dumps(value, separators=(',', ':'), default=str).encode('utf-8'))
+
+    def putRecord(self, name, record):
+        """Store a typed record with its known fields and the unknown labels."""
+        if record is None:
+            return False
+        value = record.asDict()
+        value.update(record.extra)
+        return self.putJson(name, value)
+
+    def putState(self, state):
+        """Store a CombinedState, its charger and motors records as their own entries."""
+        value = {key: item for key, item in vars(state).items() if key not in ('charger', 'motors')}
+        self.putJson('state', value)
+        self.putRecord('charger', state.charger)
+        self.putRecord('motors', state.motors)
+
+    def putLDSScan(self, scan):
+        """Store an LDS scan as a full, compressed ldscodec payload."""
+        if self.ldsEncoder is None:
+            # numpy is only needed for lidar scans
+            from ldscodec import LDSScanEncoder
+            self.ldsEncoder = LDSScanEncoder(compress=True, delta=False)
+        return self.put('lds', self.ldsEncoder.encode(scan), CONTENT_BINARY)
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def names(self):
+        with self.lock:
+            return sorted(self.entries)
+
+    def addListener(self, listener):
+        """Call listener(name) after an entry changed, on the updating thread."""
+        with self.lock:
+            self.listeners.append(listener)
+
+
+class EventClient:
+    """An open event stream and the entries it has not been sent yet."""
+
+    def __init__(self, robot):
+        self.robot = robot
+        self.dirty = set()
+        self.event = asyncio.Event()
+
+
+class StateApi:
+    """HTTP/1.1 server answering from StateStores, keyed by robot name.
+
+    Runs on the caller's event loop through open(), or on its own thread
+    through start().
+    """
+
+    def __init__(self, stores, host='', port=8080):
+        self.log = neatolog.getLogger(__name__)
+        self.stores = stores
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.clients = set()
+        registry.gauge('neato_api_event_clients', 'Open Server-Sent Events streams.',
+                       lambda: len(self.clients))
+
+    async def open(self):
+        """Start listening on the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle, self.host or None, self.port,
+                                                 limit=MAX_HEADER_BYTES, reuse_address=True)
+        for robot, store in self.stores.items():
+            store.addListener(lambda name, robot=robot:
+                              self.loop.call_soon_threadsafe(self.changed, robot, name))
+        self.log.info("State API listening on port %s", self.port)
+        return self
+
+    def start(self):
+        """Serve from a daemon thread with its own event loop."""
+        started = threading.Event()
+        errors = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.open())
+            except OSError as ex:
+                errors.append(ex)
+                return
+            finally:
+                started.set()
+            loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="neato-state-api", daemon=True)
+        self.thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        return self
+
+    def changed(self, robot, name):
+        """Mark an entry for the event streams of its robot, on the event loop."""
+        for client in self.clients:
+            if client.robot == robot:
+                client.dirty.add(name)
+                client.event.set()
+
+    def resolve(self, path):
+        """Return (store, robot, rest of the path) for a request path."""
+        parts = [part for part in path.split('/') if part]
+        if parts and parts[0] in self.stores:
+            return self.stores[parts[0]], parts[0], parts[1:]
+        if len(self.stores) == 1:
+            robot = next(iter(self.stores))
+            return self.stores[robot], robot, parts
+        return None, None, parts
+
+    def index(self, stores):
+        now = time.time()
+        return json.dumps({robot: {name: {'etag': entry.etag, 'content_type': entry.contentType,
+                                          'age_seconds': round(now - entry.updated, 3)}
+                                   for name, entry in ((name, store.get(name))
+                                                       for name in store.names())}
+                           for robot, store in stores.items()}).encode('utf-8')
+
+    async def handle(self, reader, writer):
+        """Serve requests on one connection until it is closed."""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                request = lines[0].split(' ')
+                if len(request) != 3:
+                    await self.respond(writer, 400, b'', CONTENT_JSON, None, False, False)
+                    return
+                method, target, version = request
+                headers = {}
+                for line in lines[1:]:
+                    name, separator, value = line.partition(':')
+                    if separator:
+                        headers[name.strip().lower()] = value.strip()
+                connection = headers.get('connection', '').lower()
+                keepAlive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                if method not in ('GET', 'HEAD'):
+                    await self.respond(writer, 405, b'', CONTENT_JSON, None, False, keepAlive)
+                    if not keepAlive:
+                        return
+                    continue
+                store, robot, parts = self.resolve(target.split('?')[0])
+                if parts == ['events'] and store is not None:
+                    await self.stream(writer, store, robot)
+                    return
+                if not parts:
+                    stores = self.stores if store is None or target.strip('/') == '' else {robot: store}
+                    await self.respond(writer, 200, self.index(stores), CONTENT_JSON, None,
+                                       method == 'HEAD', keepAlive)
+                    continue
+                entry = store.get(parts[0]) if store is not None and len(parts) == 1 else None
+                if entry is None:
+                    await self.respond(writer, 404, b'', CONTENT_JSON, None, False, keepAlive)
+                elif entry.etag in headers.get('if-none-match', '') or headers.get('if-none-match') == '*':
+                    await self.respond(writer, 304, b'', entry.contentType, entry.etag, True, keepAlive)
+                else:
+                    await self.respond(writer, 200, entry.body, entry.contentType, entry.etag,
+                                       method == 'HEAD', keepAlive)
+                if not keepAlive:
+                    return
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body, contentType, etag, headOnly, keepAlive):
+        API_REQUESTS.inc((status,))
+        head = ['HTTP/1.1 %d %s' % (status, REASONS[status]),
+                'Content-Type: ' + contentType,
+                'Content-Length: %d' % len(body),
+                'Cache-Control: no-cache',
+                'Access-Control-Allow-Origin: *']
+        if etag is not None:
+            head.append('ETag: ' + etag)
+        if not keepAlive:
+            head.append('Connection: close')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if not headOnly and status != 304:
+            writer.write(body)
+        await writer.drain()
+
+    async def stream(self, writer, store, robot):
+        """Send every entry, then each entry again whenever it changes."""
+        API_REQUESTS.inc((200,))
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\nAccess-Control-Allow-Origin: *\r\n'
+                     b'Connection: close\r\n\r\n')
+        client = EventClient(robot)
+        client.dirty.update(store.names())
+        self.clients.add(client)
+        try:
+            while True:
+                if not client.dirty:
+                    client.event.clear()
+                    try:
+                        await asyncio.wait_for(client.event.wait(), SSE_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        writer.write(b': keepalive\n\n')
+                        await writer.drain()
+                        continue
+                # entries that changed several times meanwhile are sent once, as they are now
+                names, client.dirty = client.dirty, set()
+                for name in sorted(names):
+                    entry = store.get(name)
+                    data = (entry.body if entry.contentType == CONTENT_JSON
+                            else json.dumps({'etag': entry.etag}).encode('utf-8'))
+                    writer.write(b'event: ' + name.encode('utf-8') + b'\nid: '
+                                 + entry.etag.encode('utf-8') + b'\ndata: ' + data + b'\n\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(client)
@@ -0,0 +1,269 @@
+"""Time-series telemetry in memory-mapped ring files.
+
+A ring file is a small header followed by a fixed number of fixed-size
+records, so its size on disk never grows. Header layout (little-endian,
+padded to HEADER_SIZE bytes):
+
+    4s  magic b'NTLM'
+    H   format version
+    H   record size in bytes
+    Q   capacity in records
+    Q   records appended since the file was created
+
+Record i lives in slot i % capacity. Timestamps only increase, which lets
+queries binary search the mapped time column and touch just the pages of
+the requested range.
+"""
+import math
+import os
+import struct
+import time
+import numpy as np
+
+MAGIC = b'NTLM'
+VERSION = 2
+HEADER = struct.Struct('<4sHHQQ')
+HEADER_SIZE = 64
+APPENDED_OFFSET = 16
+# records are aggregated this many at a time, bounding memory use of queries
+CHUNK_RECORDS = 65536
+
+# every value but time is float32, NaN when it wasn't measured
+FIELDS = ('battery_level', 'charging', 'docked', 'cleaning', 'error_code',
+          'vbatt_v', 'charger_mah', 'battery_current_ma', 'battery_temp_c',
+          'vacuum_rpm', 'brush_rpm', 'left_wheel_rpm', 'right_wheel_rpm')
+# padded to 64 bytes, keeping every time 8-byte aligned: numpy copies a whole
+# misaligned column before searching it, which would read the entire file
+RECORD = np.dtype([('time', '<f8')] + [(field, '<f4') for field in FIELDS], align=True)
+
+
+def orNan(value):
+    """Return value as float, NaN for None."""
+    return math.nan if value is None else float(value)
+
+
+class TelemetryRing:
+    """A ring of RECORD entries in a memory-mapped file."""
+
+    def __init__(self, path, capacity=None, readOnly=False):
+        """Open the ring at path, creating it with capacity records if needed.
+
+        An existing file with a different layout or capacity is replaced.
+        Read-only rings use the file's own capacity.
+        """
+        self.path = path
+        if not readOnly and not self.matches(path, capacity):
+            self.create(path, capacity)
+        self.file = np.memmap(path, dtype=np.uint8, mode='r' if readOnly else 'r+')
+        magic, version, recordSize, self.capacity, _ = HEADER.unpack_from(self.file)
+        if magic != MAGIC or version != VERSION or recordSize != RECORD.itemsize:
+            raise ValueError("Not a telemetry ring file: " + path)
+        self.appended = self.file[APPENDED_OFFSET:APPENDED_OFFSET + 8].view('<u8')
+        self.records = self.file[HEADER_SIZE:HEADER_SIZE + self.capacity * RECORD.itemsize] \
+            .view(RECORD)
+
+    @staticmethod
+    def matches(path, capacity):
+        """Return true if path is a ring file of this format and capacity."""
+        try:
+            with open(path, 'rb') as f:
+                magic, version, recordSize, fileCapacity, _ = HEADER.unpack(f.read(HEADER.size))
+            expected = HEADER_SIZE + fileCapacity * recordSize
+            return (magic == MAGIC and version == VERSION and recordSize == RECORD.itemsize
+                    and fileCapacity == capacity and os.path.getsize(path) == expected)
+        except (OSError, struct.error):
+            return False
+
+    @staticmethod
+    def create(path, capacity):
+        """Write an empty ring file, sized up front."""
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD.itemsize, capacity, 0)
+                    .ljust(HEADER_SIZE, b'\0'))
+            f.truncate(HEADER_SIZE + capacity * RECORD.itemsize)
+        os.replace(tmp, path)
+
+    def __len__(self):
+        return int(min(self.appended[0], self.capacity))
+
+    def lastTime(self):
+        """Return the timestamp of the newest record, None if empty."""
+        appended = int(self.appended[0])
+        if appended == 0:
+            return None
+        return float(self.records['time'][(appended - 1) % self.capacity])
+
+    def append(self, values):
+        """Store a record given as a tuple in RECORD field order.
+
+        Returns false and drops the record if it is older than the newest one,
+        e.g. while the clock has not been synced after boot.
+        """
+        last = self.lastTime()
+        if last is not None and values[0] < last:
+            return False
+        appended = int(self.appended[0])
+        self.records[appended % self.capacity] = values
+        # count last, so a crash never exposes a half written record
+        self.appended[0] = appended + 1
+        return True
+
+    def flush(self):
+        """Write dirty pages to disk."""
+        self.file.flush()
+
+    def segments(self):
+        """Return views of the stored records in time order, oldest first."""
+        appended = int(self.appended[0])
+        if appended <= self.capacity:
+            return [self.records[:appended]]
+        start = appended % self.capacity
+        return [self.records[start:], self.records[:start]]
+
+    def slices(self, start, end):
+        """Return views of the records with start <= time <= end, oldest first."""
+        result = []
+        for segment in self.segments():
+            times = segment['time']
+            lo = np.searchsorted(times, start, 'left')
+            hi = np.searchsorted(times, end, 'right')
+            if hi > lo:
+                result.append(segment[lo:hi])
+        return result
+
+    def query(self, start, end, fields=None):
+        """Return a copy of the records in [start, end], optionally only some fields."""
+        parts = self.slices(start, end)
+        if fields is not None:
+            parts = [part[['time'] + list(fields)] for part in parts]
+        if not parts:
+            return np.zeros(0, dtype=RECORD if fields is None else
+                            RECORD[['time'] + list(fields)])
+        return np.concatenate(parts)
+
+    def aggregate(self, start, end, bucketSeconds, fields=FIELDS):
+        """Downsample [start, end) into buckets of bucketSeconds.
+
+        Returns a dict with 'time' holding the bucket start times and, for each
+        field, a dict of 'min', 'max' and 'mean' arrays. Buckets without
+        measurements are NaN. Records are read chunk by chunk.
+        """
+        bucketCount = max(1, int(math.ceil((end - start) / bucketSeconds)))
+        sums = {field: np.zeros(bucketCount) for field in fields}
+        counts = {field: np.zeros(bucketCount) for field in fields}
+        mins = {field: np.full(bucketCount, np.nan) for field in fields}
+        maxs = {field: np.full(bucketCount, np.nan) for field in fields}
+        for part in self.slices(start, end):
+            for offset in range(0, len(part), CHUNK_RECORDS):
+                chunk = part[offset:offset + CHUNK_RECORDS]
+                buckets = ((chunk['time'] - start) // bucketSeconds).astype(np.int64)
+                keep = buckets < bucketCount
+                chunk, buckets = chunk[keep], buckets[keep]
+                if len(buckets) == 0:
+                    continue
+                # times are sorted, so each bucket is one run of the chunk
+                firsts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+                index = buckets[firsts]
+                for field in fields:
+                    values = chunk[field].astype(np.float64)
+                    valid = ~np.isnan(values)
+                    sums[field][index] += np.add.reduceat(np.where(valid, values, 0), firsts)
+                    counts[field][index] += np.add.reduceat(valid, firsts)
+                    mins[field][index] = np.fmin(mins[field][index],
+                                                 np.fmin.reduceat(values, firsts))
+                    maxs[field][index] = np.fmax(maxs[field][index],
+                                                 np.fmax.reduceat(values, firsts))
+        result = {'time': start + np.arange(bucketCount) * bucketSeconds}
+        for field in fields:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = sums[field] / counts[field]
+            result[field] = {'min': mins[field], 'max': maxs[field], 'mean': mean}
+        return result
+
+    def close(self):
+        """Flush and unmap the file."""
+        if self.file.mode != 'r':
+            self.flush()
+        del self.records, self.appended, self.file
+
+
+class TelemetryRecorder:
+    """Appends a record per polled CombinedState to a TelemetryRing."""
+
+    def __init__(self, config):
+        """Open the ring from the telemetry config section."""
+        maxBytes = int(float(config.get('max_megabytes', 32)) * 1024 * 1024)
+        capacity = max(1, (maxBytes - HEADER_SIZE) // RECORD.itemsize)
+        self.ring = TelemetryRing(config.get('path', 'telemetry.bin'), capacity)
+        self.flushSeconds = float(config.get('flush_seconds', 60))
+        self.sensors = bool(config.get('sensors', False))
+        self.lastFlush = time.monotonic()
+        self.recorded = 0
+        self.skipped = 0
+
+    def record(self, state, analogSensors=None, timestamp=None):
+        """Append state, plus battery current from a GetAnalogSensors record if given."""
+        charger = getattr(state, 'charger', None)
+        motors = getattr(state, 'motors', None)
+        errorCode = 0
+        if state.error is not None:
+            try:
+                errorCode = int(state.error[0])
+            except ValueError:
+                errorCode = math.nan
+        current = None
+        if analogSensors is not None:
+            current = analogSensors.get('BatteryCurrent', analogSensors.get('CurrentInmA'))
+        values = (
+            time.time() if timestamp is None else timestamp,
+            orNan(state.battery_level),
+            float(state.is_charging),
+            float(state.is_docked),
+            float(state.is_cleaning),
+            errorCode,
+            orNan(charger.vbatt_v if charger else None),
+            orNan(charger.charger_mah if charger else None),
+            orNan(current),
+            orNan(charger.batt_temp_c_avg_0 if charger else None),
+            orNan(motors.vacuum_rpm if motors else state.fan_speed),
+            orNan(motors.brush_rpm if motors else None),
+            orNan(motors.leftwheel_rpm if motors else None),
+            orNan(motors.rightwheel_rpm if motors else None),
+        )
+        if self.ring.append(values):
+            self.recorded += 1
+        else:
+            self.skipped += 1
+        if time.monotonic() - self.lastFlush >= self.flushSeconds:
+            self.ring.flush()
+            self.lastFlush = time.monotonic()
+
+    def getStats(self):
+        """Return records written and skipped, and how many the ring holds."""
+        return {'recorded': self.recorded, 'skipped': self.skipped,
+                'stored': len(self.ring), 'capacity': self.ring.capacity}
+
+    def close(self):
+        """Flush and close the ring."""
+        self.ring.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Print downsampled telemetry.")
+    parser.add_argument('path', nargs='?', default='telemetry.bin')
+    parser.add_argument('--hours', type=float, default=24, help="how far back to look")
+    parser.add_argument('--bucket', type=float, default=3600, help="bucket size in seconds")
+    parser.add_argument('--field', default='battery_level', choices=FIELDS)
+    args = parser.parse_args()
+    ring = TelemetryRing(args.path, readOnly=True)
+    end = time.time()
+    result = ring.aggregate(end - args.hours * 3600, end, args.bucket, [args.field])
+    print("%-20s %10s %10s %10s" % ("bucket", "min", "mean", "max"))
+    for i, t in enumerate(result['time']):
+        values = result[args.field]
+        if not np.isnan(values['mean'][i]):
+            print("%-20s %10.2f %10.2f %10.2f" % (
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(t)),
+                values['min'][i], values['mean'][i], values['max'][i]))
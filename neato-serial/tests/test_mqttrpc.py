@@ -0,0 +1,88 @@
+"""Request slots of the MQTT RPC while commands run late.
+
+Run from the neato-serial directory: python -m pytest tests
+"""
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+os.environ.setdefault('NEATO_SERIAL_CONFIG', os.path.join(HERE, 'test_config.yaml'))
+
+from mqttrpc import CommandRpc  # noqa: E402
+from neatoscheduler import NeatoScheduler  # noqa: E402
+
+
+class SlowNeato:
+    """Answers every command, but only once released."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def isQuery(self, msg):
+        return msg.startswith('Get')
+
+    def write(self, msg):
+        self.started.set()
+        self.release.wait(5)
+        return msg + '\r\nLabel,Value\r\n\x1a'
+
+
+class Outbox:
+    def __init__(self):
+        self.responses = []
+
+    def publish(self, topic, payload, qos=0, retain=False, coalesce=True):
+        self.responses.append(json.loads(payload))
+
+
+class SlotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ns = SlowNeato()
+        self.scheduler = NeatoScheduler(self.ns)
+        self.outbox = Outbox()
+        self.rpc = CommandRpc({'max_pending': 1}, self.scheduler, self.outbox)
+
+    def tearDown(self):
+        self.ns.release.set()
+        self.scheduler.stop()
+
+    def request(self, requestId, command, timeout):
+        self.rpc.handle(json.dumps({'id': requestId, 'command': command,
+                                    'timeout': timeout}).encode('utf-8'))
+
+    def waitFor(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def checkSlotHeldUntilDone(self, command):
+        self.request('slow', command, 0.1)
+        self.assertTrue(self.ns.started.wait(2))
+        self.waitFor(lambda: self.outbox.responses)
+        self.assertEqual(self.outbox.responses[0]['error'], "deadline exceeded")
+        # the command still occupies the serial port, so its slot stays taken
+        self.assertEqual(self.rpc.pending, 1)
+        self.request('next', command, 1)
+        self.assertEqual(self.outbox.responses[1]['id'], 'next')
+        self.assertTrue(self.outbox.responses[1]['error'].startswith("busy"))
+        self.ns.release.set()
+        self.waitFor(lambda: self.rpc.pending == 0)
+
+    def testQueryTimingOutWhileRunning(self):
+        # queries share their run through a key
+        self.checkSlotHeldUntilDone('GetCharger')
+
+    def testActionTimingOutWhileRunning(self):
+        self.checkSlotHeldUntilDone('PlaySound 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
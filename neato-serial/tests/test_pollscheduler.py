@@ -0,0 +1,36 @@
+"""Poll pacing while Neato stays disconnected.
+
+Run from the neato-serial directory: python -m pytest tests
+"""
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from pollscheduler import PollScheduler  # noqa: E402
+
+
+class DisconnectedBackoffTest(unittest.TestCase):
+
+    def testBacksOffToTheMaximum(self):
+        scheduler = PollScheduler({'disconnected_min_seconds': 5, 'disconnected_max_seconds': 300})
+        delays = [scheduler.nextDelay(None, False) for _ in range(8)]
+        self.assertEqual(delays, [5, 10, 20, 40, 80, 160, 300, 300])
+
+    def testStaysAtTheMaximumForever(self):
+        scheduler = PollScheduler({})
+        # a robot unplugged for days polls far more than 1024 times
+        for _ in range(5000):
+            delay = scheduler.nextDelay(None, False)
+        self.assertEqual(delay, 300)
+
+    def testZeroMinimumDoesNotCountForever(self):
+        scheduler = PollScheduler({'disconnected_min_seconds': 0})
+        for _ in range(5000):
+            self.assertEqual(scheduler.nextDelay(None, False), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
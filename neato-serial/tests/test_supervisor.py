@@ -0,0 +1,78 @@
+"""Device selection of several robots under the supervisor, against the emulator.
+
+Run from the neato-serial directory: python -m pytest tests
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+os.environ.setdefault('NEATO_SERIAL_CONFIG', os.path.join(HERE, 'test_config.yaml'))
+
+import usbwatch  # noqa: E402
+from config import settings  # noqa: E402
+from neatoemulator import NeatoEmulator  # noqa: E402
+from asyncneatoserial import AsyncNeatoSerial  # noqa: E402
+
+try:
+    import neatosupervisor
+except ImportError:
+    neatosupervisor = None
+
+
+@unittest.skipIf(neatosupervisor is None, "paho-mqtt is not installed")
+class TwoRobotsTest(unittest.TestCase):
+    """A Neato by-id link, as udev creates it, points at the first robot."""
+
+    def setUp(self):
+        self.byId = tempfile.mkdtemp()
+        self.emulators = []
+        for robot in ('downstairs', 'upstairs'):
+            emulator = NeatoEmulator('/tmp/neato-test-%s-%s' % (os.getpid(), robot),
+                                     latency=0.01, jitter=0, baud=0)
+            emulator.start()
+            self.emulators.append(emulator)
+        os.symlink(self.emulators[0].link,
+                   os.path.join(self.byId, 'usb-Neato_Robotics_Neato_Botvac-if00'))
+
+    def tearDown(self):
+        for emulator in self.emulators:
+            emulator.close()
+        shutil.rmtree(self.byId)
+
+    def robots(self):
+        return [{'name': 'downstairs', 'serial_device': self.emulators[0].link},
+                {'name': 'upstairs', 'serial_device': self.emulators[1].link}]
+
+    def testEachRobotOpensItsOwnDevice(self):
+        async def run():
+            sessions = [AsyncNeatoSerial(config) for config in neatosupervisor.robotConfigs()]
+            try:
+                for ns in sessions:
+                    self.assertTrue(await ns.connect())
+                    self.assertIsNotNone(await ns.getCharger())
+            finally:
+                for ns in sessions:
+                    ns.close()
+
+        with mock.patch.object(usbwatch, 'BY_ID', self.byId), \
+                mock.patch.dict(settings, {'robots': self.robots()}):
+            asyncio.run(run())
+        # the wake-up and GetCharger of each robot reached its own emulator
+        self.assertEqual([emulator.commands for emulator in self.emulators], [2, 2])
+
+    def testSingleRobotFindsTheByIdLink(self):
+        with mock.patch.object(usbwatch, 'BY_ID', self.byId), \
+                mock.patch.dict(settings, {'robots': self.robots()[1:]}):
+            config, = neatosupervisor.robotConfigs()
+            devices = AsyncNeatoSerial(config).getDevices()
+        self.assertEqual(devices[0], os.path.join(self.byId, 'usb-Neato_Robotics_Neato_Botvac-if00'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""Batches sent to a Neato that fell asleep, against the emulator.
+
+Run from the neato-serial directory: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+os.environ.setdefault('NEATO_SERIAL_CONFIG', os.path.join(HERE, 'test_config.yaml'))
+
+from config import settings  # noqa: E402
+from neatoemulator import NeatoEmulator  # noqa: E402
+from neatoserial import NeatoSerial  # noqa: E402
+from asyncneatoserial import AsyncNeatoSerial  # noqa: E402
+
+SLEEP_SECONDS = 1
+QUERIES = ['GetCharger', 'GetMotors', 'GetAnalogSensors', 'GetErr']
+
+
+def robotConfig(link):
+    config = dict(settings['serial'])
+    config['serial_device'] = link
+    config['wake_up_idle_seconds'] = 5
+    return config
+
+
+class SleepingBatchTest(unittest.TestCase):
+    """The emulator swallows the first command after SLEEP_SECONDS idle, as the XV does."""
+
+    def setUp(self):
+        self.link = '/tmp/neato-test-%s-%s' % (os.getpid(), self.id().rsplit('.', 1)[-1])
+        self.emulator = NeatoEmulator(self.link, latency=0.01, jitter=0, baud=0,
+                                      sleepSeconds=SLEEP_SECONDS)
+        self.emulator.start()
+
+    def tearDown(self):
+        self.emulator.close()
+
+    def checkAnswered(self, ns, results, seconds):
+        self.assertEqual(sorted(results), sorted(QUERIES))
+        self.assertEqual(self.emulator.unanswered, 1)
+        # the sleep was learned from the one missing reply
+        self.assertLess(ns.wakeUp.idleTimeout, SLEEP_SECONDS)
+        # and noticed once the last reply came, not after every command timed out
+        self.assertLess(seconds, 2)
+
+    def testSync(self):
+        ns = NeatoSerial(robotConfig(self.link))
+        try:
+            self.assertTrue(ns.getIsConnected())
+            ns.writeBatch(QUERIES)
+            ns.cache.invalidate()
+            time.sleep(SLEEP_SECONDS * 1.5)
+            started = time.monotonic()
+            results = {msg: out for msg, out in ns.writeBatch(QUERIES).items() if out}
+            self.checkAnswered(ns, results, time.monotonic() - started)
+        finally:
+            ns.close()
+
+    def testAsync(self):
+        async def run():
+            ns = AsyncNeatoSerial(robotConfig(self.link))
+            self.assertTrue(await ns.connect())
+            try:
+                await ns.writeBatch(QUERIES)
+                ns.cache.invalidate()
+                await asyncio.sleep(SLEEP_SECONDS * 1.5)
+                started = time.monotonic()
+                results = {msg: out for msg, out in (await ns.writeBatch(QUERIES)).items() if out}
+                self.checkAnswered(ns, results, time.monotonic() - started)
+            finally:
+                ns.close()
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
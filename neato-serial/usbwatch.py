@@ -0,0 +1,161 @@
+"""Finding Neato's serial device and waiting for it to enumerate.
+
+Devices are matched by USB VID:PID through sysfs and by name in
+/dev/serial/by-id. DeviceWatcher wakes up when entries in /dev are created,
+removed or change permissions (inotify), falling back to polling where
+inotify is not available.
+"""
+import asyncio
+import ctypes
+import glob
+import os
+import select
+import time
+
+SYSFS_TTY = '/sys/class/tty'
+BY_ID = '/dev/serial/by-id'
+# used when inotify is not available
+POLL_SECONDS = 0.05
+
+IN_ATTRIB = 0x4
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+
+def usbIdOf(tty):
+    """Return 'vid:pid' of the USB device behind a tty name like ttyACM0, None if not USB."""
+    path = os.path.realpath(os.path.join(SYSFS_TTY, tty, 'device'))
+    # the tty hangs off a USB interface; idVendor/idProduct live on its parent device
+    while path and path != '/':
+        try:
+            with open(os.path.join(path, 'idVendor')) as f:
+                vendor = f.read().strip()
+            with open(os.path.join(path, 'idProduct')) as f:
+                product = f.read().strip()
+            return vendor.lower() + ':' + product.lower()
+        except OSError:
+            path = os.path.dirname(path)
+    return None
+
+
+def findByUsbId(usbId):
+    """Return /dev paths of ttys whose USB device has the given 'vid:pid'."""
+    if not usbId:
+        return []
+    usbId = usbId.lower()
+    devices = []
+    for tty in sorted(os.listdir(SYSFS_TTY)) if os.path.isdir(SYSFS_TTY) else []:
+        if tty.startswith(('ttyACM', 'ttyUSB')) and usbIdOf(tty) == usbId:
+            devices.append('/dev/' + tty)
+    return devices
+
+
+def findByIdLinks(nameContains='neato'):
+    """Return /dev/serial/by-id links whose name contains nameContains."""
+    return sorted(p for p in glob.glob(os.path.join(BY_ID, '*'))
+                  if nameContains.lower() in os.path.basename(p).lower())
+
+
+def findDevices(usbId, configured, discover=True):
+    """Return candidate device paths, most specific first and without duplicates.
+
+    With discover false only the configured paths are returned.
+    """
+    devices = []
+    seen = set()
+    found = findByUsbId(usbId) + findByIdLinks() if discover else []
+    for dev in found + configured:
+        real = os.path.realpath(dev)
+        if real not in seen:
+            seen.add(real)
+            devices.append(dev)
+    return devices
+
+
+class DeviceWatcher:
+    """Waits for device nodes in /dev to appear or change.
+
+    Start watching before the first attempt to open a device, so a node
+    created in between is not missed.
+    """
+
+    def __init__(self, path='/dev'):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, path.encode(), IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_TO) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+        except (OSError, AttributeError):
+            self.fd = None
+
+    def drain(self):
+        """Discard pending events."""
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def wait(self, timeout):
+        """Block until something changes in /dev or timeout passes. Return false on timeout."""
+        if timeout <= 0:
+            return False
+        if self.fd is None:
+            time.sleep(min(POLL_SECONDS, timeout))
+            return True
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        self.drain()
+        return bool(readable)
+
+    async def waitAsync(self, timeout):
+        """Like wait(), for the event loop."""
+        if timeout <= 0:
+            return False
+        if self.fd is None:
+            await asyncio.sleep(min(POLL_SECONDS, timeout))
+            return True
+        loop = asyncio.get_running_loop()
+        changed = loop.create_future()
+        loop.add_reader(self.fd, lambda: changed.done() or changed.set_result(True))
+        try:
+            return await asyncio.wait_for(changed, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(self.fd)
+            self.drain()
+
+    def waitGone(self, path, timeout):
+        """Block until path no longer exists, at most timeout seconds. Return true if it's gone.
+
+        With path None this waits the whole timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while path is None or os.path.exists(path):
+            if not self.wait(deadline - time.monotonic()) and time.monotonic() >= deadline:
+                return False
+        return True
+
+    async def waitGoneAsync(self, path, timeout):
+        """Like waitGone(), for the event loop."""
+        deadline = time.monotonic() + timeout
+        while path is None or os.path.exists(path):
+            if not await self.waitAsync(deadline - time.monotonic()) and time.monotonic() >= deadline:
+                return False
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()